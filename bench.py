@@ -0,0 +1,1644 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for WSocket internals.
+
+usage: python bench.py [benchmark ...]
+
+runs every benchmark if no name is given. `python bench.py load --help`
+shows the options of the loopback load generator.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import tracemalloc
+import zlib
+from multiprocessing import Process, Queue
+from threading import Event as ThreadEvent, Thread, Timer
+from time import monotonic, sleep
+from timeit import default_timer as timer, repeat
+
+from wsocket import (WebSocket, OPCODE_BINARY, OPCODE_CONTINUATION,
+                     OPCODE_TEXT, mask_bytes, AsyncWSocketApp,
+                     AsyncWSocketServer, WSocketApp, SelectorWSGIServer,
+                     FixedHandler, make_server, Dispatcher, Event, Hub,
+                     PerMessageDeflate, RSV0_MASK, Router,
+                     ThreadingWSGIServer, Metrics, Tracer,
+                     SlowestCalls, set_tracer, WebSocketClient, Heartbeat,
+                     SendQueue, WebSocketError, run, LocalBroadcast,
+                     AsyncWebSocketClient, WSocketServer, __version__)
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+def make_frame(payload, opcode=OPCODE_BINARY, mask=None):
+    header = WebSocket.encode_header(True, opcode, mask, len(payload), 0)
+    if mask:
+        payload = mask_bytes(mask, payload)
+
+    return bytes(header) + payload
+
+
+def feed(sock, data, repeat, other):
+    other.close()
+    try:
+        for _ in range(repeat):
+            sock.sendall(data)
+    finally:
+        sock.close()
+
+
+def bench_read(size, count, buffered=True):
+    """frames/sec decoded by `WebSocket.read_message` from a socket pair"""
+    server, client = socket.socketpair()
+    rfile = server.makefile("rb")
+    read = rfile.read if buffered else lambda n: rfile.read(n)
+    ws = WebSocket({}, read, None, Handler(), False)
+    # batch small frames so the writer thread does not dominate
+    batch = max(1, 65536 // (size + 14))
+    data = make_frame(b"x" * size) * batch
+    repeat = max(1, count // batch)
+    # the writer runs in another process to keep it off our GIL
+    writer = Process(target=feed, args=(client, data, repeat, server))
+    writer.start()
+    client.close()
+    start = timer()
+    for _ in range(repeat * batch):
+        ws.read_message()
+    elapsed = timer() - start
+    writer.join()
+    rfile.close()
+    server.close()
+    return repeat * batch / elapsed
+
+
+def drain(sock, other):
+    other.close()
+    while sock.recv(1048576):
+        pass
+
+
+def bench_send(size, count, gather=True):
+    """frames/sec written by `WebSocket.send` to a socket pair"""
+    server, client = socket.socketpair()
+    reader = Process(target=drain, args=(client, server))
+    reader.start()
+    client.close()
+    environ = {"wsocket.socket": server} if gather else {}
+    ws = WebSocket(environ, None, server.sendall, Handler(), False)
+    data = bytearray(size)
+    start = timer()
+    for _ in range(count):
+        ws.send(data, binary=True, do_compress=False)
+    elapsed = timer() - start
+    server.close()
+    reader.join()
+    return count / elapsed
+
+
+def send_frames():
+    print("send (binary bytearray payloads)")
+    print("%10s %16s %16s" % ("size", "socket/s", "write()/s"))
+    for size, count in ((16, 200000), (1024, 100000), (256 * 1024, 2000)):
+        print("%10d %16d %16d" % (size, bench_send(size, count),
+                                  bench_send(size, count, False)))
+
+
+def read_frames():
+    print("read_message (unmasked frames)")
+    print("%10s %16s %16s" % ("size", "buffered/s", "read() only/s"))
+    for size, count in ((16, 200000), (1024, 100000), (1024 * 1024, 200)):
+        print("%10d %16d %16d" % (size, bench_read(size, count),
+                                  bench_read(size, count, False)))
+
+
+def check_mask():
+    """`mask_bytes` must match `WebSocket.mask_payload` byte for byte"""
+    reference = WebSocket.mask_payload
+    data = bytearray(os.urandom(70000))
+    for _ in range(20):
+        mask = os.urandom(4)
+        for length in list(range(70)) + [511, 512, 513, 4097, 65536]:
+            for offset in range(4):
+                chunk = data[offset:offset + length]
+                expected = reference(None, mask, length, chunk)
+                assert mask_bytes(mask, chunk) == expected
+                assert mask_bytes(mask, bytes(chunk)) == expected
+                # unmask in place and into a larger preallocated buffer
+                assert mask_bytes(mask, chunk[:], chunk[:]) == expected
+                out = bytearray(length + 8)
+                assert mask_bytes(mask, chunk, out)[:length] == expected
+
+
+def per_call(func, number, times=5):
+    """best time of `times` runs in microseconds per call"""
+    return min(repeat(func, number=number, repeat=times)) * 1e6 / number
+
+
+def mask():
+    check_mask()
+    print("unmasking, microseconds per payload")
+    print("%10s %16s %16s" % ("size", "mask_bytes", "mask_payload"))
+    key = os.urandom(4)
+    for size in (16, 1024, 65536, 1024 * 1024):
+        data = bytearray(os.urandom(size))
+        number = max(1, 1000000 // size)
+        fast = per_call(lambda: mask_bytes(key, data, data), number)
+        slow = per_call(
+            lambda: WebSocket.mask_payload(None, key, size, data),
+            max(1, number // 100), 3)
+        print("%10d %16.1f %16.1f" % (size, fast, slow))
+
+
+def run_events(event, keys, count):
+    """calls/sec through `event` and whether every key saw them in order"""
+    seen = dict((key, []) for key in keys)
+    done = Queue()
+    total = len(keys) * count
+
+    def handler(i, key):
+        seen[key].append(i)
+        if i == count - 1 and all(len(s) == count for s in seen.values()):
+            done.put(True)
+
+    event += handler
+    start = timer()
+    for i in range(count):
+        for key in keys:
+            event(i, key)
+
+    done.get()
+    elapsed = timer() - start
+    ordered = all(s == list(range(count)) for s in seen.values())
+    return total / elapsed, ordered
+
+
+def dispatch():
+    """`Event` calls handled by a thread per call and by a `Dispatcher`"""
+    keys = [WebSocket({}, None, None, Handler(), False) for _ in range(100)]
+    print("Event dispatch, 100 websockets x 200 messages")
+    print("%12s %12s %8s %8s" % ("", "calls/s", "ordered", "threads"))
+    for name, dispatcher in (("thread/call", None),
+                             ("dispatcher", Dispatcher(workers=16))):
+        rate, ordered = run_events(Event(dispatcher=dispatcher), keys, 200)
+        threads = dispatcher.stats()["threads"] if dispatcher else 20000
+        print("%12s %12d %8s %8d" % (name, rate, ordered, threads))
+
+    print("queue stats  %r" % dispatcher.stats())
+
+
+def receive_all(clients, size):
+    """read one `size` byte frame from every client socket"""
+    for client in clients:
+        left = size
+        while left:
+            left -= len(client.recv(left))
+
+
+def bench_publish(count, message, rounds=20):
+    """
+    publish() latency and the time until every subscriber got the
+    message, compared to `send()` in a loop
+    """
+    hub = Hub()
+    pairs = [socket.socketpair() for _ in range(count)]
+    subscribers = [
+        WebSocket({"wsocket.socket": server}, None, server.sendall,
+                  Handler(), False) for server, client in pairs
+    ]
+    clients = [client for server, client in pairs]
+    for wsock in subscribers:
+        hub.subscribe(wsock, "ticks")
+
+    size = len(hub.encode(message))
+    publish, deliver, loop = [], [], []
+    for _ in range(rounds):
+        start = timer()
+        hub.publish(message, "ticks")
+        publish.append(timer() - start)
+        receive_all(clients, size)
+        deliver.append(timer() - start)
+        start = timer()
+        for wsock in subscribers:
+            wsock.send(message, do_compress=False)
+
+        loop.append(timer() - start)
+        receive_all(clients, size)
+
+    hub.close()
+    for server, client in pairs:
+        server.close()
+        client.close()
+
+    return min(publish), min(deliver), min(loop)
+
+
+def stalled_publish(count, message, rounds=500):
+    """publish() latency when one of `count` subscribers never reads"""
+    hub = Hub()
+    pairs = [socket.socketpair() for _ in range(count)]
+    for server, client in pairs:
+        hub.subscribe(
+            WebSocket({"wsocket.socket": server}, None, server.sendall,
+                      Handler(), False), "ticks")
+
+    clients = [client for server, client in pairs[1:]]
+    size = len(hub.encode(message))
+    worst = 0
+    for _ in range(rounds):
+        start = timer()
+        hub.publish(message, "ticks")
+        worst = max(worst, timer() - start)
+        receive_all(clients, size)
+
+    skipped = hub.skipped
+    hub.close()
+    for server, client in pairs:
+        server.close()
+        client.close()
+
+    return worst, skipped
+
+
+def broadcast():
+    """`Hub.publish` of a market update to 1, 100 and 10k subscribers"""
+    message = '{"symbol": "ACME", "bid": 101.25, "ask": 101.5}' * 4
+    most = min(10000, (raise_fd_limit() - 200) // 2)
+    print("broadcast of a %d byte text message, ms" % len(message))
+    print("%12s %12s %12s %12s" %
+          ("subscribers", "publish()", "delivered", "send() loop"))
+    for count in (1, 100, most):
+        publish, deliver, loop = bench_publish(count, message)
+        print("%12d %12.3f %12.3f %12.3f" %
+              (count, publish * 1000, deliver * 1000, loop * 1000))
+
+    worst, skipped = stalled_publish(100, message * 20)
+    print("one of 100 subscribers stalled: slowest publish() %.3f ms, "
+          "%d messages skipped" % (worst * 1000, skipped))
+
+
+def compressed_frame(message, window_bits=15):
+    """a masked, compressed frame as a client would send it"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -window_bits)
+    payload = compressor.compress(message) + compressor.flush(
+        zlib.Z_SYNC_FLUSH)
+    header = WebSocket.encode_header(True, OPCODE_BINARY, b"abcd",
+                                     len(payload) - 4, RSV0_MASK)
+    return bytes(header) + mask_bytes(b"abcd", payload[:-4])
+
+
+def connection_memory(deflate, count=1000):
+    """
+    bytes held per websocket after it received and sent a compressed
+    message, the size of that message on the wire and microseconds per
+    send()
+    """
+    message = b'{"symbol": "ACME", "bid": 101.25, "ask": 101.5}' * 20
+    if deflate:
+        frame = compressed_frame(message, deflate.client_window_bits)
+
+    else:
+        frame = make_frame(message, mask=b"abcd")
+
+    sent = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    websockets = []
+    for _ in range(count):
+        ws = WebSocket({}, None, sent.append, Handler(), deflate or False)
+        ws.parser.feed(frame)
+        assert ws.receive(block=False) == message
+        ws.send(message)
+        websockets.append(ws)
+
+    del sent[1:]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    send = per_call(lambda: ws.send(message), 2000)
+    return used / count, len(sent[0]), send
+
+
+def deflate_memory():
+    """memory per connection of permessage-deflate settings"""
+    print("permessage-deflate, memory per connection")
+    print("%-42s %8s %10s %10s" % ("settings", "KB", "wire size", "send us"))
+    for name, deflate in (
+        ("no compression", None),
+        ("defaults (level 7, 15 bits, memLevel 8)", PerMessageDeflate()),
+        ("level 6, 12 bits, memLevel 5", PerMessageDeflate(6, 5, 12, 12)),
+        ("level 1, 9 bits, memLevel 1", PerMessageDeflate(1, 1, 9, 9)),
+        ("no context takeover", PerMessageDeflate(7, 8, 15, 15, True,
+                                                  True)),
+    ):
+        used, size, send = connection_memory(deflate)
+        print("%-42s %8.1f %10d %10.1f" % (name, used / 1024, size, send))
+
+
+def send_cost(deflate, message, count=2000):
+    """microseconds per send() and bytes per frame written"""
+    sent = []
+    ws = WebSocket({}, None, sent.append, Handler(), deflate)
+    elapsed = per_call(lambda: ws.send(message), count)
+    size = sum(len(frame) for frame in sent[-count:]) / count
+    return elapsed, size
+
+
+def compression_policy():
+    """send() of small, large and incompressible messages"""
+    messages = (
+        ("20 B text", "price: 101.25 (ACME)"),
+        ("200 B json", '{"symbol": "ACME", "bid": 101.25}' * 6),
+        ("16 KB json", '{"symbol": "ACME", "bid": 101.25}' * 500),
+        ("64 KB random", os.urandom(65536)),
+    )
+    print("send() with permessage-deflate, us per message / bytes sent")
+    print("%-14s %20s %20s" % ("message", "always compress", "policy"))
+    for name, message in messages:
+        always = send_cost(PerMessageDeflate(min_size=0, max_ratio=None),
+                           message)
+        policy = send_cost(PerMessageDeflate(levels=((16384, 1), )),
+                           message)
+        print("%-14s %10.1f /%8d %10.1f /%8d" %
+              ((name, ) + always + policy))
+
+
+def receive_peak(size, stream):
+    """peak memory and time of receiving a `size` bytes message"""
+    server, client = socket.socketpair()
+    rfile = server.makefile("rb")
+    ws = WebSocket({}, rfile.read, None, Handler(), False)
+    frame = make_frame(os.urandom(size), mask=b"abcd")
+    writer = Process(target=feed, args=(client, frame, 1, server))
+    writer.start()
+    client.close()
+    del frame
+    tracemalloc.start()
+    start = timer()
+    if stream:
+        received = sum(len(chunk) for chunk in ws.receive_stream())
+
+    else:
+        received = len(ws.receive())
+
+    elapsed = timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    writer.join()
+    rfile.close()
+    server.close()
+    assert received == size
+    return peak, elapsed
+
+
+def receive_stream():
+    """peak memory of receive() and receive_stream() for large messages"""
+    print("receiving one masked frame")
+    print("%10s %22s %22s" % ("size", "receive()", "receive_stream()"))
+    for size in (1 << 20, 16 << 20, 128 << 20):
+        whole = receive_peak(size, False)
+        streamed = receive_peak(size, True)
+        print("%8d MB %10.1f MB %6.0f ms %10.1f MB %6.0f ms" %
+              (size >> 20, whole[0] / 1048576.0, whole[1] * 1000,
+               streamed[0] / 1048576.0, streamed[1] * 1000))
+
+
+def send_file_peak(path, stream):
+    """peak memory and time of sending a file as one message"""
+    server, client = socket.socketpair()
+    reader = Process(target=drain, args=(client, server))
+    reader.start()
+    client.close()
+    ws = WebSocket({"wsocket.socket": server}, None, server.sendall,
+                   Handler(), False)
+    tracemalloc.start()
+    start = timer()
+    with open(path, "rb") as f:
+        if stream:
+            ws.send_stream(f)
+
+        else:
+            ws.send(f.read())
+
+    elapsed = timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    server.close()
+    reader.join()
+    return peak, elapsed
+
+
+def send_stream():
+    """peak memory of send(f.read()) and send_stream(f) for large files"""
+    print("sending a file as one message")
+    print("%10s %22s %22s" % ("size", "send()", "send_stream()"))
+    for size in (1 << 20, 16 << 20, 128 << 20):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(os.urandom(1 << 20) * (size >> 20))
+            f.flush()
+            whole = send_file_peak(f.name, False)
+            streamed = send_file_peak(f.name, True)
+
+        print("%8d MB %10.1f MB %6.0f ms %10.1f MB %6.0f ms" %
+              (size >> 20, whole[0] / 1048576.0, whole[1] * 1000,
+               streamed[0] / 1048576.0, streamed[1] * 1000))
+
+
+def scan_routes(routes, path):
+    """the linear route scan `WSocketApp.wsgi` used to do"""
+    for route in routes:
+        if route == path:
+            return routes[route]
+
+        if route.endswith("*") and path.startswith(route[:-1]):
+            return routes[route]
+
+
+def routes():
+    """route lookups, linear scan and `Router`, at 10 to 1000 routes"""
+    print("route lookup, us per request")
+    print("%7s %-18s %10s %10s" % ("routes", "path", "scan", "Router"))
+    for count in (10, 100, 1000):
+        table = {}
+        router = Router()
+        for i in range(count // 2):
+            table["/pages/page%d.html" % i] = i
+            table["/assets%d/*" % i] = i
+
+        for rule, callback in table.items():
+            router.add(rule, callback)
+
+        last = count // 2 - 1
+        for name, path in (("last static", "/pages/page%d.html" % last),
+                           ("last wildcard", "/assets%d/app.js" % last),
+                           ("not found", "/missing")):
+            assert scan_routes(table, path) == router.match("GET", path)[0]
+            print("%7d %-18s %10.2f %10.2f" %
+                  (count, name, per_call(lambda: scan_routes(table, path),
+                                         10000),
+                   per_call(lambda: router.match("GET", path), 10000)))
+
+        # parameters, every path new to the cache
+        for i in range(count):
+            router.add("/rooms%d/<id>" % i, i)
+
+        paths = ["/rooms%d/%d" % (count - 1, i) for i in range(10000)]
+        paths = iter(paths * 5)
+        print("%7d %-18s %10s %10.2f" %
+              (count * 2, "<id> uncached", "-",
+               per_call(lambda: router.match("GET", next(paths)), 10000)))
+        print("%7d %-18s %10s %10.2f" %
+              (count * 2, "<id> cached", "-",
+               per_call(lambda: router.match("GET", "/rooms1/7"), 10000)))
+
+
+def metrics_overhead():
+    """cost of the frame counters on the frame path and of the registry"""
+    best = read_per_frame()
+    # to a socket, a send is a system call
+    send = 1e6 / max(bench_send(16, 100000) for _ in range(3))
+    # the statements the frame path runs for metrics, without the frame
+    counted = WebSocket({}, None, None, Handler(), False)
+    header = b"\x82\x10"
+    count_in = min(
+        repeat("parser.frames += 1", number=1000000, repeat=5,
+               globals={"parser": counted.parser}))
+    count_out = min(
+        repeat("ws.frames_out += 1; ws.bytes_out += len(header) + 16",
+               number=1000000, repeat=5,
+               globals={"ws": counted, "header": header}))
+    print("16 byte frames, us per frame")
+    print("%-22s %8s %10s %8s" % ("", "frame", "counting", "share"))
+    print("%-22s %8.3f %10.3f %7.1f%%" %
+          ("read_message", best, count_in, count_in / best * 100))
+    print("%-22s %8.3f %10.3f %7.1f%%" %
+          ("send", send, count_out, count_out / send * 100))
+
+    registry = Metrics()
+    labels = (("handler", "bench.handler"), )
+    print("inc()                  %.3f us" %
+          per_call(lambda: registry.inc("total", 1, labels), 100000))
+    print("observe()              %.3f us" %
+          per_call(lambda: registry.observe("seconds", 0.003, labels),
+                   100000))
+    sockets = [WebSocket({}, None, None, Handler(), False)
+               for _ in range(1000)]
+    for wsock in sockets:
+        registry.track(wsock)
+
+    print("render(), 1000 open    %.0f us" % per_call(registry.render, 20))
+
+
+def read_per_frame(count=100000):
+    """best in-memory `read_message` time of 16 byte frames, us"""
+    data = make_frame(b"x" * 16) * count
+    best = None
+    for _ in range(5):
+        ws = WebSocket({}, None, None, Handler(), False)
+        ws.parser.feed(data)
+        start = timer()
+        for _ in range(count):
+            ws.read_message(False)
+
+        elapsed = (timer() - start) * 1e6 / count
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def fragmented_text(text, fragment_size):
+    """frames of `text` as a message cut in `fragment_size` byte fragments"""
+    data = text.encode("utf-8")
+    frames = []
+    for start in range(0, len(data), fragment_size):
+        fin = start + fragment_size >= len(data)
+        opcode = OPCODE_CONTINUATION if start else OPCODE_TEXT
+        payload = data[start:start + fragment_size]
+        header = WebSocket.encode_header(fin, opcode, None, len(payload), 0)
+        frames.append(bytes(header) + payload)
+
+    return b"".join(frames)
+
+
+def receive_text(data, raw_text, count=20):
+    """best in-memory time to receive the message in `data`, ms"""
+    best = None
+    for _ in range(count):
+        ws = WebSocket({}, None, None, Handler(), False)
+        ws.raw_text = raw_text
+        ws.parser.feed(data)
+        start = timer()
+        ws.read_message(False)
+        elapsed = (timer() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def text_messages():
+    """
+    time to receive 4 MB text messages in 16 KB fragments, decoded to str
+    and as raw bytes
+    """
+    words = (("ascii", u"lorem ipsum "),
+             ("mixed", u"na\u00efve caf\u00e9 \u2713 \U0001f600 "))
+    print("%-8s %12s %12s" % ("text", "str ms", "raw_text ms"))
+    for name, word in words:
+        text = word * ((4 << 20) // len(word.encode("utf-8")))
+        data = fragmented_text(text, 16384)
+        print("%-8s %12.2f %12.2f" %
+              (name, receive_text(data, False), receive_text(data, True)))
+
+
+def tracing():
+    """frame decoding without a tracer, with one and after removing it"""
+    print("read_message, 16 byte frames")
+    print("%-24s %8.3f us" % ("no tracer", read_per_frame()))
+    set_tracer(Tracer())
+    print("%-24s %8.3f us" % ("Tracer()", read_per_frame()))
+    set_tracer(SlowestCalls(spans=("decode", )))
+    print("%-24s %8.3f us" % ("SlowestCalls()", read_per_frame()))
+    set_tracer(None)
+    print("%-24s %8.3f us" % ("removed", read_per_frame()))
+
+
+def raise_fd_limit():
+    """returns the number of files this process may open"""
+    if resource is None:
+        return 512
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def proc_status(pid, field):
+    """a number from /proc/<pid>/status (linux)"""
+    with open("/proc/%d/status" % pid) as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+
+def rss(pid):
+    """resident memory of a process in KB"""
+    return proc_status(pid, "VmRSS")
+
+
+class EchoApp(AsyncWSocketApp):
+    async def on_connect(self, client):
+        pass
+
+    async def on_message(self, message, client):
+        await client.send(message, do_compress=False)
+
+    def on_close(self, message):
+        pass
+
+
+def serve_async(ports):
+    raise_fd_limit()
+    server = AsyncWSocketServer(EchoApp(), "127.0.0.1", 0, backlog=4096)
+
+    async def main():
+        await server.start()
+        ports.put(server.port)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+HANDSHAKE = (b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+             b"Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+             b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n")
+
+
+async def open_websocket(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(HANDSHAKE)
+    await reader.readuntil(b"\r\n\r\n")
+    return reader, writer
+
+
+async def hold_connections(port, count, pid):
+    before = rss(pid)
+    connections = []
+    start = timer()
+    for i in range(0, count, 500):
+        connections += await asyncio.gather(
+            *[open_websocket(port) for _ in range(min(500, count - i))])
+
+    elapsed = timer() - start
+    await asyncio.sleep(1)
+    after = rss(pid)
+    # the server must stay responsive while holding every connection
+    rtt = []
+    ping = make_frame(b"ping", mask=b"abcd")
+    for reader, writer in connections[::max(1, count // 100)]:
+        sent = timer()
+        writer.write(ping)
+        await reader.readexactly(6)
+        rtt.append(timer() - sent)
+
+    for reader, writer in connections:
+        writer.close()
+
+    rtt.sort()
+    print("connections        %d" % count)
+    print("handshakes/s       %d" % (count / elapsed))
+    print("server RSS         %d KB -> %d KB" % (before, after))
+    print("memory/connection  %.1f KB" % ((after - before) / count))
+    print("echo rtt p50/max   %.2f / %.2f ms" %
+          (rtt[len(rtt) // 2] * 1000, rtt[-1] * 1000))
+
+
+class SyncEchoApp(WSocketApp):
+    def on_connect(self, client):
+        pass
+
+    def on_message(self, message, client):
+        client.send(message, do_compress=False)
+
+    def on_close(self, message):
+        pass
+
+
+class QuietHandler(FixedHandler):
+    quiet = True
+
+
+def serve_selector(ports):
+    raise_fd_limit()
+    server = make_server("127.0.0.1", 0, SyncEchoApp(), SelectorWSGIServer,
+                         QuietHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+async def echo_all(connections):
+    """every client sends a message at once, all echoes must come back"""
+
+    async def echo(i, reader, writer):
+        payload = ("%8d" % i).encode()
+        writer.write(make_frame(payload, mask=b"abcd"))
+        data = await reader.readexactly(len(payload) + 2)
+        assert data[2:] == payload
+
+    start = timer()
+    await asyncio.gather(*[echo(i, reader, writer)
+                           for i, (reader, writer) in enumerate(connections)])
+    return timer() - start
+
+
+async def drive_parked(port, count, pid):
+    connections = []
+    for i in range(0, count, 200):
+        connections += await asyncio.gather(
+            *[open_websocket(port) for _ in range(min(200, count - i))])
+
+    await asyncio.sleep(1)
+    threads = proc_status(pid, "Threads")
+    elapsed = min([await echo_all(connections) for _ in range(3)])
+    for reader, writer in connections:
+        writer.close()
+
+    print("connections        %d" % count)
+    print("server threads     %d" % threads)
+    print("server RSS         %d KB" % rss(pid))
+    print("echo all clients   %.1f ms (%d messages/s)" %
+          (elapsed * 1000, count / elapsed))
+
+
+def parked_connections():
+    """thousands of loopback clients on one SelectorWSGIServer"""
+    count = min(10000, raise_fd_limit() - 200)
+    ports = Queue()
+    server = Process(target=serve_selector, args=(ports, ))
+    server.start()
+    try:
+        port = ports.get()
+        print("parked websockets on the selector server")
+        asyncio.run(drive_parked(port, count, server.pid))
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+def idle_connections():
+    """asyncio server holding up to 50k idle websockets in one process"""
+    count = min(50000, raise_fd_limit() - 200)
+    ports = Queue()
+    server = Process(target=serve_async, args=(ports, ))
+    server.start()
+    try:
+        port = ports.get()
+        print("idle websockets on the asyncio server")
+        asyncio.run(hold_connections(port, count, server.pid))
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+def serve_file(ports, root, static):
+    app = WSocketApp()
+    if static:
+        app.static("/static", root)
+
+    else:
+
+        @app.route("/static/*")
+        def read_file(environ, start_response):
+            start_response(200, [("Content-Type", "application/octet-stream")])
+            with open(os.path.join(root, environ["PATH_INFO"][8:]), "rb") as f:
+                return f.read()
+
+    server = make_server("127.0.0.1", 0, app, ThreadingWSGIServer,
+                         QuietHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def fetch(port, path, headers={}, count=1):
+    """seconds per GET of `path`, the body is read into one buffer"""
+    buf = bytearray(1 << 20)
+    start = timer()
+    for _ in range(count):
+        client = http.client.HTTPConnection("127.0.0.1", port)
+        client.request("GET", path, headers=headers)
+        response = client.getresponse()
+        while response.readinto(buf):
+            pass
+
+        client.close()
+
+    return (timer() - start) / count, response.status
+
+
+def static_files():
+    """a large file from a route reading it and from `WSocketApp.static`"""
+    print("serving a file, server peak RSS and time per request")
+    print("%10s %24s %24s" % ("size", "route f.read()", "static()"))
+    root = tempfile.mkdtemp()
+    try:
+        for size in (1 << 20, 16 << 20, 128 << 20):
+            with open(os.path.join(root, "file.bin"), "wb") as f:
+                f.write(os.urandom(1 << 20) * (size >> 20))
+
+            row = []
+            for static in (False, True):
+                ports = Queue()
+                server = Process(target=serve_file,
+                                 args=(ports, root, static))
+                server.start()
+                try:
+                    port = ports.get()
+                    base = proc_status(server.pid, "VmHWM")
+                    elapsed = fetch(port, "/static/file.bin", count=5)[0]
+                    peak = proc_status(server.pid, "VmHWM") - base
+                    row.append((peak, elapsed))
+                    if static:
+                        etag = '"%x-%x"' % (os.stat(f.name).st_mtime_ns, size)
+                        not_modified, status = fetch(
+                            port, "/static/file.bin",
+                            {"If-None-Match": etag}, 200)
+                        assert status == 304
+
+                finally:
+                    server.terminate()
+                    server.join()
+
+            print("%8d MB %12.1f MB %6.1f ms %12.1f MB %6.1f ms" %
+                  (size >> 20, row[0][0] / 1024.0, row[0][1] * 1000,
+                   row[1][0] / 1024.0, row[1][1] * 1000))
+
+        print("304 Not Modified   %.2f ms per request" % (not_modified * 1000))
+
+    finally:
+        for name in os.listdir(root):
+            os.remove(os.path.join(root, name))
+
+        os.rmdir(root)
+
+
+def serve_hello(ports):
+    app = WSocketApp()
+
+    @app.route("/")
+    def hello(environ, start_response):
+        start_response(200, [("Content-Type", "text/plain")])
+        return "hello"
+
+    server = make_server("127.0.0.1", 0, app, ThreadingWSGIServer,
+                         QuietHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def hello_requests(port, count, keepalive):
+    """requests per second of GET / on one connection or one per request"""
+    headers = {} if keepalive else {"Connection": "close"}
+    client = http.client.HTTPConnection("127.0.0.1", port)
+    start = timer()
+    for _ in range(count):
+        client.request("GET", "/", headers=headers)
+        response = client.getresponse()
+        assert response.read() == b"hello"
+        if not keepalive:
+            client.close()
+
+    elapsed = timer() - start
+    client.close()
+    return count / elapsed
+
+
+def keepalive():
+    """plain HTTP requests with and without keep-alive"""
+    ports = Queue()
+    server = Process(target=serve_hello, args=(ports, ))
+    server.start()
+    try:
+        port = ports.get()
+        print("GET / from one client, requests/s")
+        print("%-28s %8.0f" % ("new connection per request",
+                               hello_requests(port, 2000, False)))
+        print("%-28s %8.0f" % ("keep-alive (100 per conn.)",
+                               hello_requests(port, 2000, True)))
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+def serve_streams(ports):
+    app = WSocketApp()
+
+    @app.route("/wait")
+    def wait(environ, start_response):
+        # starts the response from another thread, like a long poll
+        Timer(1.0, start_response, (200, )).start()
+        return ["done"]
+
+    @app.route("/items/<flush:int>")
+    def items(environ, start_response):
+        start_response(200, [("Content-Type", "text/plain")])
+        flush = environ["wsgiorg.routing_args"][1]["flush"]
+        for i in range(10000):
+            yield "item %6d\n" % i
+            if flush:
+                yield b""
+
+    server = make_server("127.0.0.1", 0, app, ThreadingWSGIServer,
+                         QuietHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def cpu_seconds(pid):
+    """user and system CPU time of a process (linux)"""
+    with open("/proc/%d/stat" % pid) as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def stream_response():
+    """server CPU while a response waits to start, coalesced items"""
+    ports = Queue()
+    server = Process(target=serve_streams, args=(ports, ))
+    server.start()
+    try:
+        port = ports.get()
+        fetch(port, "/items/0")
+        cpu = cpu_seconds(server.pid)
+        elapsed = fetch(port, "/wait")[0]
+        print("response started after %.1f s, server CPU %.2f s" %
+              (elapsed, cpu_seconds(server.pid) - cpu))
+        print("10000 items of 12 bytes, ms per response")
+        print("%-24s %8.1f" % ("written one by one",
+                               fetch(port, "/items/1", count=20)[0] * 1000))
+        print("%-24s %8.1f" % ("coalesced",
+                               fetch(port, "/items/0", count=20)[0] * 1000))
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+def client_bursts():
+    """bursts of 20 small messages, one send() each or one send_many()"""
+    ports = Queue()
+    server = Process(target=serve_selector, args=(ports, ))
+    server.start()
+    try:
+        client = WebSocketClient("ws://127.0.0.1:%d/" % ports.get(),
+                                 deflate=None)
+        burst = [b"update %2d" % i for i in range(20)]
+        for name in ("send", "send_many"):
+            start = timer()
+            for _ in range(500):
+                if name == "send":
+                    for message in burst:
+                        client.send(message)
+
+                else:
+                    client.send_many(burst)
+
+                for _ in burst:
+                    client.receive()
+
+            elapsed = timer() - start
+            print("%-10s %6.1f us/burst %8d messages/s" %
+                  (name, elapsed / 500 * 1e6, 500 * len(burst) / elapsed))
+
+        client.close()
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+def server_bursts(mode, count=5000):
+    """
+    us per burst of 20 small messages written by a server websocket to a
+    socket pair, and the writes it took
+    """
+    server, client = socket.socketpair()
+    reader = Process(target=drain, args=(client, server))
+    reader.start()
+    client.close()
+    writes = []
+
+    def sendall(data):
+        writes.append(len(data))
+        server.sendall(data)
+
+    ws = WebSocket({}, None, sendall, Handler(), False)
+    burst = ["update %2d" % i for i in range(20)]
+    start = timer()
+    for _ in range(count):
+        if mode == "send":
+            for message in burst:
+                ws.send(message)
+
+        elif mode == "batch":
+            with ws.batch():
+                for message in burst:
+                    ws.send(message)
+
+        else:
+            ws.send_many(burst)
+
+    elapsed = timer() - start
+    server.close()
+    reader.join()
+    return elapsed / count * 1e6, len(writes) / float(count)
+
+
+def send_bursts():
+    """bursts of 20 small messages: send() each, in a batch() or send_many()"""
+    print("%-10s %10s %14s" % ("", "us/burst", "writes/burst"))
+    for mode in ("send", "batch", "send_many"):
+        print("%-10s %10.1f %14.1f" % ((mode, ) + server_bursts(mode)))
+
+
+class HeartbeatApp(SyncEchoApp):
+    heartbeat = Heartbeat(interval=1.0, max_missed=2)
+
+
+class DeepQueueServer(ThreadingWSGIServer):
+    request_queue_size = 4096
+
+
+def serve_heartbeat(ports):
+    raise_fd_limit()
+    server = make_server("127.0.0.1", 0, HeartbeatApp(), DeepQueueServer,
+                         QuietHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def vanished_clients():
+    """threads and memory of clients that vanished, reclaimed by pings"""
+    count = min(1000, raise_fd_limit() - 200)
+    ports = Queue()
+    server = Process(target=serve_heartbeat, args=(ports, ))
+    server.start()
+    try:
+        port = ports.get()
+        before = rss(server.pid)
+        # clients that never read nor answer, like a phone gone offline
+        connections = []
+        for _ in range(count):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(HANDSHAKE)
+            connections.append(sock)
+
+        sleep(1)
+        print("vanished clients   %d, pinged every 1 s, closed after 2 "
+              "missed pings" % count)
+        print("server threads     %d, RSS %d KB -> %d KB" %
+              (proc_status(server.pid, "Threads"), before, rss(server.pid)))
+        start = timer()
+        while proc_status(server.pid, "Threads") > 10:
+            sleep(0.1)
+
+        print("reclaimed after    %.1f s, threads %d, RSS %d KB" %
+              (timer() - start + 1, proc_status(
+                  server.pid, "Threads"), rss(server.pid)))
+        for sock in connections:
+            sock.close()
+
+    finally:
+        server.terminate()
+        server.join()
+
+
+class GatherApp(SyncEchoApp):
+    """keeps its websockets in `clients`"""
+
+    def __init__(self, count):
+        SyncEchoApp.__init__(self)
+        self.clients = []
+        self.ready = ThreadEvent()
+        self.count = count
+
+    def on_connect(self, client):
+        self.clients.append(client)
+        if len(self.clients) == self.count:
+            self.ready.set()
+
+    def on_message(self, message, client):
+        pass
+
+
+def fan_out(send_queue, stalled_clients=1):
+    """
+    2000 messages of 8 KB sent in turn to 10 clients and `stalled_clients`
+    that stopped reading, a round per millisecond. Returns the seconds it
+    took the sender, `None` if it was still blocked after 10 s, and the
+    share of messages the 10 got.
+    """
+    app = GatherApp(10 + stalled_clients)
+    app.send_queue = send_queue
+    server = make_server("127.0.0.1", 0, app, DeepQueueServer, QuietHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = "ws://127.0.0.1:%d/" % server.server_port
+    stalled = []
+    for _ in range(stalled_clients):
+        sock = socket.create_connection(("127.0.0.1", server.server_port))
+        sock.sendall(HANDSHAKE)
+        stalled.append(sock)
+
+    received = []
+
+    def read(client):
+        count = 0
+        # a message dropped for this client may never come, stop waiting
+        while count < 2000 and client.receive() is not None:
+            count += 1
+
+        received.append(count)
+
+    readers = [
+        Thread(target=read,
+               args=(WebSocketClient(url, deflate=None, timeout=2), ),
+               daemon=True) for _ in range(10)
+    ]
+    for thread in readers:
+        thread.start()
+
+    app.ready.wait()
+    payload = b"x" * 8192
+    sent = []
+
+    def broadcast():
+        start = timer()
+        for _ in range(2000):
+            for client in app.clients:
+                try:
+                    client.send(payload)
+
+                except WebSocketError:
+                    pass
+
+            # updates at up to 1000 per second
+            sleep(0.001)
+
+        sent.append(timer() - start)
+
+    sender = Thread(target=broadcast, daemon=True)
+    sender.start()
+    sender.join(10)
+    for thread in readers:
+        thread.join(5)
+
+    for sock in stalled:
+        sock.close()
+
+    server.shutdown()
+    return sent[0] if sent else None, sum(received) / 20000.0
+
+
+def slow_consumer():
+    """
+    fan-out with clients that stopped reading, with and without queues.
+    12 stalled clients are more than the 8 writer threads of the queues.
+    """
+    for name, stalled_clients, send_queue in (
+        ("send on the sender's thread", 1, None),
+        ("drop_oldest queues", 1, SendQueue(max_bytes=1 << 20,
+                                            policy="drop_oldest")),
+        ("close queues", 1, SendQueue(max_bytes=1 << 20, policy="close")),
+        ("drop_oldest queues", 12, SendQueue(max_bytes=1 << 20,
+                                             policy="drop_oldest")),
+    ):
+        elapsed, delivered = fan_out(send_queue, stalled_clients)
+        print("%-20s %2d stalled, sender %s, fast clients got %.1f%%" %
+              (name, stalled_clients,
+               "blocked" if elapsed is None else "%.3f s" % elapsed,
+               delivered * 100))
+
+
+def serve_workers(port, workers):
+    sys.stdout = open(os.devnull, "w")
+    app = WSocketApp()
+
+    @app.route("/")
+    def hello(environ, start_response):
+        start_response(200, [("Content-Type", "text/plain")])
+        return "hello"
+
+    run(app, "127.0.0.1", port, workers=workers, handler_class=QuietHandler)
+
+
+def count_requests(port, seconds, counts):
+    """keep-alive GET / requests made in `seconds`"""
+    client = http.client.HTTPConnection("127.0.0.1", port)
+    count = 0
+    deadline = timer() + seconds
+    while timer() < deadline:
+        client.request("GET", "/")
+        client.getresponse().read()
+        count += 1
+
+    client.close()
+    counts.put(count)
+
+
+def prefork():
+    """requests per second of `run(workers=N)`, N from 1 to the cores"""
+    cores = os.cpu_count() or 1
+    print("%d cores, GET / from %d keep-alive clients, requests/s" %
+          (cores, 2 * cores))
+    workers = 1
+    while True:
+        port = 18600 + workers
+        server = Process(target=serve_workers, args=(port, workers))
+        server.start()
+        sleep(1)
+        try:
+            counts = Queue()
+            clients = [
+                Process(target=count_requests, args=(port, 3, counts))
+                for _ in range(2 * cores)
+            ]
+            for client in clients:
+                client.start()
+
+            total = sum(counts.get() for _ in clients)
+            for client in clients:
+                client.join()
+
+            print("workers=%-3d %8.0f" % (workers, total / 3.0))
+
+        finally:
+            os.kill(server.pid, signal.SIGTERM)
+            server.join()
+
+        if workers >= cores:
+            break
+
+        workers = min(workers * 2, cores)
+
+
+def serve_bus(port, workers):
+    sys.stdout = open(os.devnull, "w")
+    app = WSocketApp()
+    app.broadcast = LocalBroadcast()
+    app.onconnect += lambda client: app.subscribe(client, "bus")
+    app.onmessage += lambda message, client: app.publish(message, "bus")
+    run(app, "127.0.0.1", port, workers=workers, handler_class=QuietHandler)
+
+
+def bus_latency(workers, clients=40, messages=200):
+    """
+    milliseconds from sending a message to one worker until each of
+    `clients`, spread over the workers, got it and until all of them did
+    """
+    port = 18700 + workers
+    server = Process(target=serve_bus, args=(port, workers))
+    server.start()
+    sleep(1)
+    try:
+        url = "ws://127.0.0.1:%d/" % port
+        receivers = [
+            WebSocketClient(url, deflate=None, timeout=5)
+            for _ in range(clients)
+        ]
+        sleep(0.5)  # subscribed
+        arrivals = [[] for _ in receivers]
+
+        def read(client, times):
+            while len(times) < messages:
+                message = client.receive()
+                if message is None:
+                    return
+
+                if message.startswith("t"):
+                    times.append(monotonic() - float(message[1:]))
+
+        readers = [
+            Thread(target=read, args=pair, daemon=True)
+            for pair in zip(receivers, arrivals)
+        ]
+        for thread in readers:
+            thread.start()
+
+        sender = receivers[0]
+        for _ in range(messages):
+            sender.send("t%r" % monotonic())
+            sleep(0.01)
+
+        for thread in readers:
+            thread.join(10)
+
+        for client in receivers:
+            client.close()
+
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+
+    each = sorted(t for times in arrivals for t in times)
+    complete = sorted(
+        max(times[i] for times in arrivals)
+        for i in range(min(len(times) for times in arrivals)))
+
+    def ms(values, share):
+        return 1000 * values[min(len(values) - 1, int(share * len(values)))]
+
+    return (len(each) / float(clients * messages), ms(each, 0.5),
+            ms(each, 0.99), ms(complete, 0.5), ms(complete, 0.99))
+
+
+def broadcast_bus():
+    """
+    end-to-end fan-out latency of `publish()` through `LocalBroadcast`,
+    40 clients spread over the workers
+    """
+    print("%-10s %9s %9s %9s %14s %13s" %
+          ("workers", "delivered", "p50 ms", "p99 ms", "all p50 ms",
+           "all p99 ms"))
+    for workers in (1, 2, 4):
+        delivered, p50, p99, all_p50, all_p99 = bus_latency(workers)
+        print("%-10d %8.1f%% %9.2f %9.2f %14.2f %13.2f" %
+              (workers, 100 * delivered, p50, p99, all_p50, all_p99))
+
+
+class BenchApp(WSocketApp):
+    """echo app of the `load` server"""
+
+    def on_connect(self, client):
+        pass
+
+    def on_message(self, message, client):
+        try:
+            client.send(message)
+
+        except WebSocketError:
+            pass
+
+    def on_close(self, message):
+        pass
+
+
+class AsyncBenchApp(AsyncWSocketApp):
+    async def on_connect(self, client):
+        pass
+
+    async def on_message(self, message, client):
+        await client.send(message)
+
+    def on_close(self, message):
+        pass
+
+
+def serve_bench(kind, ports):
+    """run the `load` server, `kind` is "thread", "selector" or "async" """
+    sys.stdout = open(os.devnull, "w")  # websockets print when closing
+    if kind == "async":
+        server = AsyncWSocketServer(AsyncBenchApp(), "127.0.0.1", 0,
+                                    backlog=4096)
+
+        async def serve():
+            await server.start()
+            ports.put(server.port)
+            await server.serve_forever()
+
+        asyncio.run(serve())
+        return
+
+    class Handler(FixedHandler):
+        quiet = True
+
+    class Server(SelectorWSGIServer if kind == "selector" else WSocketServer):
+        request_queue_size = 4096
+
+    server = make_server("127.0.0.1", 0, BenchApp(), Server, Handler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def bench_handshakes(port, count, concurrency):
+    """handshakes per second, `concurrency` clients at a time"""
+    slots = asyncio.Semaphore(concurrency)
+
+    async def handshake():
+        async with slots:
+            client = await AsyncWebSocketClient.connect(
+                "ws://127.0.0.1:%d/" % port, deflate=None)
+            client.close()
+
+    start = monotonic()
+    await asyncio.gather(*[handshake() for _ in range(count)])
+    elapsed = monotonic() - start
+    return {"count": count, "per_second": round(count / elapsed, 1)}
+
+
+async def bench_echo(clients, size, count):
+    """round trip times of `count` messages per client, one at a time"""
+    payload = (b"wsocket benchmark payload " * (size // 26 + 1))[:size]
+    times = []
+
+    async def echo(client):
+        for _ in range(count):
+            sent = monotonic()
+            await client.send(payload)
+            await client.receive()
+            times.append(monotonic() - sent)
+
+    await asyncio.gather(*[echo(client) for client in clients])
+    times.sort()
+    return dict(("%s_ms" % name, round(percentile(times, fraction) * 1000, 3))
+                for name, fraction in (("p50", 0.5), ("p99", 0.99),
+                                       ("p999", 0.999)))
+
+
+async def bench_throughput(clients, size, count):
+    """echoed messages per second, every client sending `count` at once"""
+    payload = (b"wsocket benchmark payload " * (size // 26 + 1))[:size]
+
+    async def flood(client):
+        await client.send_many([payload] * count)
+        for _ in range(count):
+            await client.receive()
+
+    start = monotonic()
+    await asyncio.gather(*[flood(client) for client in clients])
+    elapsed = monotonic() - start
+    messages = count * len(clients)
+    return {
+        "messages_per_second": round(messages / elapsed, 1),
+        "mb_per_second": round(messages * size / elapsed / 1048576, 2),
+    }
+
+
+def process_rss(pid):
+    """resident memory of a process in KB, `None` if unknown (not linux)"""
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+
+    except (IOError, OSError):
+        return None
+
+
+async def bench_memory(port, pid, count):
+    """server memory per idle websocket"""
+    await asyncio.sleep(0.2)  # let the server settle
+    before = process_rss(pid)
+    clients = []
+    for i in range(0, count, 200):
+        clients += await asyncio.gather(*[
+            AsyncWebSocketClient.connect("ws://127.0.0.1:%d/" % port,
+                                         deflate=None)
+            for _ in range(min(200, count - i))
+        ])
+
+    await asyncio.sleep(0.5)
+    after = process_rss(pid)
+    for client in clients:
+        client.close()
+
+    if before is None or after is None:
+        return {"connections": count, "kb_per_connection": None}
+
+    return {
+        "connections": count,
+        "kb_per_connection": round((after - before) / float(count), 2)
+    }
+
+
+async def drive_bench(port, pid, options):
+    results = {
+        "wsocket": __version__,
+        "python": "%d.%d.%d" % tuple(sys.version_info[:3]),
+        "server": options.server,
+        "clients": options.clients,
+        # first, before the other phases leave freed memory to reuse
+        "memory": await bench_memory(port, pid, options.connections),
+        "handshakes": await bench_handshakes(port, options.handshakes,
+                                             options.clients),
+        "echo": [],
+        "throughput": [],
+    }
+    modes = {"on": (True, ), "off": (False, ), "both": (False, True)}
+    for deflate in modes[options.deflate]:
+        # compress every message, whatever its size
+        clients = await asyncio.gather(*[
+            AsyncWebSocketClient.connect(
+                "ws://127.0.0.1:%d/" % port,
+                deflate=deflate and PerMessageDeflate(min_size=0))
+            for _ in range(options.clients)
+        ])
+        for size in options.sizes:
+            # about a megabyte per client and size
+            count = max(10, min(options.messages, (1 << 20) // max(size, 1)))
+            row = {"size": size, "deflate": deflate, "messages": count}
+            row.update(await bench_echo(clients, size, count))
+            results["echo"].append(row)
+            row = {"size": size, "deflate": deflate, "messages": count}
+            row.update(await bench_throughput(clients, size, count))
+            results["throughput"].append(row)
+
+        for client in clients:
+            client.close()
+
+    return results
+
+
+def load(argv=None):
+    """
+    `python bench.py load`: start an echo server on loopback, drive it
+    with concurrent clients and print the results as JSON.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python bench.py load",
+        description="benchmark a loopback wsocket server")
+    parser.add_argument("--server", default="thread",
+                        choices=("thread", "selector", "async"))
+    parser.add_argument("--clients", type=int, default=50,
+                        help="concurrent clients (50)")
+    parser.add_argument("--messages", type=int, default=200,
+                        help="messages per client and payload size (200)")
+    parser.add_argument("--sizes", default="16,1024,65536",
+                        type=lambda sizes: [int(size) for size in
+                                            sizes.split(",")],
+                        help="payload sizes (16,1024,65536)")
+    parser.add_argument("--deflate", default="both",
+                        choices=("on", "off", "both"),
+                        help="permessage-deflate (both)")
+    parser.add_argument("--handshakes", type=int, default=1000,
+                        help="handshakes to time (1000)")
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="idle connections to measure memory (1000)")
+    parser.add_argument("--output", help="write the JSON to this file")
+    options = parser.parse_args(argv)
+
+    ports = Queue()
+    server = Process(target=serve_bench, args=(options.server, ports))
+    server.daemon = True
+    server.start()
+    # keep the JSON clean of what closing websockets print
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        results = asyncio.run(drive_bench(ports.get(), server.pid, options))
+
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        server.terminate()
+        server.join()
+
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(text + "\n")
+
+    else:
+        print(text)
+
+    return results
+
+
+BENCHMARKS = {
+    "broadcast": broadcast,
+    "broadcast_bus": broadcast_bus,
+    "client_bursts": client_bursts,
+    "compression_policy": compression_policy,
+    "deflate_memory": deflate_memory,
+    "dispatch": dispatch,
+    "idle_connections": idle_connections,
+    "keepalive": keepalive,
+    "mask": mask,
+    "metrics": metrics_overhead,
+    "parked_connections": parked_connections,
+    "prefork": prefork,
+    "read_frames": read_frames,
+    "receive_stream": receive_stream,
+    "routes": routes,
+    "text_messages": text_messages,
+    "send_bursts": send_bursts,
+    "send_frames": send_frames,
+    "send_stream": send_stream,
+    "slow_consumer": slow_consumer,
+    "static_files": static_files,
+    "tracing": tracing,
+    "vanished_clients": vanished_clients,
+    "stream_response": stream_response,
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["load"]:
+        load(sys.argv[2:])
+        sys.exit()
+
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+        print()
@@ -55,6 +55,8 @@ setup(
     keywords='sample, setuptools, development',  # Optional
 
     py_modules=['wsocket'],
+    # asyncio.run() and the asyncio server
+    python_requires='>=3.7',
     scripts=['wsocket.py'],
     license='MIT',
     platforms='any',
@@ -70,30 +72,16 @@ setup(
                'Topic :: Internet :: WWW/HTTP :: WSGI :: Server',
                'Topic :: Software Development :: Libraries :: Application Frameworks',
                'Programming Language :: Python',
-               'Programming Language :: Python :: 2',
-               'Programming Language :: Python :: 2.3',
-               'Programming Language :: Python :: 2.4',
-               'Programming Language :: Python :: 2.5',
-               'Programming Language :: Python :: 2.6',
-               'Programming Language :: Python :: 2.7',
                'Programming Language :: Python :: 3',
-               'Programming Language :: Python :: 3.0',
-               'Programming Language :: Python :: 3.1',
-               'Programming Language :: Python :: 3.2',
-               'Programming Language :: Python :: 3.3',
-               'Programming Language :: Python :: 3.4',
-               'Programming Language :: Python :: 3.5',
-               'Programming Language :: Python :: 3.6',
+               'Programming Language :: Python :: 3 :: Only',
                'Programming Language :: Python :: 3.7',
                'Programming Language :: Python :: 3.8',
                'Programming Language :: Python :: 3.9',
                'Programming Language :: Python :: 3.10',
+               'Programming Language :: Python :: 3.11',
                'Programming Language :: Python :: Implementation',
                'Programming Language :: Python :: Implementation :: CPython',
-               'Programming Language :: Python :: Implementation :: IronPython',
-               'Programming Language :: Python :: Implementation :: Jython',
                'Programming Language :: Python :: Implementation :: PyPy',
-               'Programming Language :: Python :: Implementation :: Stackless',
                'Framework :: WSocket',
                'Topic :: Communications :: Chat',
                'Topic :: Internet',
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from wsocket import AsyncWSocketApp, AsyncWSocketServer
+
+
+def make_app():
+    app = AsyncWSocketApp()
+
+    @app.route("/echo")
+    def echo(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["wsgi.input"].read()]
+
+    return app
+
+
+def request(data, truncated=False):
+    """send `data` to a new server, the response it gets"""
+
+    async def main():
+        server = AsyncWSocketServer(make_app(), "127.0.0.1", 0)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection(
+                "127.0.0.1", server.port)
+            writer.write(data)
+            if truncated:
+                writer.write_eof()
+
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return response
+
+        finally:
+            server.server.close()
+            await server.server.wait_closed()
+
+    return asyncio.run(main())
+
+
+def status(response):
+    return response.split(b"\r\n", 1)[0]
+
+
+def body(response):
+    return response.partition(b"\r\n\r\n")[2]
+
+
+def test_content_length():
+    response = request(b"POST /echo HTTP/1.1\r\n"
+                       b"Content-Length: 5\r\n\r\nhello")
+    assert status(response) == b"HTTP/1.1 200 OK"
+    assert body(response) == b"hello"
+
+
+def test_chunked_body():
+    response = request(b"POST /echo HTTP/1.1\r\n"
+                       b"Transfer-Encoding: chunked\r\n\r\n"
+                       b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\n"
+                       b"Trailer: x\r\n\r\n")
+    assert status(response) == b"HTTP/1.1 200 OK"
+    assert body(response) == b"hello world"
+
+
+@pytest.mark.parametrize("head", [
+    b"Content-Length: abc",
+    b"Content-Length: -5",
+    b"Content-Length: 5, 6",
+])
+def test_bad_content_length(head):
+    response = request(b"POST /echo HTTP/1.1\r\n" + head + b"\r\n\r\n")
+    assert status(response) == b"HTTP/1.1 400 Bad Request"
+
+
+def test_bad_chunk_size():
+    response = request(b"POST /echo HTTP/1.1\r\n"
+                       b"Transfer-Encoding: chunked\r\n\r\nzz\r\nhello\r\n"
+                       b"0\r\n\r\n")
+    assert status(response) == b"HTTP/1.1 400 Bad Request"
+
+
+def test_unsupported_transfer_encoding():
+    response = request(b"POST /echo HTTP/1.1\r\n"
+                       b"Transfer-Encoding: gzip\r\n\r\n")
+    assert status(response) == b"HTTP/1.1 501 Not Implemented"
+
+
+@pytest.mark.parametrize("data", [
+    b"POST /echo HTTP/1.1\r\nContent-Length: 50\r\n\r\nhello",
+    b"POST /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhel",
+])
+def test_truncated_body_closes_quietly(data, caplog):
+    assert request(data, truncated=True) == b""
+    # no "Task exception was never retrieved"
+    assert not [r for r in caplog.records if r.name == "asyncio"]
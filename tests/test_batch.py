@@ -0,0 +1,139 @@
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from wsocket import OPCODE_CLOSE, OPCODE_PING, FrameParser, WebSocket
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+def frames(data):
+    """(opcode, payload) of the frames in `data`"""
+    parser = FrameParser()
+    parser.feed(data)
+    found = []
+    while True:
+        frame = parser.next_frame()
+        if frame is None:
+            return found
+
+        found.append((frame[1], bytes(frame[-1])))
+
+
+@pytest.fixture
+def writes():
+    """a websocket recording its writes, and the writes"""
+    written = []
+    wsock = WebSocket({}, None, written.append, Handler(), False)
+    yield wsock, written
+    wsock.closed = True  # no close frame
+
+
+def test_batch_is_one_write(writes):
+    wsock, written = writes
+    with wsock.batch():
+        wsock.send("one")
+        wsock.send_frame(b"ping", OPCODE_PING)
+        wsock.send(b"two")
+        assert written == []
+
+    assert len(written) == 1
+    assert frames(written[0]) == [(1, b"one"), (OPCODE_PING, b"ping"),
+                                  (2, b"two")]
+
+
+def test_nested_batch_written_by_the_outer_one(writes):
+    wsock, written = writes
+    with wsock.batch():
+        wsock.send("one")
+        with wsock.batch():
+            wsock.send("two")
+
+        assert written == []
+
+    assert [op for op, payload in frames(written[0])] == [1, 1]
+
+
+def test_send_many(writes):
+    wsock, written = writes
+    wsock.send_many(["a", "b", b"c"])
+    assert len(written) == 1
+    assert frames(written[0]) == [(1, b"a"), (1, b"b"), (2, b"c")]
+
+
+def test_send_many_in_a_batch(writes):
+    wsock, written = writes
+    with wsock.batch():
+        wsock.send("first")
+        wsock.send_many(["a", "b"])
+        wsock.send_frame(b"p", OPCODE_PING)
+
+    assert frames(written[0]) == [(1, b"first"), (1, b"a"), (1, b"b"),
+                                  (OPCODE_PING, b"p")]
+
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    yield wsock, client
+    wsock.closed = True
+    server.close()
+    client.close()
+
+
+def test_control_frames_wait_for_the_batch(pair):
+    wsock, client = pair
+    with wsock.batch():
+        wsock.send("data")
+        assert wsock.write_nowait(OPCODE_PING, b"") is None
+
+    client.settimeout(5)
+    assert frames(client.recv(100)) == [(1, b"data")]
+
+
+def test_abort_drops_the_batch(pair):
+    wsock, client = pair
+    with wsock.batch():
+        wsock.send("data")
+        wsock.abort(1001, "bye")
+
+    client.settimeout(5)
+    data = b""
+    while True:
+        chunk = client.recv(100)
+        if not chunk:
+            break
+
+        data += chunk
+
+    # the close frame is the last one
+    assert frames(data) == [(OPCODE_CLOSE, b"\x03\xe9bye")]
+
+
+def test_abort_leaves_a_locked_batch_alone(pair):
+    wsock, client = pair
+    batch = wsock.batch()
+    batch.__enter__()
+    wsock.send("one")
+    wsock.send_lock.acquire()  # another sender is adding to the batch
+
+    def add():
+        time.sleep(0.1)
+        wsock.batched += b"\x81\x03two"
+        wsock.send_lock.release()
+
+    sender = Thread(target=add)
+    sender.start()
+    start = time.monotonic()
+    wsock.abort()
+    assert time.monotonic() - start < 0.1  # did not wait for the lock
+    sender.join()
+    assert frames(bytes(wsock.batched)) == [(1, b"one"), (1, b"two")]
+    wsock.batched = None
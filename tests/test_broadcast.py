@@ -0,0 +1,157 @@
+import os
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from wsocket import LocalBroadcast
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"),
+                                reason="needs Unix domain sockets")
+
+
+def listen(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    return server
+
+
+def test_default_path_is_private():
+    first, second = LocalBroadcast(), LocalBroadcast()
+    try:
+        assert first.path != second.path
+        st = os.stat(first.path)
+        assert st.st_uid == os.getuid()
+        assert st.st_mode & 0o777 == 0o700
+
+    finally:
+        os.rmdir(first.path)
+        os.rmdir(second.path)
+
+
+def test_given_path(tmp_path):
+    path = str(tmp_path / "bus")
+    assert LocalBroadcast(path).path == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.chmod(path, 0o755)
+    with pytest.raises(PermissionError):
+        LocalBroadcast(path)
+
+    os.chmod(path, 0o700)
+    os.symlink(path, path + "-link")
+    with pytest.raises(PermissionError):
+        LocalBroadcast(path + "-link")
+
+
+def test_stalled_process_does_not_delay_the_others(tmp_path):
+    bus = LocalBroadcast(str(tmp_path / "bus"))
+    bus.max_backlog = 1 << 16
+    stalled = listen(os.path.join(bus.path, "1.sock"))  # never reads
+    reader = listen(os.path.join(bus.path, "2.sock"))
+    received = []
+
+    def read():
+        conn = reader.accept()[0]
+        buf = bytearray()
+        while True:
+            data = conn.recv(1 << 16)
+            if not data:
+                return
+
+            buf += data
+            received.extend(bus.decode(buf))
+
+    thread = Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    bus.start(lambda messages: None)
+    try:
+        message = "x" * 1000
+        start = time.monotonic()
+        for _ in range(200):
+            for _ in range(10):
+                bus.publish(message)
+
+            time.sleep(0.002)
+
+        while len(received) < 2000 and time.monotonic() - start < 10:
+            time.sleep(0.01)
+
+        assert len(received) == 2000
+        assert time.monotonic() - start < 5
+        assert bus.dropped > 0  # the ones the stalled process missed
+
+    finally:
+        bus.close()
+        stalled.close()
+        reader.close()
+
+
+def test_pending_is_capped(tmp_path):
+    bus = LocalBroadcast(str(tmp_path / "bus"), tick=0.5)
+    bus.max_pending = 10
+    bus.start(lambda messages: None)
+    try:
+        for i in range(25):
+            bus.publish(str(i))
+
+        assert len(bus.pending) == 10
+        assert bus.dropped == 15
+
+    finally:
+        bus.close()
+
+
+def test_publish_before_start(tmp_path):
+    bus = LocalBroadcast(str(tmp_path / "bus"))
+    reader = listen(os.path.join(bus.path, "1.sock"))
+    bus.publish("early")
+    assert bus.sent == 1
+    bus.start(lambda messages: None)
+    try:
+        reader.settimeout(5)
+        conn = reader.accept()[0]
+        conn.settimeout(5)
+        buf = bytearray()
+        messages = []
+        while not messages:
+            buf += conn.recv(1 << 16)
+            messages = bus.decode(buf)
+
+        assert messages == [("early", "", False)]
+        conn.close()
+
+    finally:
+        bus.close()
+        reader.close()
+
+
+def test_invalid_records_are_skipped(tmp_path):
+    bus = LocalBroadcast(str(tmp_path / "bus"))
+    delivered = []
+    bus.start(delivered.extend)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(bus.address)
+        bad_text = bus.record.pack(False, 0, 2) + b"\xc3\x28"
+        bad_channel = bus.record.pack(True, 1, 1) + b"\xffx"
+        sock.sendall(b"".join([bus.encode("one"), bad_text,
+                               bus.encode(b"two"), bad_channel]))
+        start = time.monotonic()
+        while len(delivered) < 2 and time.monotonic() - start < 5:
+            time.sleep(0.01)
+
+        assert delivered == [("one", "", False), (b"two", "", True)]
+        assert bus.dropped == 2
+        # still receiving
+        sock.sendall(bus.encode("three", "room"))
+        while len(delivered) < 3 and time.monotonic() - start < 5:
+            time.sleep(0.01)
+
+        assert delivered[2:] == [("three", "room", False)]
+
+    finally:
+        sock.close()
+        bus.close()
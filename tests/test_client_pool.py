@@ -0,0 +1,117 @@
+import asyncio
+import time
+from threading import Thread
+
+import pytest
+
+from wsocket import AsyncClientPool, ClientPool
+
+opened = []
+
+
+class Client(object):
+    """opens in 0.5 s for urls with "slow" in them"""
+    closed = False
+
+    def __init__(self, url):
+        if "slow" in url:
+            time.sleep(0.5)
+
+        if "down" in url:
+            raise ConnectionRefusedError(url)
+
+        self.url = url
+        opened.append(self)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncClient(Client):
+    def __init__(self, url):
+        self.url = url
+
+    @classmethod
+    async def connect(cls, url):
+        if "slow" in url:
+            await asyncio.sleep(0.5)
+
+        if "down" in url:
+            raise ConnectionRefusedError(url)
+
+        client = cls(url)
+        opened.append(client)
+        return client
+
+
+class Pool(ClientPool):
+    client_class = Client
+
+
+class AsyncPool(AsyncClientPool):
+    client_class = AsyncClient
+
+
+def test_opening_does_not_hold_other_urls():
+    pool = Pool()
+    took = {}
+
+    def get(url):
+        start = time.monotonic()
+        pool.get(url)
+        took[url] = time.monotonic() - start
+
+    slow = Thread(target=get, args=("ws://slow/", ))
+    slow.start()
+    time.sleep(0.05)
+    get("ws://fast/")
+    slow.join()
+    assert took["ws://fast/"] < 0.2
+    assert took["ws://slow/"] >= 0.5
+
+
+def test_size_is_kept():
+    del opened[:]
+    pool = Pool(size=2)
+    threads = [
+        Thread(target=pool.get, args=("ws://slow/", )) for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(opened) == 2
+    assert len(pool.clients["ws://slow/"]) == 2
+    assert pool.connecting["ws://slow/"] == 0
+
+
+def test_failed_open_frees_its_place():
+    pool = Pool()
+    with pytest.raises(ConnectionRefusedError):
+        pool.get("ws://down/")
+
+    assert pool.connecting["ws://down/"] == 0
+    assert pool.clients["ws://down/"] == []
+
+
+def test_async_opening_does_not_hold_other_urls():
+    del opened[:]
+
+    async def main():
+        pool = AsyncPool(size=2)
+        start = time.monotonic()
+        slow = [
+            asyncio.ensure_future(pool.get("ws://slow/")) for _ in range(4)
+        ]
+        await asyncio.sleep(0.05)
+        await pool.get("ws://fast/")
+        fast = time.monotonic() - start
+        clients = await asyncio.gather(*slow)
+        return pool, fast, clients
+
+    pool, fast, clients = asyncio.run(main())
+    assert fast < 0.2
+    assert len(set(clients)) == 2
+    assert len(opened) == 3
@@ -0,0 +1,255 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from wsocket import (FixedHandler, FrameParser, PerMessageDeflate,
+                     SelectorWSGIServer, WebSocket, WebSocketClient,
+                     WSocketApp, make_server, parse_extensions)
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+class QuietHandler(FixedHandler):
+    def log_message(self, *args):
+        pass
+
+
+class EchoApp(WSocketApp):
+    def on_connect(self, client):
+        pass
+
+    def on_message(self, message, client):
+        client.send(message)
+
+
+def accept(deflate, header):
+    (name, params), = parse_extensions(header)
+    assert name == "permessage-deflate"
+    return deflate.accept(params)
+
+
+def test_parse_extensions():
+    extensions = parse_extensions(
+        'permessage-deflate; client_max_window_bits; '
+        'server_max_window_bits="10", x-other')
+    assert extensions == [
+        ("permessage-deflate", [("client_max_window_bits", True),
+                                ("server_max_window_bits", "10")]),
+        ("x-other", []),
+    ]
+    assert parse_extensions("") == []
+
+
+def test_accept_defaults():
+    deflate = accept(PerMessageDeflate(), "permessage-deflate")
+    assert deflate.response() == "permessage-deflate"
+    assert deflate.server_window_bits == deflate.client_window_bits == 15
+
+
+def test_accept_takes_the_smaller_window():
+    policy = PerMessageDeflate(server_window_bits=12, client_window_bits=10)
+    deflate = accept(
+        policy, "permessage-deflate; server_max_window_bits=14; "
+        "client_max_window_bits")
+    assert deflate.server_window_bits == 12
+    assert deflate.client_window_bits == 10
+    assert deflate.response() == ("permessage-deflate; "
+                                  "server_max_window_bits=12; "
+                                  "client_max_window_bits=10")
+    # the policy is a template, not changed by a connection
+    assert policy.client_window_bits == 10
+
+
+def test_client_window_only_limited_when_offered():
+    # a client not offering client_max_window_bits can not be limited
+    deflate = accept(PerMessageDeflate(client_window_bits=10),
+                     "permessage-deflate")
+    assert deflate.client_window_bits == 15
+
+
+def test_accept_no_context_takeover():
+    deflate = accept(
+        PerMessageDeflate(client_no_context_takeover=True),
+        "permessage-deflate; server_no_context_takeover")
+    assert deflate.server_no_context_takeover
+    assert deflate.client_no_context_takeover
+    assert deflate.response() == ("permessage-deflate; "
+                                  "server_no_context_takeover; "
+                                  "client_no_context_takeover")
+
+
+@pytest.mark.parametrize("header", [
+    "permessage-deflate; server_max_window_bits=8",
+    "permessage-deflate; server_max_window_bits=16",
+    "permessage-deflate; server_max_window_bits",
+    "permessage-deflate; client_max_window_bits=x",
+    "permessage-deflate; server_no_context_takeover=1",
+    "permessage-deflate; server_no_context_takeover; "
+    "server_no_context_takeover",
+    "permessage-deflate; unknown",
+])
+def test_refused_offers(header):
+    assert accept(PerMessageDeflate(), header) is None
+
+
+def test_window_bits_checked():
+    with pytest.raises(ValueError):
+        PerMessageDeflate(server_window_bits=8)
+
+    with pytest.raises(ValueError):
+        PerMessageDeflate(client_window_bits=16)
+
+
+def test_confirm_swaps_roles():
+    (name, params), = parse_extensions(
+        "permessage-deflate; server_max_window_bits=10; "
+        "client_no_context_takeover")
+    deflate = PerMessageDeflate().confirm(params)
+    # the server's window is the one of the messages a client receives
+    assert deflate.client_window_bits == 10
+    assert deflate.server_window_bits == 15
+    assert deflate.server_no_context_takeover
+    assert not deflate.client_no_context_takeover
+    (name, params), = parse_extensions(
+        "permessage-deflate; client_max_window_bits=10")
+    assert PerMessageDeflate().confirm(params) is None
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"server_window_bits": 9, "client_window_bits": 8},
+    {"server_no_context_takeover": True, "client_no_context_takeover": True},
+])
+def test_compressed_echo(options):
+    app = EchoApp()
+    app.deflate = PerMessageDeflate(**options)
+    server = make_server("127.0.0.1", 0, app, SelectorWSGIServer,
+                         QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        client = WebSocketClient("ws://127.0.0.1:%d/" % server.server_port)
+        assert client.deflate is not None
+        messages = ["%d hello " % i * 200 for i in range(5)]
+        for message in messages:
+            client.send(message)
+            assert client.receive() == message
+
+        # compressed both ways
+        size = sum(len(message) for message in messages)
+        assert client.deflate.raw_out == size
+        assert client.deflate.compressed_out < size / 4
+        assert client.deflate.raw_in == size
+        assert client.deflate.compressed_in < size / 4
+        client.close()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_not_offered_without_deflate():
+    server = make_server("127.0.0.1", 0, EchoApp(), SelectorWSGIServer,
+                         QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        client = WebSocketClient("ws://127.0.0.1:%d/" % server.server_port,
+                                 deflate=None)
+        assert client.deflate is None
+        client.send("hello" * 100)
+        assert client.receive() == "hello" * 100
+        client.close()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    client.settimeout(5)
+    deflate = accept(PerMessageDeflate(min_size=100, sample_size=4096),
+                     "permessage-deflate")
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), deflate)
+    yield wsock, client
+    wsock.closed = True
+    server.close()
+    client.close()
+
+
+def sent_frame(client):
+    """`(compressed, payload size)` of the next frame `client` receives"""
+    parser = FrameParser()
+    frame = None
+    while frame is None:
+        parser.feed(client.recv(65536))
+        frame = parser.next_frame()
+
+    return bool(frame[2] & 0x40), len(frame[4])
+
+
+def test_level_for():
+    deflate = PerMessageDeflate(level=6, min_size=10,
+                                levels=[(10000, 1), (1000, 3)])
+    assert deflate.level_for(9) is None
+    assert deflate.level_for(10) == 6
+    assert deflate.level_for(999) == 6
+    assert deflate.level_for(1000) == 3
+    assert deflate.level_for(10000) == 1
+    deflate.enabled = False
+    assert deflate.level_for(10000) is None
+
+
+def test_unknown_policy_argument():
+    with pytest.raises(TypeError):
+        PerMessageDeflate(min_sise=10)
+
+
+def test_small_messages_sent_plain(pair):
+    wsock, client = pair
+    wsock.send("a" * 99)
+    assert sent_frame(client) == (False, 99)
+    wsock.send("a" * 100)
+    compressed, size = sent_frame(client)
+    assert compressed and size < 100
+    assert wsock.deflate.plain_out == 99
+    assert wsock.deflate.raw_out == 100
+
+
+def test_compression_turned_off_per_message(pair):
+    wsock, client = pair
+    wsock.send("a" * 1000, do_compress=False)
+    assert sent_frame(client) == (False, 1000)
+
+
+def test_stops_compressing_what_does_not_shrink(pair):
+    wsock, client = pair
+    for _ in range(3):
+        wsock.send(os.urandom(2000), True)
+        assert sent_frame(client)[0]
+
+    # 6000 bytes sampled, larger once compressed
+    assert not wsock.deflate.enabled
+    assert wsock.compressor is None
+    wsock.send("a" * 1000)
+    assert sent_frame(client) == (False, 1000)
+
+
+def test_keeps_compressing_what_shrinks(pair):
+    wsock, client = pair
+    for _ in range(10):
+        wsock.send("hello " * 1000)
+        assert sent_frame(client)[0]
+
+    assert wsock.deflate.enabled
+    assert wsock.deflate.compressed_out < wsock.deflate.raw_out / 10
@@ -0,0 +1,101 @@
+import random
+import socket
+import time
+from threading import Lock, Thread
+
+from wsocket import Dispatcher, WebSocket
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+def test_calls_of_a_key_run_in_order():
+    dispatcher = Dispatcher(workers=8)
+    lock = Lock()
+    running = set()
+    overlaps = []
+    calls = {}
+
+    def handle(key, number):
+        with lock:
+            if key in running:
+                overlaps.append(key)
+
+            running.add(key)
+
+        time.sleep(random.random() * 0.001)
+        with lock:
+            running.discard(key)
+            calls.setdefault(key, []).append(number)
+
+    def submit(sender):
+        for number in range(100):
+            for key in range(4):
+                dispatcher.submit((sender, key), handle, (sender, key),
+                                  number)
+
+    senders = [Thread(target=submit, args=(i, )) for i in range(6)]
+    for sender in senders:
+        sender.start()
+
+    for sender in senders:
+        sender.join()
+
+    deadline = time.monotonic() + 10
+    while dispatcher.stats()["handled"] < 2400:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert not overlaps
+    assert len(calls) == 24
+    for numbers in calls.values():
+        assert numbers == list(range(100))
+
+
+def test_one_key_uses_one_thread():
+    dispatcher = Dispatcher(workers=8)
+    done = []
+    for number in range(50):
+        dispatcher.submit("key", lambda n: (time.sleep(0.001), done.append(n)),
+                          number)
+
+    assert dispatcher.stats()["threads"] == 1
+    while len(done) < 50:
+        time.sleep(0.01)
+
+    assert done == list(range(50))
+
+
+def test_idle_threads_exit():
+    dispatcher = Dispatcher(workers=4)
+    dispatcher.idle_timeout = 0.1
+    for key in range(4):
+        dispatcher.submit(key, time.sleep, 0.05)
+
+    assert dispatcher.stats()["threads"] == 4
+    time.sleep(0.5)
+    assert dispatcher.stats()["threads"] == 0
+    done = []
+    dispatcher.submit(None, done.append, 1)  # starts a thread again
+    time.sleep(0.1)
+    assert done == [1]
+
+
+def test_close_when_full_does_not_block():
+    dispatcher = Dispatcher(workers=1, max_queue=1, when_full="close")
+    server, client = socket.socketpair()
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    wsock.lock_writes()  # a sender holds the websocket
+    dispatcher.submit(None, time.sleep, 0.2)
+    start = time.monotonic()
+    assert dispatcher.submit(wsock, len, "") is False
+    assert time.monotonic() - start < 0.1
+    assert dispatcher.stats()["dropped"] == 1
+    client.settimeout(5)
+    assert client.recv(100) == b""  # shut down, the reader closes it
+    wsock.unlock_writes()
+    server.close()
+    client.close()
@@ -0,0 +1,172 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from wsocket import FrameParser, Heartbeat, WebSocket, mask_bytes
+
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+opened = []
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+class Client(object):
+    """
+    The client end of a websocket, answers pings if `answer` and sends a
+    message with each pong if `chat`
+    """
+
+    def __init__(self, sock, answer=True, chat=False):
+        self.sock = sock
+        self.answer = answer
+        self.chat = chat
+        self.pings = 0
+        self.close_code = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, opcode, payload):
+        mask = b"\x0f\xf0\x3c\xc3"
+        header = WebSocket.encode_header(True, opcode, mask, len(payload), 0)
+        self.sock.sendall(bytes(header) + bytes(mask_bytes(mask, payload)))
+
+    def run(self):
+        parser = FrameParser()
+        while True:
+            frame = parser.next_frame()
+            if frame is None:
+                try:
+                    data = self.sock.recv(4096)
+
+                except socket.error:
+                    return
+
+                if not data:
+                    return
+
+                parser.feed(data)
+                continue
+
+            opcode, payload = frame[1], bytes(frame[4])
+            if opcode == OPCODE_CLOSE:
+                self.close_code = struct.unpack("!H", payload[:2])[0]
+                return
+
+            if opcode == OPCODE_PING:
+                self.pings += 1
+                if self.answer:
+                    self.send(OPCODE_PONG, payload)
+
+                if self.chat:
+                    self.send(OPCODE_TEXT, b"still here")
+
+
+@pytest.fixture
+def heartbeat():
+    heartbeat = Heartbeat(interval=0.1, max_missed=2)
+    yield heartbeat
+    heartbeat.close()
+    for wsock, sock, client in opened:
+        wsock.closed = True
+        sock.close()
+        client.sock.close()
+
+    del opened[:]
+
+
+def connect(heartbeat, **options):
+    server, client = socket.socketpair()
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    reader = threading.Thread(target=receive_all, args=(wsock, ))
+    reader.daemon = True
+    reader.start()
+    heartbeat.add(wsock)
+    client = Client(client, **options)
+    opened.append((wsock, server, client))
+    return wsock, client
+
+
+def receive_all(wsock):
+    try:
+        while wsock.receive() is not None:
+            pass
+
+    except Exception:
+        pass
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+
+        time.sleep(0.01)
+
+    return True
+
+
+def test_answered_pings_keep_it_open(heartbeat):
+    wsock, client = connect(heartbeat)
+    assert wait_for(lambda: client.pings >= 5)
+    assert not wsock.closed
+    assert wsock.rtt is not None and wsock.rtt < 1
+    assert wsock.pongs >= 4
+
+
+def test_closed_after_missed_pings(heartbeat):
+    wsock, client = connect(heartbeat, answer=False)
+    start = time.monotonic()
+    assert wait_for(lambda: wsock.closed)
+    # pinged at 0.1 and 0.2 s, found missed at 0.3 s
+    assert time.monotonic() - start >= 0.25
+    client.thread.join(5)
+    assert client.pings == 2
+    assert client.close_code == 1011
+    assert wsock not in heartbeat.websockets
+
+
+def test_idle_timeout(heartbeat):
+    heartbeat.idle_timeout = 0.5
+    wsock, client = connect(heartbeat)
+    assert wait_for(lambda: wsock.closed)
+    client.thread.join(5)
+    assert client.close_code == 1011
+    # pongs alone do not count as activity
+    assert client.pings >= 3
+
+
+def test_messages_are_activity(heartbeat):
+    heartbeat.idle_timeout = 0.5
+    wsock, client = connect(heartbeat, chat=True)
+    assert wait_for(lambda: client.pings >= 10)
+    assert not wsock.closed
+
+
+def test_many_websockets_one_thread(heartbeat):
+    before = threading.active_count()
+    pairs = [connect(heartbeat, answer=i % 2 == 0) for i in range(10)]
+    # a thread for the heartbeat, plus the readers and clients of the test
+    assert threading.active_count() <= before + 20 + 1 + heartbeat.workers
+    assert wait_for(lambda: all(wsock.closed for wsock, client in pairs[1::2]))
+    assert not any(wsock.closed for wsock, client in pairs[::2])
+
+
+def test_discard(heartbeat):
+    wsock, client = connect(heartbeat, answer=False)
+    heartbeat.discard(wsock)
+    time.sleep(0.4)
+    assert not wsock.closed
+    assert client.pings <= 1
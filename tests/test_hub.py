@@ -0,0 +1,80 @@
+import socket
+import time
+from threading import Thread
+
+from wsocket import FrameParser, Hub, WebSocket
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+def subscriber(sndbuf=None):
+    """a websocket on one end of a socket pair and the other end"""
+    server, client = socket.socketpair()
+    if sndbuf:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sndbuf)
+
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    return wsock, client
+
+
+def read_messages(sock, count, received):
+    parser = FrameParser()
+    while len(received) < count:
+        data = sock.recv(1 << 16)
+        if not data:
+            return
+
+        parser.feed(data)
+        while parser.next_frame() is not None:
+            received.append(1)
+
+
+def test_stalled_subscribers_do_not_hold_the_pool():
+    hub = Hub(workers=2)
+    message = b"x" * (256 << 10)  # more than a socket buffer
+    stalled = []
+    for _ in range(6):  # more than the pool threads
+        wsock, client = subscriber(8192)
+        hub.subscribe(wsock)
+        stalled.append(client)  # never read
+
+    readers = []
+    for _ in range(3):
+        wsock, client = subscriber()
+        hub.subscribe(wsock)
+        received = []
+        thread = Thread(target=read_messages, args=(client, 20, received))
+        thread.daemon = True
+        thread.start()
+        readers.append((thread, received))
+
+    try:
+        for _ in range(20):
+            hub.publish(message)
+            time.sleep(0.01)
+
+        for thread, received in readers:
+            thread.join(10)
+            assert len(received) == 20
+
+    finally:
+        for client in stalled:
+            client.close()  # frees writers blocked on them
+
+        hub.close()
+
+
+def test_skips_a_slow_consumer():
+    hub = Hub(max_pending=4)
+    wsock, client = subscriber(8192)
+    hub.subscribe(wsock)
+    for _ in range(20):
+        hub.publish(b"x" * (64 << 10))
+
+    assert hub.skipped > 0
+    hub.close()
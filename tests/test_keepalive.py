@@ -0,0 +1,144 @@
+import socket
+import threading
+import time
+from http.client import HTTPConnection
+
+import pytest
+
+from wsocket import FixedHandler, ThreadingWSGIServer, make_server
+
+
+class QuietHandler(FixedHandler):
+    keepalive_timeout = 1.0
+    max_requests = 3
+
+    def log_message(self, *args):
+        pass
+
+
+def app(environ, start_response):
+    """`/port` answers the client's port, `/stream` without a length"""
+    path = environ["PATH_INFO"]
+    if path == "/read":
+        # reads a part of the body only
+        body = environ["wsgi.input"].read(3)
+
+    else:
+        port = environ["wsocket.socket"].getpeername()[1]
+        body = str(port).encode("latin-1")
+
+    if path == "/stream":
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"a", b"bc", body]
+
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+@pytest.fixture
+def server():
+    server = make_server("127.0.0.1", 0, app, ThreadingWSGIServer,
+                         QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server):
+    return HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+
+
+def get(conn, path, method="GET", body=None, headers={}):
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def test_requests_share_a_connection(server):
+    conn = connect(server)
+    response, first = get(conn, "/port")
+    assert response.getheader("Connection") is None
+    response, second = get(conn, "/port")
+    assert first == second
+    conn.close()
+
+
+def test_chunked_response(server):
+    conn = connect(server)
+    response, body = get(conn, "/stream")
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    port = body[3:]
+    assert body == b"abc" + port
+    response, body = get(conn, "/port")
+    assert body == port
+    conn.close()
+
+
+def test_unread_body_is_skipped(server):
+    conn = connect(server)
+    response, body = get(conn, "/read", "POST", b"123456789")
+    assert body == b"123"
+    response, body = get(conn, "/read", "POST", b"abcdef")
+    assert body == b"abc"
+    conn.close()
+
+
+def test_closed_on_request(server):
+    conn = connect(server)
+    response, body = get(conn, "/port", headers={"Connection": "close"})
+    assert response.getheader("Connection") == "close"
+    assert response.will_close
+    conn.close()
+
+
+def test_closed_after_max_requests(server):
+    conn = connect(server)
+    ports = set()
+    for _ in range(3):
+        response, body = get(conn, "/port")
+        ports.add(body)
+
+    assert response.getheader("Connection") == "close"
+    response, body = get(conn, "/port")
+    ports.add(body)
+    # reconnected for the fourth
+    assert len(ports) == 2
+    conn.close()
+
+
+def test_http_1_0_is_closed():
+    server = make_server("127.0.0.1", 0, app, ThreadingWSGIServer,
+                         QuietHandler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    sock = socket.create_connection(("127.0.0.1", server.server_port), 5)
+    try:
+        sock.sendall(b"GET /port HTTP/1.0\r\n\r\n")
+        data = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+
+            data += chunk
+
+        assert data.startswith(b"HTTP/1.1 200")
+
+    finally:
+        sock.close()
+        thread.join(5)
+        server.server_close()
+
+
+def test_idle_connection_closed(server):
+    conn = connect(server)
+    get(conn, "/port")
+    start = time.monotonic()
+    # nothing more is sent, the server gives up after 1 s
+    assert conn.sock.recv(4096) == b""
+    assert 0.5 < time.monotonic() - start < 4
+    conn.close()
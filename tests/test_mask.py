@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from wsocket import WebSocket, mask_bytes
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+@pytest.fixture
+def websocket():
+    return WebSocket({}, None, None, Handler(), False)
+
+
+def masks():
+    rand = random.Random(4)
+    yield b"\x00\x00\x00\x00"
+    yield b"\xff\xff\xff\xff"
+    for _ in range(4):
+        yield bytes(rand.getrandbits(8) for _ in range(4))
+
+
+def payload(length, seed=0):
+    rand = random.Random(length * 31 + seed)
+    return bytes(rand.getrandbits(8) for _ in range(length))
+
+
+# around the 512 byte switch between the two ways of masking
+LENGTHS = list(range(0, 70)) + [127, 128, 511, 512, 513, 1023, 1024, 4099]
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+def test_same_as_mask_payload(websocket, length):
+    data = payload(length)
+    for mask in masks():
+        expected = websocket.mask_payload(mask, length, data)
+        assert mask_bytes(mask, data) == expected
+        assert mask_bytes(mask, bytearray(data)) == expected
+
+
+@pytest.mark.parametrize("length", [0, 1, 3, 4, 5, 100, 511, 512, 513, 2048])
+@pytest.mark.parametrize("offset", [0, 1, 2, 3, 5, 7])
+def test_unaligned_data(websocket, length, offset):
+    # a payload that starts at any offset of a larger buffer
+    buf = bytearray(payload(length + offset + 3, offset))
+    data = memoryview(buf)[offset:offset + length]
+    for mask in masks():
+        expected = websocket.mask_payload(mask, length, bytes(data))
+        assert mask_bytes(mask, data) == expected
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 4, 9, 511, 512, 513, 3000])
+def test_in_place(websocket, length):
+    for mask in masks():
+        data = bytearray(payload(length))
+        expected = websocket.mask_payload(mask, length, data)
+        out = mask_bytes(mask, data, data)
+        assert out is data
+        assert data == expected
+
+
+@pytest.mark.parametrize("length", [0, 1, 7, 600])
+def test_larger_out(websocket, length):
+    mask = b"\x12\x34\x56\x78"
+    data = payload(length)
+    out = bytearray(b"\xaa" * (length + 8))
+    assert mask_bytes(mask, data, out) is out
+    assert out[:length] == websocket.mask_payload(mask, length, data)
+    # the rest of `out` is left alone
+    assert out[length:] == b"\xaa" * 8
+
+
+@pytest.mark.parametrize("length", [0, 5, 512, 1001])
+def test_masking_twice_restores(length):
+    mask = b"\x01\x80\x7f\xfe"
+    data = payload(length)
+    assert mask_bytes(mask, mask_bytes(mask, data)) == data
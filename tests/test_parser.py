@@ -0,0 +1,217 @@
+import io
+import random
+
+import pytest
+
+from wsocket import (FrameParser, FrameTooLargeException,
+                     MessageTooLargeException, ProtocolError, WebSocket,
+                     mask_bytes)
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CONTINUATION = 0x0
+OPCODE_PING = 0x9
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+def payload(length):
+    rand = random.Random(length)
+    return bytes(rand.getrandbits(8) for _ in range(length))
+
+
+def frame(data, opcode=OPCODE_BINARY, fin=True, mask=None, flags=0):
+    header = WebSocket.encode_header(fin, opcode, mask, len(data), flags)
+    if mask:
+        data = mask_bytes(mask, data)
+
+    return bytes(header) + bytes(data)
+
+
+def unmask(result):
+    fin, opcode, flags, mask, data = result
+    if mask is not None:
+        data = mask_bytes(mask, data)
+
+    return bool(fin), opcode, flags, bytes(data)
+
+
+# the three ways a length is encoded: 7 bits, 16 bits and 64 bits
+LENGTHS = [0, 1, 125, 126, 127, 0xFFFF, 0x10000, 70000]
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+@pytest.mark.parametrize("mask", [None, b"\x01\x82\x43\xc4"])
+def test_whole_frame(length, mask):
+    data = payload(length)
+    parser = FrameParser()
+    parser.feed(frame(data, mask=mask))
+    result = parser.next_frame()
+    assert result[3] == mask
+    assert unmask(result) == (True, OPCODE_BINARY, 0, data)
+    assert parser.next_frame() is None
+    assert parser.needed == 2
+
+
+@pytest.mark.parametrize("length", [0, 5, 125, 126, 300, 0x10000])
+@pytest.mark.parametrize("mask", [None, b"\xa0\x0b\xc0\x0d"])
+def test_byte_at_a_time(length, mask):
+    data = payload(length)
+    raw = frame(data, mask=mask)
+    parser = FrameParser()
+    for i in range(len(raw) - 1):
+        parser.feed(raw[i:i + 1])
+        assert parser.next_frame() is None
+        assert parser.needed >= 1
+
+    parser.feed(raw[-1:])
+    assert unmask(parser.next_frame()) == (True, OPCODE_BINARY, 0, data)
+    assert parser.received == len(raw)
+    assert parser.frames == 1
+
+
+def test_needed_counts_missing_bytes():
+    raw = frame(payload(1000))  # 4 byte header
+    parser = FrameParser()
+    parser.feed(raw[:1])
+    assert parser.next_frame() is None
+    assert parser.needed == 1
+    parser.feed(raw[1:3])
+    assert parser.next_frame() is None
+    assert parser.needed == 1
+    parser.feed(raw[3:100])
+    assert parser.next_frame() is None
+    assert parser.needed == len(raw) - 100
+
+
+def test_several_frames_in_one_feed():
+    frames = [(payload(n), n % 2 == 0) for n in (3, 200, 0, 70000, 1)]
+    raw = b"".join(
+        frame(data, OPCODE_TEXT, fin, b"\x05\x06\x07\x08" if fin else None)
+        for data, fin in frames)
+    parser = FrameParser()
+    # split at an odd place, inside the header of the second frame
+    parser.feed(raw[:6])
+    parser.feed(raw[6:])
+    for data, fin in frames:
+        assert unmask(parser.next_frame()) == (fin, OPCODE_TEXT, 0, data)
+
+    assert parser.next_frame() is None
+    assert parser.frames == len(frames)
+
+
+def test_flags_and_continuation():
+    parser = FrameParser()
+    parser.feed(frame(b"ab", OPCODE_TEXT, fin=False, flags=0x40))
+    parser.feed(frame(b"cd", OPCODE_CONTINUATION))
+    fin, opcode, flags, mask, data = parser.next_frame()
+    assert (fin, opcode, flags, data) == (0, OPCODE_TEXT, 0x40, b"ab")
+    fin, opcode, flags, mask, data = parser.next_frame()
+    assert (bool(fin), opcode, flags, data) == (True, 0, 0, b"cd")
+
+
+def test_oversize_control_frame():
+    parser = FrameParser()
+    parser.feed(frame(payload(126), OPCODE_PING))
+    with pytest.raises(FrameTooLargeException):
+        parser.next_frame()
+
+
+def test_fragmented_control_frame():
+    parser = FrameParser()
+    parser.feed(frame(b"ping", OPCODE_PING, fin=False))
+    with pytest.raises(ProtocolError):
+        parser.next_frame()
+
+
+def test_control_frame_limit_from_header_alone():
+    # refused before any of the payload arrives
+    parser = FrameParser()
+    parser.feed(frame(payload(200), OPCODE_PING)[:2])
+    with pytest.raises(FrameTooLargeException):
+        parser.next_frame()
+
+
+def test_oversize_frame_refused_before_payload():
+    reads = []
+    raw = io.BytesIO(frame(payload(200000), mask=b"\x01\x02\x03\x04"))
+
+    def read(size):
+        reads.append(size)
+        return raw.read(size)
+
+    websocket = WebSocket({}, read, None, Handler(), False)
+    websocket.max_message_size = 100000
+    with pytest.raises(MessageTooLargeException):
+        websocket.read_frame()
+
+    assert sum(reads) == 14  # the header only
+
+
+def test_read_payload():
+    data = payload(100000)
+    mask = b"\x11\x22\x33\x44"
+    raw = frame(data, mask=mask)
+    rest = io.BytesIO(raw[1000:])
+    parser = FrameParser()
+    parser.feed(raw[:1000])
+    assert parser.next_frame() is None
+    result = parser.read_payload(rest.readinto)
+    assert unmask(result) == (True, OPCODE_BINARY, 0, data)
+    assert parser.received == len(raw)
+    parser.feed(frame(b"next"))
+    assert parser.next_frame()[4] == b"next"
+
+
+def test_next_piece_splits_incomplete_frame():
+    data = payload(1001)
+    mask = b"\x9a\x3b\x4c\x5d"
+    raw = frame(data, OPCODE_TEXT, mask=mask)
+    parser = FrameParser()
+    pieces = []
+    for start in range(0, len(raw), 333):
+        parser.feed(raw[start:start + 333])
+        piece = parser.next_piece()
+        if piece is not None:
+            pieces.append(unmask(piece))
+
+    assert b"".join(piece[3] for piece in pieces) == data
+    assert len(pieces) > 1
+    # the first piece keeps the opcode, the rest are continuations
+    assert pieces[0][:2] == (False, OPCODE_TEXT)
+    assert all(piece[1] == OPCODE_CONTINUATION for piece in pieces[1:])
+    assert [piece[0] for piece in pieces[-2:]] == [False, True]
+
+
+def test_next_piece_holds_control_frames():
+    parser = FrameParser()
+    raw = frame(b"ping!", OPCODE_PING)
+    parser.feed(raw[:4])
+    assert parser.next_piece() is None
+    parser.feed(raw[4:])
+    assert parser.next_piece()[4] == b"ping!"
+
+
+@pytest.mark.parametrize("length", [0, 125, 126, 0xFFFF, 0x10000])
+def test_frame_length(length):
+    raw = frame(payload(length), mask=b"\x01\x02\x03\x04")
+    parser = FrameParser()
+    size = len(raw) - length - 4  # the length is before the mask
+    parser.feed(raw[:size - 1])
+    assert parser.frame_length() is None
+    parser.feed(raw[size - 1:size])
+    assert parser.frame_length() == length
+    # the same once the parser decoded the header
+    parser.feed(raw[size:-1])
+    assert parser.next_frame() is None or length == 0
+    if length:
+        assert parser.frame_length() == length
+
+
+def test_no_frame_length_for_control_frames():
+    parser = FrameParser()
+    parser.feed(frame(b"ping", OPCODE_PING))
+    assert parser.frame_length() is None
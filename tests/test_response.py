@@ -0,0 +1,69 @@
+import time
+from threading import Thread
+
+from wsocket import Response
+
+
+def server():
+    """a server's `start_response` and what it was given"""
+    written = []
+
+    def start_response(status, headers):
+        written.append(status)
+        return written.append
+
+    return start_response, written
+
+
+def test_waiting_for_the_response_uses_no_cpu():
+    start_response, written = server()
+    app_start_response = []
+
+    def app(environ, start_response):
+        app_start_response.append(start_response)
+
+        def body():
+            yield b"hello"
+
+        return body()
+
+    response = Response({}, start_response, app)
+    thread = Thread(target=response.process_response)
+    thread.daemon = True
+    before = time.process_time()
+    thread.start()
+    time.sleep(1)
+    used = time.process_time() - before
+    assert thread.is_alive()  # still waiting
+    app_start_response[0]("200 OK", [])
+    thread.join(5)
+    assert not thread.is_alive()
+    assert used < 0.1
+    assert written == ["200 OK", b"hello"]
+
+
+def test_list_without_start_response():
+    start_response, written = server()
+
+    def app(environ, start_response):
+        return [b"a", b"b"]
+
+    response = Response({}, start_response, app)
+    thread = Thread(target=response.process_response)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert written == ["200 OK", b"ab"]
+
+
+def test_generator_started_in_its_body():
+    start_response, written = server()
+
+    def app(environ, start_response):
+        start_response("201 Created", [("Content-Type", "text/plain")])
+        yield "x"
+        yield "y"
+
+    Response({}, start_response, app).process_response()
+    assert written == ["201 Created", b"xy"]
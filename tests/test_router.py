@@ -0,0 +1,129 @@
+import pytest
+
+from wsocket import Router, WSocketApp
+
+
+def handler(name):
+    def callback(environ, start_response):
+        start_response("200 OK", [])
+        return [name.encode()]
+
+    callback.__name__ = name
+    return callback
+
+
+@pytest.fixture
+def router():
+    router = Router()
+    router.add("/", handler("index"))
+    router.add("/about", handler("about"), "GET")
+    router.add("/about", handler("post_about"), "POST")
+    router.add("/users/<id:int>", handler("user"), "GET")
+    router.add("/users/<id:int>/posts/<slug>", handler("post"))
+    router.add("/files/<path:path>", handler("files"), ("GET", "HEAD"))
+    router.add("/api/v1/*", handler("api"), "POST")
+    router.add("/<page>", handler("page"), "GET")
+    return router
+
+
+def name(result):
+    return result[0] and result[0].__name__
+
+
+def test_static(router):
+    assert name(router.match("GET", "/")) == "index"
+    assert name(router.match("GET", "/about")) == "about"
+    assert name(router.match("POST", "/about")) == "post_about"
+
+
+def test_dynamic(router):
+    callback, params, allowed = router.match("GET", "/users/42")
+    assert callback.__name__ == "user"
+    assert params == {"id": 42}
+    callback, params, allowed = router.match("DELETE", "/users/-1/posts/hi")
+    assert callback.__name__ == "post"
+    assert params == {"id": -1, "slug": "hi"}
+    callback, params, allowed = router.match("GET", "/files/a/b/c.txt")
+    assert params == {"path": "a/b/c.txt"}
+    assert name(router.match("POST", "/api/v1/anything/else")) == "api"
+    assert name(router.match("GET", "/contact")) == "page"
+
+
+def test_head_is_get(router):
+    assert name(router.match("HEAD", "/about")) == "about"
+
+
+def test_not_found(router):
+    assert router.match("GET", "/users/x") == (None, {}, set())
+    assert router.match("GET", "/nothing/here") == (None, {}, set())
+
+
+def test_method_not_allowed(router):
+    callback, params, allowed = router.match("PUT", "/about")
+    assert callback is None
+    assert allowed == {"GET", "POST"}
+    callback, params, allowed = router.match("POST", "/users/1")
+    assert callback is None
+    assert allowed == {"GET"}
+    callback, params, allowed = router.match("GET", "/api/v1/x")
+    assert allowed == {"POST"}
+
+
+def test_rules_keep_their_order_across_groups():
+    router = Router()
+    router.add("/<a>/<b>", handler("first"), "GET")
+    router.add("/users/<id>", handler("second"))
+    router.add("/users/<id>", handler("second_post"), "POST")
+    # the ungrouped rule came first
+    assert name(router.match("GET", "/users/1")) == "first"
+    assert name(router.match("POST", "/users/1")) == "second_post"
+    assert name(router.match("DELETE", "/other/1")) is None
+
+
+def test_cache_is_bounded(router):
+    router.cache_size = 3
+    for i in range(100):
+        router.match("GET", "/users/%d" % i)
+
+    assert len(router.cache) == 3
+    assert list(router.cache) == [("GET", "/users/%d" % i)
+                                  for i in (97, 98, 99)]
+
+
+def test_cache_drops_the_least_recently_used(router):
+    router.cache_size = 2
+    router.match("GET", "/users/1")
+    router.match("GET", "/users/2")
+    router.match("GET", "/users/1")  # used again
+    router.match("GET", "/users/3")
+    assert set(router.cache) == {("GET", "/users/1"), ("GET", "/users/3")}
+    callback, params, allowed = router.match("GET", "/users/1")
+    assert params == {"id": 1}
+    params["id"] = 5  # a copy, the cached params stay
+    assert router.match("GET", "/users/1")[1] == {"id": 1}
+
+
+def test_no_cache(router):
+    router.cache_size = 0
+    assert name(router.match("GET", "/users/1")) == "user"
+    assert not router.cache
+
+
+def test_adding_a_rule_clears_the_cache(router):
+    router.match("GET", "/users/1")
+    router.add("/users/1", handler("one"))
+    assert not router.cache
+    assert name(router.match("GET", "/users/1")) == "one"
+
+
+def test_app_answers_405():
+    app = WSocketApp()
+    app.route("/about", "GET")(handler("about"))
+    started = []
+    body = app.wsgi({"REQUEST_METHOD": "POST", "PATH_INFO": "/about"},
+                    lambda status, headers, exc_info=None: started.append(
+                        (status, headers)) or (lambda data: None))
+    list(body or [])
+    status, headers = started[0]
+    assert str(status).startswith("405")
+    assert ("Allow", "GET") in headers
@@ -0,0 +1,155 @@
+import asyncio
+import socket
+import struct
+import threading
+
+import pytest
+
+from wsocket import (FixedHandler, FrameParser, SelectorWSGIServer,
+                     WebSocket, WSocketApp, make_server, mask_bytes)
+
+try:
+    import resource
+
+except ImportError:  # windows
+    resource = None
+
+CLIENTS = 3000
+
+HANDSHAKE = (b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+             b"Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+             b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n")
+
+
+class QuietHandler(FixedHandler):
+    def log_message(self, *args):
+        pass
+
+
+class EchoApp(WSocketApp):
+    def on_connect(self, client):
+        pass
+
+    def on_message(self, message, client):
+        client.send(message)
+
+
+def enough_files(count):
+    """raise the open files limit for `count` files, `False` if it can not"""
+    if resource is None:
+        return False
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= count:
+        return True
+
+    if hard != resource.RLIM_INFINITY and hard < count:
+        return False
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+    return True
+
+
+@pytest.fixture
+def server():
+    if not enough_files(2 * CLIENTS + 500):
+        pytest.skip("can not open %d files" % (2 * CLIENTS + 500))
+
+    # threads left by other tests do not count
+    before = threading.active_count()
+    server = make_server("127.0.0.1", 0, EchoApp(), SelectorWSGIServer,
+                         QuietHandler)
+    server.threads_before = before
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+async def connect(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(HANDSHAKE)
+    head = await reader.readuntil(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 101")
+    return reader, writer
+
+
+async def echo(i, reader, writer):
+    payload = ("client %6d" % i).encode()
+    mask = b"\x01\x02\x03\x04"
+    header = bytes([0x82, 0x80 | len(payload)]) + mask
+    writer.write(header + bytes(mask_bytes(mask, payload)))
+    data = await reader.readexactly(len(payload) + 2)
+    return data[2:] == payload
+
+
+async def drive(port):
+    connections = []
+    for start in range(0, CLIENTS, 200):
+        connections += await asyncio.gather(
+            *[connect(port) for _ in range(min(200, CLIENTS - start))])
+
+    # the request threads are gone once the websockets are parked
+    await asyncio.sleep(1)
+    threads = threading.active_count()
+    echoed = await asyncio.wait_for(
+        asyncio.gather(*[
+            echo(i, reader, writer)
+            for i, (reader, writer) in enumerate(connections)
+        ]), 60)
+    for reader, writer in connections:
+        writer.close()
+
+    return threads, echoed
+
+
+def test_thousands_of_parked_clients(server):
+    threads, echoed = asyncio.run(drive(server.server_port))
+    assert all(echoed)
+    assert len(echoed) == CLIENTS
+    # the server, selector and its pool, the handler threads of the app
+    # and this one, not a thread per client
+    workers = server.workers + server.get_app().dispatcher.workers
+    limit = server.threads_before + workers + 10
+    assert threads <= limit
+    assert threading.active_count() <= limit
+
+
+class LimitedApp(EchoApp):
+    max_message_size = 1000
+
+
+@pytest.mark.parametrize("length", [1001, 100000])
+def test_large_frame_refused_from_its_header(length):
+    server = make_server("127.0.0.1", 0, LimitedApp(), SelectorWSGIServer,
+                         QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    sock = socket.create_connection(("127.0.0.1", server.server_port), 5)
+    try:
+        sock.sendall(HANDSHAKE)
+        head = b""
+        while b"\r\n\r\n" not in head:
+            head += sock.recv(1)
+
+        # parked, then the header and a part of the payload come in one
+        # read, nothing more is sent
+        mask = b"\x01\x02\x03\x04"
+        header = WebSocket.encode_header(True, 0x2, mask, length, 0)
+        sock.sendall(bytes(header) + bytes(mask_bytes(mask, b"x" * 500)))
+        parser = FrameParser()
+        frame = None
+        while frame is None:
+            parser.feed(sock.recv(4096))
+            frame = parser.next_frame()
+
+        assert frame[1] == 0x8
+        assert struct.unpack("!H", bytes(frame[4][:2])) == (1009, )
+
+    finally:
+        sock.close()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,123 @@
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from wsocket import FrameParser, SendQueue, WebSocket
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    yield wsock, client
+    if wsock.send_queue is not None:
+        wsock.send_queue.close()
+
+    server.close()
+    client.close()
+
+
+def held_queue(wsock, **options):
+    """a queue of `wsock`, which another sender holds so nothing is sent"""
+    queue = wsock.send_queue = SendQueue(**options).attach(wsock)
+    wsock.lock_writes()
+    return queue
+
+
+def messages(queue):
+    return [item[0] for item in queue.items]
+
+
+def read_messages(sock, count):
+    parser = FrameParser()
+    sock.settimeout(5)
+    received = []
+    while len(received) < count:
+        parser.feed(sock.recv(1 << 16))
+        while True:
+            frame = parser.next_frame()
+            if frame is None:
+                break
+
+            received.append(bytes(frame[-1]).decode())
+
+    return received
+
+
+def test_size_is_in_bytes(pair):
+    wsock, client = pair
+    queue = held_queue(wsock, max_bytes=10, policy="drop_newest")
+    assert queue.put("é" * 5)  # 5 characters, 10 bytes
+    assert queue.size == 10
+    assert queue.put("é") is False
+    assert queue.dropped == 1
+    assert queue.put(b"x") is False
+
+
+def test_drop_oldest(pair):
+    wsock, client = pair
+    queue = held_queue(wsock, max_messages=3, policy="drop_oldest")
+    for i in range(5):
+        assert queue.put(str(i))
+
+    assert messages(queue) == ["2", "3", "4"]
+    assert queue.dropped == 2
+    assert queue.size == 3
+
+
+def test_drop_newest(pair):
+    wsock, client = pair
+    queue = held_queue(wsock, max_messages=3, policy="drop_newest")
+    results = [queue.put(str(i)) for i in range(5)]
+    assert results == [True, True, True, False, False]
+    assert messages(queue) == ["0", "1", "2"]
+    assert queue.dropped == 2
+
+
+def test_coalesce(pair):
+    wsock, client = pair
+    queue = held_queue(wsock, max_messages=3, policy="coalesce")
+    queue.put("a1", key="a")
+    queue.put("b1", key="b")
+    queue.put("a2", key="a")  # replaces a1, though there is room
+    assert messages(queue) == ["a2", "b1"]
+    assert queue.coalesced == 1
+    queue.put("c1", key="c")
+    queue.put("d1", key="d")  # full, drops the oldest
+    assert messages(queue) == ["b1", "c1", "d1"]
+    assert queue.dropped == 1
+    assert "a" not in queue.keys
+
+
+def test_block(pair):
+    wsock, client = pair
+    queue = held_queue(wsock, max_messages=1, policy="block")
+    queue.put("first")
+    sender = Thread(target=queue.put, args=("second", ))
+    sender.start()
+    time.sleep(0.1)
+    assert sender.is_alive()
+    assert queue.blocked == 1
+    wsock.unlock_writes()  # the queue can be written again
+    sender.join(5)
+    assert not sender.is_alive()
+    assert read_messages(client, 2) == ["first", "second"]
+
+
+def test_close(pair):
+    wsock, client = pair
+    queue = held_queue(wsock, max_messages=1, policy="close")
+    queue.put("first")
+    assert queue.put("second") is False
+    assert queue.closed
+    assert queue.dropped == 1
+    client.settimeout(5)
+    assert client.recv(100) == b""  # the connection was shut down
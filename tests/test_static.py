@@ -0,0 +1,67 @@
+import gzip
+from threading import Thread
+
+import pytest
+
+from wsocket import StaticFiles
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / "a.txt").write_bytes(b"0123456789")
+    for i in range(20):
+        (tmp_path / ("%d.js" % i)).write_bytes(b"var x = %d;\n" % i * 500)
+
+    return StaticFiles(str(tmp_path))
+
+
+def get(files, path, **headers):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path}
+    environ.update(("HTTP_" + name.upper(), value)
+                   for name, value in headers.items())
+    started = []
+    body = files(environ, lambda status, headers: started.append(
+        (status, dict(headers))))
+    status, headers = started[0]
+    return status, headers, b"".join(body)
+
+
+@pytest.mark.parametrize("header, status, body", [
+    ("bytes=2-5", 206, b"2345"),
+    ("bytes=7-", 206, b"789"),
+    ("bytes=-3", 206, b"789"),
+    ("bytes=5-2", 200, b"0123456789"),  # invalid, ignored
+    ("bytes=x-2", 200, b"0123456789"),
+    ("bytes=20-", 416, b""),
+])
+def test_range(files, header, status, body):
+    assert get(files, "/a.txt", range=header)[::2] == (status, body)
+
+
+def test_concurrent_compression(files):
+    files.gzip_cache_size = 200  # a few files, the rest are dropped
+    errors = []
+
+    def fetch():
+        try:
+            for _ in range(5):
+                for i in range(20):
+                    status, headers, body = get(files, "/%d.js" % i,
+                                                accept_encoding="gzip")
+                    assert headers["Content-Encoding"] == "gzip"
+                    assert gzip.decompress(body) == b"var x = %d;\n" % i * 500
+
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=fetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert files.gzipped_size == sum(
+        len(body or b"") for key, body in files.gzipped.values())
+    assert files.gzipped_size <= files.gzip_cache_size
@@ -0,0 +1,280 @@
+import io
+import socket
+import struct
+import threading
+import zlib
+
+import pytest
+
+from wsocket import FrameParser, PerMessageDeflate, WebSocket, mask_bytes
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    client.settimeout(5)
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    yield wsock, client
+    wsock.closed = True
+    server.close()
+    client.close()
+
+
+def masked(payload, opcode=OPCODE_BINARY, fin=True):
+    mask = b"\x37\xfa\x21\x3d"
+    header = WebSocket.encode_header(fin, opcode, mask, len(payload), 0)
+    return bytes(header) + bytes(mask_bytes(mask, payload))
+
+
+def fragments(payload, size, opcode=OPCODE_BINARY):
+    """`payload` as a fragmented message of `size` byte frames"""
+    pieces = [payload[i:i + size] for i in range(0, len(payload), size)]
+    return b"".join(
+        masked(piece, opcode if i == 0 else OPCODE_CONTINUATION,
+               i == len(pieces) - 1) for i, piece in enumerate(pieces))
+
+
+def received_frames(client, count):
+    parser = FrameParser()
+    frames = []
+    while len(frames) < count:
+        frame = parser.next_frame()
+        if frame is None:
+            parser.feed(client.recv(65536))
+
+        else:
+            frames.append((bool(frame[0]), frame[1], bytes(frame[4])))
+
+    return frames
+
+
+def test_chunks_as_fragments_arrive(pair):
+    wsock, client = pair
+    client.sendall(masked(b"first", OPCODE_BINARY, False))
+    stream = wsock.receive_stream()
+    assert stream.binary
+    # the first fragment is there before the rest is sent
+    assert stream.read(5) == b"first"
+    assert not stream.done
+    client.sendall(masked(b"second", OPCODE_CONTINUATION, False))
+    client.sendall(masked(b"third", OPCODE_CONTINUATION))
+    assert list(stream) == [bytearray(b"second"), bytearray(b"third")]
+    assert stream.done
+    assert stream.size == 16
+
+
+def test_read_all(pair):
+    wsock, client = pair
+    data = bytes(range(256)) * 100
+    client.sendall(fragments(data, 1000))
+    stream = wsock.receive_stream()
+    assert stream.read(100) == data[:100]
+    assert stream.read() == data[100:]
+    assert stream.read() == b""
+
+
+def test_text_split_inside_a_character(pair):
+    wsock, client = pair
+    text = u"été €\U0001f600" * 50
+    client.sendall(fragments(text.encode("utf-8"), 7, OPCODE_TEXT))
+    stream = wsock.receive_stream()
+    assert not stream.binary
+    assert "".join(stream) == text
+
+
+def test_ping_between_fragments(pair):
+    wsock, client = pair
+    client.sendall(b"".join([
+        masked(b"a" * 10, OPCODE_BINARY, False),
+        masked(b"are you there", OPCODE_PING),
+        masked(b"b" * 10, OPCODE_CONTINUATION),
+    ]))
+    stream = wsock.receive_stream()
+    assert stream.read() == b"a" * 10 + b"b" * 10
+    pong = (True, OPCODE_PONG, b"are you there")
+    assert received_frames(client, 1) == [pong]
+
+
+def test_close_skips_the_rest(pair):
+    wsock, client = pair
+    client.sendall(fragments(b"x" * 5000, 1000) + masked(b"next"))
+    with wsock.receive_stream() as stream:
+        assert stream.read(10) == b"x" * 10
+
+    assert wsock.receive() == b"next"
+
+
+def test_stream_has_no_size_limit(pair):
+    wsock, client = pair
+    wsock.max_message_size = 1000
+    data = b"y" * 100000
+    sender = threading.Thread(target=client.sendall,
+                              args=(fragments(data, 4096), ))
+    sender.start()
+    stream = wsock.receive_stream()
+    assert stream.read() == data
+    sender.join()
+
+
+@pytest.mark.parametrize("frame_size", [2000, 300])
+def test_max_message_size(pair, frame_size):
+    wsock, client = pair
+    wsock.max_message_size = 1000
+    client.sendall(fragments(b"z" * 1000, frame_size) + masked(b"ok"))
+    assert wsock.receive() == b"z" * 1000
+    assert wsock.receive() == b"ok"
+    client.sendall(fragments(b"z" * 1001, frame_size))
+    assert wsock.receive() is None
+    assert wsock.closed
+    (fin, opcode, payload), = received_frames(client, 1)
+    assert opcode == OPCODE_CLOSE
+    assert struct.unpack("!H", payload[:2]) == (1009, )
+
+
+def test_max_message_size_before_payload(pair):
+    wsock, client = pair
+    wsock.max_message_size = 1000
+    # only the header of a large frame is sent
+    client.sendall(masked(b"w" * 70000)[:14])
+    assert wsock.receive() is None
+    (fin, opcode, payload), = received_frames(client, 1)
+    assert struct.unpack("!H", payload[:2]) == (1009, )
+
+
+def sent_message(client):
+    """the frames of the next message `client` receives, pings skipped"""
+    frames = []
+    parser = FrameParser()
+    while not frames or not frames[-1][0]:
+        frame = parser.next_frame()
+        if frame is None:
+            parser.feed(client.recv(65536))
+
+        elif frame[1] != OPCODE_PING:
+            frames.append((bool(frame[0]), frame[1], frame[2],
+                           bytes(frame[4])))
+
+    return frames
+
+
+def test_send_stream_of_chunks(pair):
+    wsock, client = pair
+    chunks = [b"a" * 2500, b"", bytearray(b"b" * 10), memoryview(b"c" * 990)]
+    wsock.send_stream(chunks, fragment_size=1000)
+    frames = sent_message(client)
+    assert [opcode for fin, opcode, flags, data in frames] == (
+        [OPCODE_BINARY] + [OPCODE_CONTINUATION] * (len(frames) - 1))
+    assert all(len(data) <= 1000 for fin, opcode, flags, data in frames)
+    assert b"".join(data for fin, opcode, flags, data in frames) == (
+        b"a" * 2500 + b"b" * 10 + b"c" * 990)
+
+
+def test_send_stream_of_file(pair):
+    wsock, client = pair
+    data = bytes(range(256)) * 40
+    wsock.send_stream(io.BytesIO(data), fragment_size=4096)
+    frames = sent_message(client)
+    assert [len(frame[3]) for frame in frames] == [4096, 4096, 2048, 0]
+    assert b"".join(frame[3] for frame in frames) == data
+
+
+def test_send_stream_of_text(pair):
+    wsock, client = pair
+    wsock.send_stream((u"%d€" % i for i in range(100)), binary=False)
+    frames = sent_message(client)
+    assert frames[0][1] == OPCODE_TEXT
+    text = b"".join(frame[3] for frame in frames).decode("utf-8")
+    assert text == "".join(u"%d€" % i for i in range(100))
+
+
+def test_send_stream_compressed():
+    server, client = socket.socketpair()
+    deflate = PerMessageDeflate(min_size=10)
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), deflate.accept([]))
+    try:
+        wsock.send_stream([b"hello " * 1000] * 10, fragment_size=1000)
+        frames = sent_message(client)
+        # RSV1 on the first frame only
+        assert [flags for fin, opcode, flags, data in frames] == (
+            [0x40] + [0] * (len(frames) - 1))
+        payload = b"".join(frame[3] for frame in frames)
+        assert len(payload) < 1000
+        inflater = zlib.decompressobj(-15)
+        data = inflater.decompress(payload + b"\0\0\xff\xff")
+        assert data == b"hello " * 10000
+
+    finally:
+        wsock.closed = True
+        server.close()
+        client.close()
+
+
+def test_send_stream_error_closes(pair):
+    wsock, client = pair
+
+    def chunks():
+        yield b"part"
+        raise RuntimeError("source failed")
+
+    with pytest.raises(RuntimeError):
+        wsock.send_stream(chunks())
+
+    assert wsock.closed
+    parser = FrameParser()
+    parser.feed(client.recv(65536))
+    assert parser.next_frame()[4] == b"part"
+    close = parser.next_frame()
+    assert close[1] == OPCODE_CLOSE
+    assert struct.unpack("!H", close[4][:2]) == (1011, )
+
+
+def test_messages_wait_for_the_stream(pair):
+    wsock, client = pair
+    produced = threading.Event()
+    resume = threading.Event()
+
+    def chunks():
+        yield b"first"
+        produced.set()
+        resume.wait(5)
+        yield b"last"
+
+    streamer = threading.Thread(target=wsock.send_stream, args=(chunks(), ))
+    streamer.start()
+    produced.wait(5)
+    sender = threading.Thread(target=wsock.send, args=(b"other", ))
+    sender.start()
+    # a control frame goes between the fragments, a message can not
+    wsock.send_frame(b"ping", OPCODE_PING)
+    sender.join(0.2)
+    assert sender.is_alive()
+    resume.set()
+    streamer.join(5)
+    sender.join(5)
+    parser = FrameParser()
+    frames = []
+    while len(frames) < 5:
+        frame = parser.next_frame()
+        if frame is None:
+            parser.feed(client.recv(65536))
+
+        else:
+            frames.append((frame[1], bytes(frame[4])))
+
+    assert frames == [(OPCODE_BINARY, b"first"), (OPCODE_PING, b"ping"),
+                      (OPCODE_CONTINUATION, b"last"),
+                      (OPCODE_CONTINUATION, b""), (OPCODE_BINARY, b"other")]
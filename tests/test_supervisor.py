@@ -0,0 +1,165 @@
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from wsocket import WebSocketClient
+
+if not hasattr(os, "fork"):
+    pytest.skip("workers need os.fork()", allow_module_level=True)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# workers write a file named after their number and pid
+WORKERS = """
+import os, signal, sys, time
+from wsocket import Supervisor
+
+out = sys.argv[1]
+
+
+def target(worker):
+    if sys.argv[2] == "stubborn":
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    open(os.path.join(out, "%d-%d" % (worker, os.getpid())), "w").close()
+    marker = os.path.join(out, "crashed")
+    if worker == 0 and not os.path.exists(marker):
+        open(marker, "w").close()
+        sys.exit(3)
+
+    time.sleep(60)
+
+
+supervisor = Supervisor(target, 2)
+supervisor.restart_delay = 0.1
+supervisor.stop_timeout = 0.5
+print("started")
+supervisor.run()
+print("stopped")
+"""
+
+SERVER = """
+import os
+from wsocket import WSocketApp, run
+
+
+class App(WSocketApp):
+    def on_connect(self, client):
+        client.send(str(os.getpid()))
+
+
+run(App(), port=0, workers=2)
+"""
+
+
+def start(*args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    # stdout buffered, as it is for a pipe
+    env.pop("PYTHONUNBUFFERED", None)
+    return subprocess.Popen([sys.executable, "-c"] + list(args), env=env,
+                            cwd=ROOT, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+
+        time.sleep(0.02)
+
+    return True
+
+
+def started(out):
+    """`{worker: [pid, ...]}` of the workers started so far"""
+    workers = {}
+    for name in os.listdir(out):
+        if name != "crashed":
+            worker, pid = map(int, name.split("-"))
+            workers.setdefault(worker, []).append(pid)
+
+    return workers
+
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+
+    except OSError:
+        return False
+
+    return True
+
+
+def listening(port):
+    try:
+        WebSocketClient("ws://127.0.0.1:%d/" % port, timeout=5).close()
+
+    except ConnectionRefusedError:
+        return False
+
+    return True
+
+
+@pytest.mark.parametrize("mode", ["polite", "stubborn"])
+def test_restarts_and_stops_workers(tmp_path, mode):
+    out = str(tmp_path)
+    proc = start(WORKERS, out, mode)
+    try:
+        # worker 0 exits at once and is started again
+        assert wait_for(lambda: len(started(out).get(0, ())) == 2)
+        assert len(started(out)[1]) == 1
+        proc.send_signal(signal.SIGTERM)
+        stdout, stderr = proc.communicate(timeout=10)
+
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    assert proc.returncode == 0
+    # a worker that exits does not write out what the supervisor buffered
+    assert stdout == b"started\nstopped\n"
+    assert b"worker 0" in stderr and b"exited with status 3" in stderr
+    # stubborn workers are killed after stop_timeout
+    for pids in started(out).values():
+        assert not any(running(pid) for pid in pids)
+
+
+def test_workers_share_the_port():
+    proc = start(SERVER)
+    try:
+        # flushed before the workers are forked
+        assert select.select([proc.stdout], [], [], 10)[0]
+        line = proc.stdout.readline().decode()
+        assert line.startswith("Server started at http://127.0.0.1:")
+        assert line.endswith("with 2 workers.\n")
+        port = int(line.split(":")[2].split()[0])
+        # printed before the workers listen
+        assert wait_for(lambda: listening(port))
+        pids = set()
+        for _ in range(20):
+            client = WebSocketClient("ws://127.0.0.1:%d/" % port, timeout=5)
+            pids.add(int(client.receive()))
+            client.close()
+
+        assert proc.pid not in pids
+        assert 1 <= len(pids) <= 2
+        proc.send_signal(signal.SIGINT)
+        stdout, stderr = proc.communicate(timeout=15)
+
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    assert b"Server started" not in stdout
+    assert stdout.count(b"Server stopped.") == 1
+    assert proc.returncode == 0
@@ -0,0 +1,163 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from wsocket import (AsyncWebSocketClient, AsyncWSocketApp,
+                     AsyncWSocketServer, FixedHandler, Metrics,
+                     SelectorWSGIServer, Tracer, WebSocket, WebSocketClient,
+                     WSocketApp, make_server, mask_bytes, set_tracer)
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+class Recorder(Tracer):
+    def __init__(self):
+        self.spans = []
+
+    def end(self, span):
+        self.spans.append((span.name, type(span.target).__name__, span.size))
+
+
+class QuietHandler(FixedHandler):
+    def log_message(self, *args):
+        pass
+
+
+class EchoApp(WSocketApp):
+    def on_connect(self, client):
+        pass
+
+    def on_message(self, message, client):
+        client.send(message)
+
+
+@pytest.fixture
+def recorder():
+    recorder = Recorder()
+    set_tracer(recorder)
+    yield recorder
+    set_tracer(None)
+
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    yield wsock, client
+    wsock.closed = True
+    server.close()
+    client.close()
+
+
+def masked_frame(payload):
+    mask = b"\x01\x02\x03\x04"
+    return bytes([0x81, 0x80 | len(payload)]) + mask + mask_bytes(
+        mask, payload)
+
+
+def test_send_and_receive_spans(recorder, pair):
+    wsock, client = pair
+    wsock.send("hello")
+    assert ("write", "WebSocket", 7) in recorder.spans
+    client.sendall(masked_frame(b"hi there"))
+    assert wsock.receive() == "hi there"
+    assert ("decode", "WebSocket", 8) in recorder.spans
+
+
+def test_untraced_without_tracer(pair):
+    wsock, client = pair
+    recorder = Recorder()
+    set_tracer(recorder)
+    set_tracer(None)
+    assert not hasattr(WebSocket.write_frame, "untraced")
+    wsock.send("hello")
+    assert recorder.spans == []
+
+
+def test_client_spans(recorder):
+    server = make_server("127.0.0.1", 0, EchoApp(), SelectorWSGIServer,
+                         QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        client = WebSocketClient("ws://127.0.0.1:%d/" % server.server_port)
+        client.send("hello")
+        assert client.receive() == "hello"
+        client.close()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # masked, with a 4 byte key
+    assert ("write", "WebSocketClient", 11) in recorder.spans
+    assert ("decode", "WebSocketClient", 5) in recorder.spans
+    assert ("handshake", "EchoApp", 0) in recorder.spans
+
+
+class AsyncEchoApp(AsyncWSocketApp):
+    async def on_connect(self, client):
+        pass
+
+    async def on_message(self, message, client):
+        await client.send(message)
+
+
+def test_async_client_spans(recorder):
+    app = AsyncEchoApp()
+
+    async def main():
+        server = AsyncWSocketServer(app, "127.0.0.1", 0)
+        await server.start()
+        try:
+            client = await AsyncWebSocketClient.connect(
+                "ws://127.0.0.1:%d/" % server.port, deflate=None)
+            await client.send("hello")
+            assert await client.receive() == "hello"
+            client.close()
+
+        finally:
+            server.server.close()
+
+    asyncio.run(main())
+    assert ("write", "AsyncWebSocketClient", 11) in recorder.spans
+    assert ("write", "AsyncWebSocket", 7) in recorder.spans
+
+
+def test_metrics_count_frames(pair):
+    wsock, client = pair
+    metrics = Metrics()
+    metrics.track(wsock)
+    wsock.send("hello")
+    client.sendall(masked_frame(b"hi"))
+    wsock.receive()
+    text = metrics.render()
+    assert 'wsocket_connections 1' in text
+    assert 'wsocket_frames_total{direction="out"} 1' in text
+    assert 'wsocket_frames_total{direction="in"} 1' in text
+    assert 'wsocket_bytes_total{direction="out"} 7' in text
+    assert 'wsocket_bytes_total{direction="in"} 8' in text
+    # kept when the websocket is gone
+    metrics.retire(wsock)
+    text = metrics.render()
+    assert 'wsocket_connections 0' in text
+    assert 'wsocket_frames_total{direction="out"} 1' in text
+
+
+def test_metrics_counters_and_histograms():
+    metrics = Metrics()
+    metrics.inc("wsocket_closes_total", labels=(("code", "1000"), ))
+    metrics.inc("wsocket_closes_total", 2, labels=(("code", "1000"), ))
+    metrics.observe("wsocket_ping_rtt_seconds", 0.003)
+    text = metrics.render()
+    assert 'wsocket_closes_total{code="1000"} 3' in text
+    assert 'wsocket_ping_rtt_seconds_bucket{le="0.0025"} 0' in text
+    assert 'wsocket_ping_rtt_seconds_bucket{le="0.005"} 1' in text
+    assert 'wsocket_ping_rtt_seconds_count 1' in text
@@ -0,0 +1,133 @@
+import socket
+import struct
+
+import pytest
+
+from wsocket import FrameParser, WebSocket, WebSocketError, mask_bytes
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+
+TEXT = u"aé€\U0001f600z" * 20
+
+
+class Handler(object):
+    def on_close(self, message):
+        pass
+
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    client.settimeout(5)
+    wsock = WebSocket({"wsocket.socket": server}, server.recv, server.sendall,
+                      Handler(), False)
+    yield wsock, client
+    wsock.closed = True
+    server.close()
+    client.close()
+
+
+def masked(payload, opcode=OPCODE_TEXT, fin=True):
+    mask = b"\xde\xad\xbe\xef"
+    header = WebSocket.encode_header(fin, opcode, mask, len(payload), 0)
+    return bytes(header) + bytes(mask_bytes(mask, payload))
+
+
+def fragments(payload, size):
+    pieces = [payload[i:i + size] for i in range(0, len(payload), size)]
+    return b"".join(
+        masked(piece, OPCODE_TEXT if i == 0 else OPCODE_CONTINUATION,
+               i == len(pieces) - 1) for i, piece in enumerate(pieces))
+
+
+def close_code(client):
+    parser = FrameParser()
+    frame = None
+    while frame is None:
+        parser.feed(client.recv(4096))
+        frame = parser.next_frame()
+
+    assert frame[1] == OPCODE_CLOSE
+    return struct.unpack("!H", bytes(frame[4][:2]))[0]
+
+
+def test_whole_message(pair):
+    wsock, client = pair
+    client.sendall(masked(TEXT.encode("utf-8")))
+    assert wsock.receive() == TEXT
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64])
+def test_code_points_split_between_fragments(pair, size):
+    wsock, client = pair
+    client.sendall(fragments(TEXT.encode("utf-8"), size))
+    assert wsock.receive() == TEXT
+    client.sendall(masked(b"next"))
+    assert wsock.receive() == "next"
+
+
+def test_empty_fragments(pair):
+    wsock, client = pair
+    client.sendall(b"".join([
+        masked(b"", OPCODE_TEXT, False),
+        masked(b"\xe2\x82", OPCODE_CONTINUATION, False),
+        masked(b"", OPCODE_CONTINUATION, False),
+        masked(b"\xac", OPCODE_CONTINUATION),
+    ]))
+    assert wsock.receive() == u"€"
+
+
+@pytest.mark.parametrize("payload", [
+    b"\xff",
+    b"abc\xc0\xaf",  # overlong "/"
+    b"\xed\xa0\x80",  # a surrogate
+    b"\xf4\x90\x80\x80",  # past U+10FFFF
+    b"\xe2\x82",  # cut short
+])
+def test_invalid_message_closes_1007(pair, payload):
+    wsock, client = pair
+    client.sendall(masked(payload))
+    assert wsock.receive() is None
+    assert wsock.closed
+    assert close_code(client) == 1007
+
+
+def test_invalid_fragment_closes_before_the_rest(pair):
+    wsock, client = pair
+    # the rest of the message never comes, the first fragment is enough
+    client.sendall(masked(b"ok \xc3\x28", OPCODE_TEXT, False))
+    assert wsock.receive() is None
+    assert close_code(client) == 1007
+
+
+def test_message_cut_inside_a_code_point(pair):
+    wsock, client = pair
+    client.sendall(b"".join([
+        masked(b"ok \xe2\x82", OPCODE_TEXT, False),
+        masked(b"", OPCODE_CONTINUATION),
+    ]))
+    assert wsock.receive() is None
+    assert close_code(client) == 1007
+
+
+def test_raw_text_is_not_decoded(pair):
+    wsock, client = pair
+    wsock.raw_text = True
+    client.sendall(fragments(b"\xffraw", 2))
+    assert wsock.receive() == b"\xffraw"
+
+
+def test_stream_closes_1007(pair):
+    wsock, client = pair
+    client.sendall(b"".join([
+        masked(b"fine", OPCODE_TEXT, False),
+        masked(b"\xf0\x28\x8c\x28", OPCODE_CONTINUATION),
+    ]))
+    stream = wsock.receive_stream()
+    assert stream.read(4) == "fine"
+    with pytest.raises(WebSocketError):
+        stream.read()
+
+    assert close_code(client) == 1007
@@ -16,26 +16,46 @@ License: MIT
 from __future__ import absolute_import, division, print_function
 
 from base64 import b64decode, b64encode
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from copy import copy
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
-from sys import version_info, exc_info
+from io import BytesIO
+from sys import version_info, exc_info, stderr
 from os import urandom
-from threading import Thread
-from time import sleep
+from threading import Condition, Lock, RLock, Thread, Timer
+from time import monotonic, sleep
+from types import GeneratorType
+import asyncio
+import codecs
+import heapq
+import mimetypes
+import os
+import selectors
+import signal
+import tempfile
 import traceback
 import logging
+import re
 import zlib
 import struct
 import socket
+import sys
+import weakref
 from socket import error as socket_error
-from wsgiref.simple_server import make_server, ServerHandler, WSGIRequestHandler, WSGIServer
+from wsgiref.simple_server import (make_server, ServerHandler,
+                                   WSGIRequestHandler, WSGIServer)
+from wsgiref.util import FileWrapper as BaseFileWrapper
 
 try:  # Py3
     from socketserver import ThreadingMixIn
-    from urllib.parse import urlencode
+    from urllib.parse import urlencode, unquote
 
 except ImportError:  # Py2
     from SocketServer import ThreadingMixIn
-    from urllib import urlencode
+    from urllib import urlencode, unquote
 
 try:
     import ssl
@@ -93,6 +113,11 @@ MSG_SOCKET_DEAD = "Socket is dead"
 MSG_ALREADY_CLOSED = "Connection is already closed"
 MSG_CLOSED = "Connection closed"
 
+# send() flag that never blocks, `None` where there is none (windows)
+DONTWAIT = getattr(socket, "MSG_DONTWAIT", None)
+# holds partial packets until it is cleared, Linux only
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
 # from bottlepy/bottle
 #: A dict to map HTTP status codes (e.g. 404) to phrases (e.g. 'Not Found')
 HTTP_CODES = httplib.responses.copy()
@@ -118,6 +143,65 @@ def log_traceback(ex):
     return tb_lines
 
 
+XOR_TABLES = [None] * 256
+
+
+def xor_table(byte):
+    """returns a cached translate() table that XORs each byte with `byte`"""
+    table = XOR_TABLES[byte]
+    if table is None:
+        table = XOR_TABLES[byte] = bytes(
+            bytearray(b ^ byte for b in range_type(256)))
+
+    return table
+
+
+def mask_bytes(mask, data, out=None):
+    """
+    XOR `data` with the 4 byte websocket `mask`, same as
+    `WebSocket.mask_payload` but without a Python level loop over the bytes.
+    The result is written to `out` (a bytearray at least as long as `data`,
+    which may be `data` itself to unmask in place) or to a new bytearray.
+    """
+    length = len(data)
+    if out is None:
+        out = bytearray(data)
+
+    elif out is not data:
+        out[:length] = data
+
+    if not length:
+        return out
+
+    mask = bytearray(mask)
+    if PY3 and length < 512:
+        # one big integer XOR is cheaper for small payloads
+        key = bytes(mask) * (length // 4 + 1)
+        value = int.from_bytes(out[:length], "big")
+        value ^= int.from_bytes(key[:length], "big")
+        out[:length] = value.to_bytes(length, "big")
+
+    else:
+        # four strided translate() calls, all done in C
+        for i in range_type(4):
+            out[i:length:4] = out[i:length:4].translate(xor_table(mask[i]))
+
+    return out
+
+
+def sends_nowait(websocket):
+    """
+    whether frames can be written to the socket of `websocket` without
+    blocking. not where there is no MSG_DONTWAIT, nor to ssl or timeout
+    sockets
+    """
+    sock = websocket.socket
+    if DONTWAIT is None or sock is None or websocket.sendmsg is None:
+        return False
+
+    return sock.gettimeout() is None
+
+
 class WebSocketError(socket_error):
     """
     Base class for all websocket errors.
@@ -142,6 +226,14 @@ class FrameTooLargeException(ProtocolError):
     pass
 
 
+class MessageTooLargeException(FrameTooLargeException):
+    """
+    Raised if a message is larger than `WebSocket.max_message_size`.
+    """
+
+    pass
+
+
 class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
     """This class is identical to WSGIServer but uses threads to handle
     requests by using the ThreadingMixIn. This is useful to handle web
@@ -150,10 +242,309 @@ class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
 
     multithread = True
     daemon_threads = True
+    # bind with SO_REUSEPORT, for processes sharing a port, see `run()`
+    reuse_port = False
+    # SO_SNDBUF and SO_RCVBUF bytes, `None` for the default. Set on the
+    # listening socket, connections inherit them before their TCP window
+    # scale is agreed on
+    sndbuf = None
+    rcvbuf = None
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        if self.sndbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                   self.sndbuf)
+
+        if self.rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   self.rcvbuf)
+
+        WSGIServer.server_bind(self)
+
+
+class SelectorWSGIServer(ThreadingWSGIServer):
+    """
+    ThreadingWSGIServer that parks upgraded websockets in one selector
+    (epoll) loop instead of keeping a thread blocked in `receive()` for
+    each of them. When a parked websocket gets data, it is read and the
+    buffered messages are handled by one of `workers` pool threads.
+    Apps park websockets by calling `environ["wsocket.park"]`, as
+    `WSocketApp` does.
+    """
+
+    workers = 16
+    read_size = 65536
+    request_queue_size = 1024
+
+    def __init__(self, *args, **kwargs):
+        ThreadingWSGIServer.__init__(self, *args, **kwargs)
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.selector = selectors.DefaultSelector()
+        self.parked = set()
+        self.pending = deque()
+        # wakes the selector up to register pending websockets
+        self.waker, self.wakeup = socket.socketpair()
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        self.selector_thread = Thread(target=self.select_forever)
+        self.selector_thread.daemon = True
+        self.selector_thread.start()
+
+    def park(self, wsock, callback):
+        """
+        Take over an upgraded websocket from its request thread.
+        `callback(wsock)` is called in a worker thread whenever data was
+        read and returns `False` once the websocket is done.
+        """
+        sock = wsock.environ["wsocket.socket"]
+        # the request's file may have read ahead, take what it buffered
+        stream = getattr(wsock.read, "__self__", None)
+        sock.setblocking(False)
+        try:
+            data = stream.read1(self.read_size) if stream else b""
+
+        except socket.error:
+            data = b""
+
+        finally:
+            sock.setblocking(True)
+
+        # from now on only the socket is read
+        wsock.read = wsock.read1 = sock.recv
+        wsock.readinto = None
+        self.parked.add(sock)
+        if data:
+            wsock.parser.feed(data)
+            self.pool.submit(self.service, sock, wsock, callback, False)
+
+        else:
+            self.watch(sock, wsock, callback)
+
+    def watch(self, sock, wsock, callback):
+        self.pending.append((sock, wsock, callback))
+        self.wakeup.send(b"\0")
+
+    def select_forever(self):
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self.waker:
+                    self.waker.recv(4096)
+                    while self.pending:
+                        sock, wsock, callback = self.pending.popleft()
+                        self.selector.register(sock, selectors.EVENT_READ,
+                                               (wsock, callback))
+
+                else:
+                    self.selector.unregister(key.fileobj)
+                    self.pool.submit(self.service, key.fileobj, key.data[0],
+                                     key.data[1])
+
+    def service(self, sock, wsock, callback, read=True):
+        try:
+            if read:
+                # the socket is readable, this does not block
+                data = sock.recv(self.read_size)
+                if not data:
+                    raise WebSocketError(MSG_CLOSED)
+
+                wsock.parser.feed(data)
+
+            # refuse a large message before its payload is buffered, as
+            # `read_frame()` does. the header may have come with this
+            # read, it is not decoded until the callback
+            if wsock.max_message_size is not None:
+                length = wsock.parser.frame_length()
+                if length is not None:
+                    wsock.check_size(length)
+
+            if callback(wsock):
+                self.watch(sock, wsock, callback)
+                return
+
+        except socket.error as e:
+            wsock.close_on_error(e)
+
+        except Exception as e:
+            logger.exception(e)
+
+        self.parked.discard(sock)
+        self.shutdown_request(sock)
+
+    def shutdown_request(self, request):
+        if request not in self.parked:
+            ThreadingWSGIServer.shutdown_request(self, request)
+
+    def server_close(self):
+        ThreadingWSGIServer.server_close(self)
+        self.pool.shutdown(wait=False)
+
+
+class FileWrapper(BaseFileWrapper):
+    """
+    `wsgi.file_wrapper` for `length` bytes of a file from `offset`, the
+    whole file if `length` is `None`. `FixedServerHandler` sends it with
+    `socket.sendfile`, so the file is copied to the socket by the kernel
+    where it can, other servers iterate it.
+    """
+
+    def __init__(self, filelike, blksize=65536, offset=0, length=None):
+        BaseFileWrapper.__init__(self, filelike, blksize)
+        self.offset = offset
+        self.length = length
+        if offset:
+            filelike.seek(offset)
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.blksize if remaining is None else min(
+                self.blksize, remaining)
+            data = self.filelike.read(size)
+            if not data:
+                return
+
+            if remaining is not None:
+                remaining -= len(data)
+
+            yield data
+
+    def sendfile(self, sock):
+        """write the file to `sock`, returns the number of bytes sent"""
+        return sock.sendfile(self.filelike, self.offset, self.length)
+
+
+class RequestBody(object):
+    """
+    `wsgi.input` reading at most `length` bytes of a request body from
+    `stream`, so a kept alive connection can read the next request.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.stream.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.stream.readline(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def discard(self, limit=65536):
+        """skip the unread body, `False` if more than `limit` bytes"""
+        if self.remaining > limit:
+            return False
+
+        while self.remaining:
+            if not self.read(self.remaining):
+                return False
+
+        return True
 
 
 class FixedServerHandler(ServerHandler):  # fixed serverhandler
-    http_version = "1.1"  # http versions below 1.1 is not supported by some clients such as Firefox
+    # http versions below 1.1 is not supported by some clients such as
+    # Firefox
+    http_version = "1.1"
+    wsgi_file_wrapper = FileWrapper
+    chunked = False  # whether the body is sent with chunked encoding
+
+    def cleanup_headers(self):
+        """
+        Frame the body so the connection can be kept alive, with chunked
+        encoding if it has no Content-Length, or else close it after this
+        response.
+        """
+        ServerHandler.cleanup_headers(self)
+        request = getattr(self, "request_handler", None)
+        if request is None:
+            return
+
+        code = int(self.status[:3])
+        if code == 101:  # the connection is the websocket's now
+            request.close_connection = True
+            return
+
+        if self.headers.get("Connection", "").lower() == "close":
+            request.close_connection = True
+
+        if request.close_connection:
+            pass
+
+        elif any((code < 200, code in (204, 304),
+                  "Content-Length" in self.headers,
+                  self.environ.get("REQUEST_METHOD") == "HEAD")):
+            pass  # the length of the body is known
+
+        elif all((self.environ.get("SERVER_PROTOCOL") == "HTTP/1.1",
+                  "Transfer-Encoding" not in self.headers)):
+            self.headers["Transfer-Encoding"] = "chunked"
+            self.chunked = True
+
+        else:
+            request.close_connection = True
+
+        if request.close_connection:
+            if "Connection" not in self.headers:
+                self.headers["Connection"] = "close"
+
+        elif self.environ.get("SERVER_PROTOCOL") == "HTTP/1.0":
+            self.headers["Connection"] = "keep-alive"
+
+    def write(self, data):
+        if self.chunked:
+            if not data:
+                return  # an empty chunk ends the body
+
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+
+        ServerHandler.write(self, data)
+
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        if self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+
+    def handle_error(self):
+        # the response may be cut short, the client can't read another one
+        request = getattr(self, "request_handler", None)
+        if request is not None:
+            request.close_connection = True
+
+        ServerHandler.handle_error(self)
+
+    def sendfile(self):
+        """send a `FileWrapper` result without reading it into python"""
+        sock = self.environ.get("wsocket.socket")
+        if sock is None or self.chunked:
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+
+        self.bytes_sent += self.result.sendfile(sock)
+        return True
 
     def _convert_string_type(self, value,
                              title):  # not in old versions of wsgiref
@@ -190,16 +581,48 @@ class FixedServerHandler(ServerHandler):  # fixed serverhandler
             for name, val in headers:
                 name = self._convert_string_type(name, "Header name")
                 val = self._convert_string_type(val, "Header value")
-                # removed hop by hop headers check otherwise it raises AssertionError for Upgrade and Connection headers
+                # removed hop by hop headers check otherwise it raises
+                # AssertionError for Upgrade and Connection headers
                 # assert not is_hop_by_hop(
                 #    name
-                # ), "Hop-by-hop header, '{}: {}', not allowed".format(name, val)
+                # ), "Hop-by-hop header, '{}: {}', not allowed".format(
+                #    name, val)
 
         self.send_headers()
         return self.write
 
 
 class FixedHandler(WSGIRequestHandler):  # fixed request handler
+    quiet = False
+    # keeps connections alive between requests, see `handle`
+    protocol_version = "HTTP/1.1"
+    keepalive_timeout = 5.0  # seconds to wait for the next request
+    max_requests = 100  # per connection, `None` for no limit
+    # socket options of connections, `run()` takes them too
+    tcp_nodelay = True
+    tcp_cork = False  # send a HTTP response in full packets, Linux only
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        sock = self.connection
+        try:
+            # responses are written in parts, with Nagle's algorithm the
+            # last one of a kept alive connection waits for the client's
+            # delayed ACK
+            if self.tcp_nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        except (socket.error, AttributeError):  # not TCP
+            pass
+
+    def cork(self, on):
+        """hold partial packets back while a response is written"""
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, TCP_CORK, on)
+
+        except socket.error:
+            pass
+
     def address_string(self):  # Prevent reverse DNS lookups please.
         return self.client_address[0]
 
@@ -210,10 +633,29 @@ class FixedHandler(WSGIRequestHandler):  # fixed request handler
     def get_app(self):
         return self.server.get_app()
 
-    def handle(self
-               ):  # to add FixedServerHandler we had to override entire method
-        """Handle a single HTTP request"""
+    def handle(self):
+        """
+        Handle HTTP requests until the connection is closed, by the
+        client, after `max_requests` or `keepalive_timeout` idle seconds.
+        """
+        self.requests = 0
+        self.handle_one_request()
+        while not self.close_connection:
+            self.connection.settimeout(self.keepalive_timeout)
+            try:
+                if not self.rfile.peek(1):
+                    return
+
+            except (socket.timeout, socket.error, ValueError):
+                return
+
+            self.connection.settimeout(self.timeout)
+            self.handle_one_request()
 
+    # to add FixedServerHandler we had to override entire method
+    def handle_one_request(self):
+        """Handle a single HTTP request"""
+        self.close_connection = True
         self.raw_requestline = self.rfile.readline(65537)
         if len(self.raw_requestline) > 65536:
             self.requestline = ""
@@ -225,279 +667,1138 @@ class FixedHandler(WSGIRequestHandler):  # fixed request handler
         if not self.parse_request():  # An error code has been sent, just exit
             return
 
-        handler = FixedServerHandler(self.rfile, self.wfile, self.get_stderr(),
-                                     self.get_environ())
-        handler.request_handler = self  # backpointer for logging
-        handler.run(self.get_app())
-
-
-class WebSocket(object):
-    """
-    Base class for supporting websocket operations.
-    """
-
-    origin = None
-    protocol = None
-    version = None
-    path = None
-    logger = logger
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            self.close_connection = True
 
-    def __init__(self, environ, read, write, handler, do_compress):
-        self.environ = environ
-        self.closed = False
-        self.write = write
-        self.read = read
-        self.handler = handler
-        self.do_compress = do_compress
-        self.origin = self.environ.get(
-            "HTTP_SEC_WEBSOCKET_ORIGIN") or self.environ.get("HTTP_ORIGIN")
-        self.protocols = list(
-            map(str.strip,
-                self.environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL",
-                                 "").split(",")))
-        self.version = int(
-            self.environ.get("HTTP_SEC_WEBSOCKET_VERSION", "0").strip())
-        self.path = self.environ.get("PATH_INFO", "/")
-        if do_compress:
-            self.compressor = zlib.compressobj(7, zlib.DEFLATED,
-                                               -zlib.MAX_WBITS)
-            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        environ = self.get_environ()
+        # lets websockets write frames straight to the socket
+        environ["wsocket.socket"] = self.connection
+        park = getattr(self.server, "park", None)
+        if park is not None:
+            environ["wsocket.park"] = park
 
-    def __del__(self):
+        # a kept alive connection must not read past the body
+        stdin = self.rfile
         try:
-            self.close()
-        except:
-            # close() may fail if __init__ didn't complete
-            pass
+            length = int(environ.get("CONTENT_LENGTH") or 0)
 
-    def _decode_bytes(self, bytestring):
-        if not bytestring:
-            return ""
+        except ValueError:
+            length = -1
 
-        try:
-            return bytestring.decode("utf-8")
+        if length < 0 or "HTTP_TRANSFER_ENCODING" in environ:
+            self.close_connection = True
 
-        except UnicodeDecodeError as e:
-            print('UnicodeDecodeError')
-            self.close(1007, str(e))
-            raise
+        elif length:
+            stdin = RequestBody(self.rfile, length)
 
-    def _encode_bytes(self, text):
-        if not isinstance(text, str):
-            text = text_type(text or "")
+        handler = FixedServerHandler(stdin, self.wfile, self.get_stderr(),
+                                     environ)
+        handler.request_handler = self  # backpointer for logging
+        # not websockets, a corked socket holds their frames for 200 ms
+        cork = all((self.tcp_cork, TCP_CORK is not None,
+                    "HTTP_UPGRADE" not in environ))
+        if cork:
+            self.cork(1)
 
-        return text.encode("utf-8")
+        try:
+            handler.run(self.get_app())
 
-    def _is_valid_close_code(self, code):
-        # valid hybi close code?
-        if (code < 1000 or 1004 <= code <= 1006 or 1012 <= code <= 1016
-                or code ==
-                1100  # not sure about this one but the autobahn fuzzer requires it.
-                or 2000 <= code <= 2999):
-            return False
+        finally:
+            if cork:
+                self.cork(0)  # sends the rest
 
-        return True
+        if stdin is not self.rfile and not self.close_connection:
+            self.close_connection = not stdin.discard()
 
-    def handle_close(self, payload):
-        if not payload:
-            self.close(1000, "")
-            return
 
-        if len(payload) < 2:
-            raise ProtocolError("Invalid close frame: %s" % payload)
+class FrameParser(object):
+    """
+    Incremental decoder for websocket frames.
 
-        code = struct.unpack("!H", payload[:2])[0]
-        payload = payload[2:]
-        if payload:
-            payload.decode("utf-8")
+    Raw bytes are added with `feed()` and complete frames are taken out with
+    `next_frame()`, which returns `None` while the buffered data does not
+    hold a whole frame yet. `needed` is the number of bytes still missing
+    before the decoder can make progress.
+    """
 
-        if not self._is_valid_close_code(code):
-            raise ProtocolError("Invalid close code %s" % code)
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.needed = 2
+        self.header = None  # decoded header of an incomplete frame
+        self.frames = 0  # frames and bytes decoded, see `Metrics`
+        self.received = 0
 
-        self.close(code, payload)
+    def feed(self, data):
+        if self.offset:
+            # cheap, bytearray drops its head without moving the data
+            del self.buffer[:self.offset]
+            self.offset = 0
 
-    def handle_ping(self, payload):
-        self.send_frame(payload, self.OPCODE_PONG)
+        self.buffer += data
+        self.received += len(data)
 
-    def handle_pong(self, payload):
-        pass
+    def frame_length(self):
+        """
+        Payload length of the data frame being received, `None` until its
+        header is buffered and for control frames, that are small anyway.
+        The buffer is left as it is.
+        """
+        if self.header is not None:
+            return self.header[4] if self.header[1] <= 0x07 else None
 
-    def mask_payload(self, mask, length, payload):
-        payload = bytearray(payload)
-        mask = bytearray(mask)
-        for i in range_type(length):
-            payload[i] ^= mask[i % 4]
+        buf = self.buffer
+        have = len(buf) - self.offset
+        if have < 2 or buf[self.offset] & OPCODE_MASK > 0x07:
+            return None
 
-        return payload
+        length = buf[self.offset + 1] & LENGTH_MASK
+        if length == 126:
+            if have < 4:
+                return None
 
-    def read_message(self):
-        opcode = None
-        message = bytearray()
+            return struct.unpack_from("!H", buf, self.offset + 2)[0]
 
-        while True:
-            data = self.read(2)
+        if length == 127:
+            if have < 10:
+                return None
 
-            if len(data) != 2:
-                first_byte, second_byte = 0, 0
+            return struct.unpack_from("!Q", buf, self.offset + 2)[0]
 
-            else:
-                first_byte, second_byte = struct.unpack("!BB", data)
+        return length
 
+    def read_payload(self, readinto):
+        """
+        Complete the pending frame by reading the rest of its payload from
+        `readinto` straight into place, for payloads too large to buffer.
+        """
+        fin, opcode, flags, mask, length = self.header
+        buf = self.buffer
+        payload = bytearray(length)
+        have = len(buf) - self.offset
+        payload[:have] = buf[self.offset:]
+        self.buffer = bytearray()
+        self.offset = 0
+        self.needed = 2
+        self.header = None
+
+        if readinto(memoryview(payload)[have:]) != length - have:
+            raise WebSocketError("Unexpected EOF reading frame payload")
+
+        self.received += length - have
+
+        return fin, opcode, flags, mask, payload
+
+    def next_frame(self):
+        buf = self.buffer
+        size = len(buf)
+
+        if self.header is None:
+            offset = self.offset
+            if size - offset < 2:
+                self.needed = 2 - size + offset
+                return None
+
+            first_byte = buf[offset]
+            second_byte = buf[offset + 1]
             fin = first_byte & FIN_MASK
-            f_opcode = first_byte & OPCODE_MASK
+            opcode = first_byte & OPCODE_MASK
             flags = first_byte & HEADER_FLAG_MASK
             length = second_byte & LENGTH_MASK
-            has_mask = second_byte & MASK_MASK == MASK_MASK
 
-            if f_opcode > 0x07:
+            if opcode > 0x07:
                 if not fin:
                     raise ProtocolError(
                         "Received fragmented control frame: {0!r}".format(
-                            data))
-                # Control frames MUST have a payload length of 125 bytes or less
+                            bytes(buf[offset:offset + 2])))
+                # Control frames MUST have a payload of 125 bytes or less
                 if length > 125:
                     raise FrameTooLargeException(
                         "Control frame cannot be larger than 125 bytes: "
-                        "{0!r}".format(data))
+                        "{0!r}".format(bytes(buf[offset:offset + 2])))
 
+            start = offset + 2
             if length == 126:
-                # 16 bit length
-                data = self.read(2)
-                if len(data) != 2:
-                    raise WebSocketError(
-                        "Unexpected EOF while decoding header")
-                length = struct.unpack("!H", data)[0]
+                start += 2
 
             elif length == 127:
-                # 64 bit length
-                data = self.read(8)
-                if len(data) != 8:
-                    raise WebSocketError(
-                        "Unexpected EOF while decoding header")
-                length = struct.unpack("!Q", data)[0]
-
-            if has_mask:
-                mask = self.read(4)
-                if len(mask) != 4:
-                    raise WebSocketError(
-                        "Unexpected EOF while decoding header")
-
-            if self.do_compress and (flags & RSV0_MASK):
-                flags &= ~RSV0_MASK
-                compressed = True
+                start += 8
 
-            else:
-                compressed = False
+            if second_byte & MASK_MASK:
+                start += 4
+
+            if size < start:
+                self.needed = start - size
+                return None
 
-            if flags:
-                raise ProtocolError(str(flags))
+            self.frames += 1
+            if length == 126:
+                # 16 bit length
+                length = struct.unpack_from("!H", buf, offset + 2)[0]
+
+            elif length == 127:
+                # 64 bit length
+                length = struct.unpack_from("!Q", buf, offset + 2)[0]
 
-            if not length:
-                payload = b""
+            if second_byte & MASK_MASK:
+                mask = bytes(buf[start - 4:start])
 
             else:
-                try:
-                    payload = self.read(length)
+                mask = None
 
-                except socket.error:
-                    payload = b""
+            end = start + length
+            if size < end:
+                # keep the decoded header until the payload arrives
+                self.header = fin, opcode, flags, mask, length
+                self.offset = start
+                self.needed = end - size
+                return None
 
-                except Exception:
-                    raise WebSocketError("Could not read payload")
+        else:
+            fin, opcode, flags, mask, length = self.header
+            start = self.offset
+            end = start + length
+            if size < end:
+                self.needed = end - size
+                return None
 
-                if len(payload) != length:
-                    raise WebSocketError(
-                        "Unexpected EOF reading frame payload")
+            self.header = None
 
-                if has_mask:
-                    payload = self.mask_payload(mask, length, payload)
+        if end == size:
+            # the frame fills the buffer, hand it over instead of copying
+            self.buffer = bytearray()
+            self.offset = 0
+            if start:
+                del buf[:start]
 
-                if compressed:
-                    payload = b"".join((
-                        self.decompressor.decompress(bytes(payload)),
-                        self.decompressor.decompress(b"\0\0\xff\xff"),
-                        self.decompressor.flush(),
-                    ))
+            return fin, opcode, flags, mask, buf
 
-            if f_opcode in (OPCODE_TEXT, OPCODE_BINARY):
-                # a new frame
-                if opcode:
-                    raise ProtocolError("The opcode in non-fin frame is "
-                                        "expected to be zero, got "
-                                        "{0!r}".format(f_opcode))
+        self.offset = end
+        return fin, opcode, flags, mask, buf[start:end]
 
-                opcode = f_opcode
+    def next_piece(self):
+        """
+        Like `next_frame()`, but the buffered part of an incomplete data
+        frame is returned too, as if the frame had been split in
+        fragments. The rest of it follows as continuation frames, with the
+        mask turned to their offset.
+        """
+        frame = self.next_frame()
+        if frame is not None or self.header is None:
+            return frame
 
-            elif f_opcode == OPCODE_CONTINUATION:
-                if not opcode:
-                    raise ProtocolError("Unexpected frame with opcode=0")
+        fin, opcode, flags, mask, length = self.header
+        have = len(self.buffer) - self.offset
+        if opcode > 0x07 or not have:
+            return None
 
-            elif f_opcode == OPCODE_PING:
-                self.handle_ping(payload)
-                continue
+        payload = self.buffer[self.offset:]
+        self.buffer = bytearray()
+        self.offset = 0
+        rest_mask = mask
+        if mask is not None:
+            turn = have % 4
+            rest_mask = mask[turn:] + mask[:turn]
 
-            elif f_opcode == OPCODE_PONG:
-                self.handle_pong(payload)
-                continue
+        self.header = fin, OPCODE_CONTINUATION, 0, rest_mask, length - have
+        self.needed = length - have
+        return False, opcode, flags, mask, payload
 
-            elif f_opcode == OPCODE_CLOSE:
-                print('opcode close')
-                self.handle_close(payload)
-                return
 
-            else:
-                raise ProtocolError("Unexpected opcode={0!r}".format(f_opcode))
+def parse_extensions(header):
+    """
+    `[(name, [(param, value), ...]), ...]` of a Sec-WebSocket-Extensions
+    header, `value` is `True` for params without one
+    """
+    extensions = []
+    for offer in header.split(","):
+        parts = [part.strip() for part in offer.split(";")]
+        if not parts[0]:
+            continue
 
-            if opcode == OPCODE_TEXT:
-                payload.decode("utf-8")
+        params = []
+        for part in parts[1:]:
+            name, eq, value = part.partition("=")
+            params.append((name.strip(),
+                           value.strip().strip('"') if eq else True))
 
-            message += payload
+        extensions.append((parts[0], params))
 
-            if fin:
-                break
+    return extensions
 
-        if opcode == OPCODE_TEXT:
-            return self._decode_bytes(message)
 
-        else:
-            return message
+class PerMessageDeflate(object):
+    """
+    permessage-deflate (RFC 7692) settings. `WSocketApp.deflate` is the
+    policy of the server, `accept()` turns a client offer into the
+    settings of one connection.
+
+    A compressor costs about `2 ** (server_window_bits + 2) +
+    2 ** (mem_level + 9)` bytes and a decompressor `2 **
+    client_window_bits`, 256 KB and 32 KB with the defaults. With
+    `*_no_context_takeover` they only exist while a message is
+    compressed or decompressed, instead of for the whole connection.
+
+    It is also the compression policy of sent messages: messages under
+    `min_size` bytes are sent as they are, `levels` are `(size, level)`
+    pairs that pick the level of messages of at least `size` bytes and
+    a connection stops compressing once more than `sample_size` bytes
+    were compressed to over `max_ratio` of their size. The `*_in` and
+    `*_out` counters are bytes received and sent by one connection.
+    """
 
-    def receive(self):
+    min_size = 128
+    levels = ()
+    max_ratio = 0.95  # `None` never stops compressing
+    sample_size = 65536
+
+    def __init__(self, level=7, mem_level=8, server_window_bits=15,
+                 client_window_bits=15, server_no_context_takeover=False,
+                 client_no_context_takeover=False, **policy):
+        if not 9 <= server_window_bits <= 15:
+            # zlib can not compress with a 256 byte window
+            raise ValueError("server_window_bits must be 9 to 15")
+
+        if not 8 <= client_window_bits <= 15:
+            raise ValueError("client_window_bits must be 8 to 15")
+
+        self.level = level
+        self.mem_level = mem_level
+        self.server_window_bits = server_window_bits
+        self.client_window_bits = client_window_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        for name, value in policy.items():
+            if name not in ("min_size", "levels", "max_ratio",
+                            "sample_size"):
+                raise TypeError("unexpected keyword argument %r" % name)
+
+            setattr(self, name, value)
+
+        self.levels = sorted(self.levels)
+        self.reset()
+
+    def reset(self):
+        self.enabled = True  # compress sent messages
+        self.raw_in = 0  # size of received compressed messages
+        self.compressed_in = 0  # and their compressed size
+        self.raw_out = 0  # size of messages sent compressed
+        self.compressed_out = 0  # and their compressed size
+        self.plain_out = 0  # size of messages sent uncompressed by policy
+
+    def accept(self, params):
         """
-        Read and return a message from the stream. If `None` is returned, then
-        the socket is considered closed/errored.
+        Settings for an offer with these `(param, value)` pairs, or `None`
+        if it can not be accepted.
         """
-        if self.closed:
-            print('receive closed')
-            self.handler.on_close(MSG_ALREADY_CLOSED)
-            raise WebSocketError(MSG_ALREADY_CLOSED)
+        names = [name for name, value in params]
+        if len(set(names)) != len(names):
+            return None
+
+        server_bits = self.server_window_bits
+        client_bits = 15
+        server_no_context = self.server_no_context_takeover
+        client_no_context = self.client_no_context_takeover
+        for name, value in params:
+            if name in ("server_no_context_takeover",
+                        "client_no_context_takeover"):
+                if value is not True:
+                    return None
+
+                if name == "server_no_context_takeover":
+                    server_no_context = True
 
-        try:
-            return self.read_message()
+                else:
+                    client_no_context = True
 
-        except UnicodeError as e:
-            print('UnicodeDecodeError')
-            self.close(1007, str(e).encode())
+            elif name in ("server_max_window_bits", "client_max_window_bits"):
+                if value is True and name == "client_max_window_bits":
+                    # the client lets us choose
+                    bits = 15
 
-        except ProtocolError as e:
-            print('Protocol err', e)
-            self.close(1002, str(e).encode())
+                elif value is True or not value.isdigit():
+                    return None
 
-        except socket.timeout as e:
-            print('timeout')
-            self.close(message=str(e))
-            self.handler.on_close(MSG_CLOSED)
+                else:
+                    bits = int(value)
 
-        except socket.error as e:
-            print('spcket err')
-            self.close(message=str(e))
-            self.handler.on_close(MSG_CLOSED)
+                if not 8 <= bits <= 15:
+                    return None
 
-        return None
+                if name == "client_max_window_bits":
+                    client_bits = min(bits, self.client_window_bits)
 
-    def encode_header(self, fin, opcode, mask, length, flags):
-        first_byte = opcode
-        second_byte = 0
+                elif bits < 9:
+                    return None
+
+                else:
+                    server_bits = min(bits, server_bits)
+
+            else:
+                return None
+
+        deflate = copy(self)
+        deflate.server_window_bits = server_bits
+        deflate.client_window_bits = client_bits
+        deflate.server_no_context_takeover = server_no_context
+        deflate.client_no_context_takeover = client_no_context
+        deflate.reset()
+        return deflate
+
+    def response(self):
+        """the Sec-WebSocket-Extensions value for these settings"""
+        params = ["permessage-deflate"]
+        if self.server_no_context_takeover:
+            params.append("server_no_context_takeover")
+
+        if self.client_no_context_takeover:
+            params.append("client_no_context_takeover")
+
+        if self.server_window_bits < 15:
+            params.append("server_max_window_bits=%d" %
+                          self.server_window_bits)
+
+        if self.client_window_bits < 15:
+            params.append("client_max_window_bits=%d" %
+                          self.client_window_bits)
+
+        return "; ".join(params)
+
+    def offer(self):
+        """the Sec-WebSocket-Extensions value a client offers"""
+        return "permessage-deflate"
+
+    def confirm(self, params):
+        """
+        Client settings for the `(param, value)` pairs a server accepted
+        `offer()` with, or `None` if they are invalid. The roles swap:
+        the `server_*` settings are of the messages a client sends and
+        the `client_*` ones of the messages it receives.
+        """
+        names = [name for name, value in params]
+        if len(set(names)) != len(names):
+            return None
+
+        deflate = copy(self)
+        deflate.server_window_bits = deflate.client_window_bits = 15
+        deflate.server_no_context_takeover = False
+        deflate.client_no_context_takeover = False
+        for name, value in params:
+            if name == "server_no_context_takeover" and value is True:
+                deflate.client_no_context_takeover = True
+
+            elif name == "client_no_context_takeover" and value is True:
+                deflate.server_no_context_takeover = True
+
+            elif name == "server_max_window_bits" and value is not True:
+                if not value.isdigit() or not 8 <= int(value) <= 15:
+                    return None
+
+                deflate.client_window_bits = int(value)
+
+            else:
+                # client_max_window_bits was not offered
+                return None
+
+        deflate.reset()
+        return deflate
+
+    def level_for(self, size):
+        """compression level of a `size` bytes message, `None` for none"""
+        if not self.enabled or size < self.min_size:
+            return None
+
+        level = self.level
+        for min_size, size_level in self.levels:
+            if size < min_size:
+                break
+
+            level = size_level
+
+        return level
+
+    def count_out(self, raw, compressed):
+        """count a sent message, stop compressing if it does not pay"""
+        self.raw_out += raw
+        self.compressed_out += compressed
+        if self.max_ratio is None or self.raw_out < self.sample_size:
+            return
+
+        if self.compressed_out > self.max_ratio * self.raw_out:
+            self.enabled = False
+
+    def compressobj(self, level=None):
+        return zlib.compressobj(self.level if level is None else level,
+                                zlib.DEFLATED, -self.server_window_bits,
+                                self.mem_level)
+
+    def decompressobj(self):
+        return zlib.decompressobj(-self.client_window_bits)
+
+
+class Metrics(object):
+    """
+    Counters and histograms of the server. `render()` gives them in the
+    Prometheus text format and the registry is a WSGI app serving that,
+    eg:- `app.route("/metrics")(metrics)`.
+
+    Frames and bytes are counted in plain attributes of each websocket
+    (and its parser), which only its reader and the holder of its send
+    lock change, so the frame path takes no lock and makes no call. They
+    are added up when rendered and kept when the websocket closes. Other
+    metrics are updated with `inc()` and `observe()` under a lock.
+    """
+    # upper bounds of histogram buckets, seconds
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0)
+    described = {
+        "wsocket_connections": ("gauge", "Open websockets."),
+        "wsocket_handshakes_total":
+        ("counter", "Websocket handshakes accepted."),
+        "wsocket_handshake_failures_total":
+        ("counter", "Websocket handshakes refused, by reason."),
+        "wsocket_frames_total": ("counter", "Websocket frames, by direction."),
+        "wsocket_bytes_total":
+        ("counter", "Bytes of websocket frames, by direction."),
+        "wsocket_deflate_raw_bytes_total":
+        ("counter", "Size of compressed messages, by direction."),
+        "wsocket_deflate_compressed_bytes_total":
+        ("counter", "Compressed size of compressed messages, by direction."),
+        "wsocket_closes_total": ("counter", "Websockets closed, by code."),
+        "wsocket_handler_seconds":
+        ("histogram", "Run time of event handlers, by handler."),
+        "wsocket_ping_rtt_seconds":
+        ("histogram", "Round trip time of heartbeat pings."),
+        "wsocket_heartbeat_closes_total":
+        ("counter", "Websockets closed by the heartbeat, by reason."),
+        "wsocket_send_queue_dropped_total":
+        ("counter", "Messages dropped by full send queues."),
+        "wsocket_send_queue_coalesced_total":
+        ("counter", "Queued messages replaced by a newer one of their key."),
+        "wsocket_send_queue_blocked_total":
+        ("counter", "Senders that waited for room in a send queue."),
+    }
+    # websocket counters, `(metric, labels, attribute path)`
+    websocket_counters = (
+        ("wsocket_frames_total", (("direction", "in"), ), ("parser",
+                                                           "frames")),
+        ("wsocket_frames_total", (("direction", "out"), ), ("frames_out", )),
+        ("wsocket_bytes_total", (("direction", "in"), ), ("parser",
+                                                          "received")),
+        ("wsocket_bytes_total", (("direction", "out"), ), ("bytes_out", )),
+        ("wsocket_deflate_raw_bytes_total", (("direction", "in"), ),
+         ("deflate", "raw_in")),
+        ("wsocket_deflate_raw_bytes_total", (("direction", "out"), ),
+         ("deflate", "raw_out")),
+        ("wsocket_deflate_compressed_bytes_total", (("direction", "in"), ),
+         ("deflate", "compressed_in")),
+        ("wsocket_deflate_compressed_bytes_total", (("direction", "out"), ),
+         ("deflate", "compressed_out")),
+        ("wsocket_send_queue_dropped_total", (), ("send_queue", "dropped")),
+        ("wsocket_send_queue_coalesced_total", (), ("send_queue",
+                                                    "coalesced")),
+        ("wsocket_send_queue_blocked_total", (), ("send_queue", "blocked")),
+    )
+
+    def __init__(self):
+        # reentrant, a websocket may be closed by the garbage collector
+        # while the lock is held
+        self.lock = RLock()
+        self.counters = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [bucket counts, +Inf, sum]
+        self.websockets = weakref.WeakSet()
+
+    def inc(self, name, value=1, labels=()):
+        """add `value` to a counter, `labels` are `(name, value)` pairs"""
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """count `value` in a histogram"""
+        key = (name, labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(self.buckets) + 2)
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def track(self, wsock):
+        """count the frames of a new websocket"""
+        with self.lock:
+            self.websockets.add(wsock)
+
+    def retire(self, wsock):
+        """keep the counts of a closing websocket"""
+        with self.lock:
+            if wsock in self.websockets:
+                self.websockets.discard(wsock)
+                self.add_websocket(self.counters, wsock)
+
+    def add_websocket(self, counters, wsock):
+        for name, labels, path in self.websocket_counters:
+            value = wsock
+            for attr in path:
+                value = getattr(value, attr, None)
+
+            if value:
+                key = (name, labels)
+                counters[key] = counters.get(key, 0) + value
+
+    def collect(self):
+        """`(counters, histograms)`, copies with the open websockets"""
+        with self.lock:
+            counters = dict(self.counters)
+            for wsock in list(self.websockets):
+                self.add_websocket(counters, wsock)
+
+            counters[("wsocket_connections", ())] = len(self.websockets)
+            histograms = dict(
+                (key, list(counts))
+                for key, counts in self.histograms.items())
+
+        return counters, histograms
+
+    def render(self):
+        """the metrics in the Prometheus text exposition format"""
+        counters, histograms = self.collect()
+        samples = {}  # name: [(suffix, labels, value)]
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(("", labels, value))
+
+        for (name, labels), counts in histograms.items():
+            rows = samples.setdefault(name, [])
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf", ), counts):
+                total += count
+                rows.append(("_bucket", labels + (("le", str(bound)), ),
+                             total))
+
+            rows.append(("_sum", labels, counts[-1]))
+            rows.append(("_count", labels, total))
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self.described.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples[name]:
+                if labels:
+                    labels = "{%s}" % ",".join(
+                        '%s="%s"' % (label, str(text).replace(
+                            "\\", "\\\\").replace('"', '\\"').replace(
+                                "\n", "\\n")) for label, text in labels)
+
+                lines.append("%s%s%s %s" % (name, suffix, labels or "",
+                                            repr(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def __call__(self, environ, start_response):
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+        start_response("200 OK", [("Content-Type", content_type)])
+        return [self.render().encode("utf-8")]
+
+
+# the registry `wsocket` counts in
+metrics = Metrics()
+
+
+class WebSocket(object):
+    """
+    Base class for supporting websocket operations.
+    """
+
+    origin = None
+    protocol = None
+    version = None
+    path = None
+    logger = logger
+    read_buffer_size = 65536
+    gather_size = 16384  # smaller payloads are joined to the header
+    # larger messages are refused with code 1009, `None` for no limit.
+    # `receive_stream()` does not hold messages, it has no limit
+    max_message_size = None
+    # text messages are returned as the bytes received, not decoded nor
+    # checked to be UTF-8(eg:- for `json.loads()`, that checks them)
+    raw_text = False
+    # masking engine, `unmask(mask, data, out)`. `mask_payload` is the
+    # reference implementation
+    unmask = staticmethod(mask_bytes)
+    masked = False  # frames this end sends are masked(clients)
+    send_queue = None  # a `SendQueue` of messages `send()` queues
+    # seconds of the last ping round trip, see `Heartbeat`
+    rtt = None
+    ping_payload = None  # of the ping waiting for its pong
+    ping_sent = None
+    pongs = 0
+
+    def __init__(self, environ, read, write, handler, do_compress):
+        self.environ = environ
+        self.closed = False
+        self.write = write
+        self.read = read
+        self.handler = handler
+        self.parser = FrameParser()
+        self.message_opcode = None  # opcode and data of a fragmented message
+        self.message_buffer = None
+        self.message_size = 0  # bytes of it, after decompression
+        self.text_decoder = None  # of a fragmented text message
+        # frames of concurrent senders must not interleave, nor messages,
+        # but control frames may go between the fragments of a message
+        self.send_lock = Lock()
+        self.message_lock = Lock()
+        self.batched = None  # frames written in a `batch()`
+        # take whole chunks when `read` belongs to a buffered stream
+        # (eg:- the socket file in wsgi.input)
+        stream = getattr(read, "__self__", None)
+        if getattr(stream, "read", None) == read:
+            self.read1 = getattr(stream, "read1", None)
+            self.readinto = getattr(stream, "readinto", None)
+
+        else:
+            self.read1 = self.readinto = None
+        self.do_compress = bool(do_compress)
+        self.origin = self.environ.get(
+            "HTTP_SEC_WEBSOCKET_ORIGIN") or self.environ.get("HTTP_ORIGIN")
+        self.protocols = list(
+            map(str.strip,
+                self.environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL",
+                                 "").split(",")))
+        self.version = int(
+            self.environ.get("HTTP_SEC_WEBSOCKET_VERSION", "0").strip())
+        self.path = self.environ.get("PATH_INFO", "/")
+        # `do_compress` is the `PerMessageDeflate` agreed in the handshake,
+        # `True` for the defaults
+        if do_compress and not isinstance(do_compress, PerMessageDeflate):
+            do_compress = PerMessageDeflate()
+
+        self.deflate = do_compress or None
+        # the compressor is made for the first compressed message.
+        # without context takeover, (de)compressors are made per message
+        self.compressor = self.decompressor = self.compressor_level = None
+        self.inflater = None  # decompressor of the message being read
+        self.inflate_input = None  # `(data, fin)` left by `next_chunk()`
+        if do_compress and not do_compress.client_no_context_takeover:
+            self.decompressor = do_compress.decompressobj()
+
+        # write straight to the socket, if the server exposes it.
+        # SSL sockets can not do gather writes with sendmsg()
+        sock = self.socket = self.environ.get("wsocket.socket")
+        self.sendall = getattr(sock, "sendall", None)
+        self.sendmsg = getattr(sock, "sendmsg", None)
+        if isinstance(sock, getattr(ssl, "SSLSocket", ())):
+            self.sendmsg = None
+
+        # counted under the send lock, received ones by `parser`
+        self.frames_out = self.bytes_out = 0
+        metrics.track(self)
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            # close() may fail if __init__ didn't complete
+            pass
+
+    def _decode_bytes(self, bytestring):
+        if not bytestring:
+            return ""
+
+        try:
+            return bytestring.decode("utf-8")
+
+        except UnicodeDecodeError as e:
+            print('UnicodeDecodeError')
+            self.close(1007, str(e))
+            raise
+
+    def _encode_bytes(self, text):
+        if isinstance(text, (bytes, bytearray)):
+            return bytes(text)
+
+        if not isinstance(text, str):
+            text = text_type(text or "")
+
+        return text.encode("utf-8")
+
+    def _is_valid_close_code(self, code):
+        # valid hybi close code? not sure about 1100 but the autobahn
+        # fuzzer requires it.
+        if any((code < 1000, 1004 <= code <= 1006, 1012 <= code <= 1016,
+                code == 1100, 2000 <= code <= 2999)):
+            return False
+
+        return True
+
+    def handle_close(self, payload):
+        if not payload:
+            self.close(1000, "")
+            return
+
+        if len(payload) < 2:
+            raise ProtocolError("Invalid close frame: %s" % payload)
+
+        code = struct.unpack("!H", payload[:2])[0]
+        payload = payload[2:]
+        if payload:
+            payload.decode("utf-8")
+
+        if not self._is_valid_close_code(code):
+            raise ProtocolError("Invalid close code %s" % code)
+
+        self.close(code, payload)
+
+    def handle_ping(self, payload):
+        self.send_frame(payload, OPCODE_PONG)
+
+    def handle_pong(self, payload):
+        self.pongs += 1
+        if self.ping_payload is not None and payload == self.ping_payload:
+            self.rtt = monotonic() - self.ping_sent
+            self.ping_payload = None
+            metrics.observe("wsocket_ping_rtt_seconds", self.rtt)
+
+    def mask_payload(self, mask, length, payload):
+        payload = bytearray(payload)
+        mask = bytearray(mask)
+        for i in range_type(length):
+            payload[i] ^= mask[i % 4]
+
+        return payload
+
+    def read_frame(self):
+        """
+        Read from the stream until the parser holds a complete frame and
+        return it as `(fin, opcode, flags, mask, payload)`. Data is pulled
+        in large chunks when the stream is buffered.
+        """
+        parser = self.parser
+        frame = None
+
+        while frame is None:
+            needed = parser.needed
+            if needed > self.read_buffer_size:
+                if parser.header is not None:
+                    # refuse large messages before their payload is read
+                    if self.max_message_size is not None:
+                        self.check_size(parser.header[4])
+
+                    if self.readinto is not None:
+                        return parser.read_payload(self.readinto)
+
+                data = self.read(needed)
+
+            elif self.read1 is not None:
+                data = self.read1(self.read_buffer_size)
+
+            else:
+                data = self.read(needed)
+
+            if not data:
+                raise WebSocketError("Unexpected EOF while decoding frame")
+
+            parser.feed(data)
+            frame = parser.next_frame()
+
+        return frame
+
+    def read_message(self, block=True):
+        while True:
+            frame = self.parser.next_frame()
+            if frame is None:
+                if not block:
+                    return None
+
+                frame = self.read_frame()
+
+            message = self.handle_frame(frame)
+            if message is not None or self.closed:
+                return message
+
+    def decode_frame(self, frame):
+        """
+        Unmask a frame and handle it if it is a control frame. Returns
+        `(opcode, fin, payload)` of data frames, `opcode` being the one of
+        their message, or `None`. The payload is not decompressed yet.
+        """
+        fin, f_opcode, flags, mask, payload = frame
+        opcode = self.message_opcode
+
+        # only the first frame of a compressed message has RSV1 set
+        compressed = False
+        if self.do_compress and (flags & RSV0_MASK):
+            if f_opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                flags &= ~RSV0_MASK
+                compressed = True
+
+        if flags:
+            raise ProtocolError(str(flags))
+
+        if payload and mask:
+            payload = self.unmask(mask, payload, payload)
+
+        if f_opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            # a new frame
+            if opcode:
+                raise ProtocolError("The opcode in non-fin frame is "
+                                    "expected to be zero, got "
+                                    "{0!r}".format(f_opcode))
+
+            opcode = self.message_opcode = f_opcode
+            if compressed:
+                self.inflater = self.decompressor
+                if self.inflater is None:
+                    self.inflater = self.deflate.decompressobj()
+
+        elif f_opcode == OPCODE_CONTINUATION:
+            if not opcode:
+                raise ProtocolError("Unexpected frame with opcode=0")
+
+        elif f_opcode == OPCODE_PING:
+            self.handle_ping(payload)
+            return None
+
+        elif f_opcode == OPCODE_PONG:
+            self.handle_pong(payload)
+            return None
+
+        elif f_opcode == OPCODE_CLOSE:
+            self.handle_close(payload)
+            return None
+
+        else:
+            raise ProtocolError("Unexpected opcode={0!r}".format(f_opcode))
+
+        return opcode, fin, payload
+
+    def handle_frame(self, frame):
+        """
+        Process a decoded frame. Returns the message once its final frame
+        arrived, `None` while more frames are needed or after a close.
+        """
+        data = self.decode_frame(frame)
+        if data is None:
+            return None
+
+        opcode, fin, payload = data
+        message = self.message_buffer
+        if self.inflater is not None:
+            payload = self.inflate(payload, fin)
+
+        elif self.max_message_size is not None:
+            self.check_size(len(payload))
+
+        if opcode == OPCODE_TEXT and not self.raw_text:
+            return self.handle_text(payload, fin)
+
+        if message is None:
+            if fin and isinstance(payload, bytearray):
+                # unfragmented message, no need to copy the payload
+                message = payload
+
+            else:
+                message = bytearray(payload)
+
+        else:
+            message += payload
+
+        if not fin:
+            self.message_buffer = message
+            self.message_size = len(message)
+            return None
+
+        self.message_opcode = self.message_buffer = self.inflater = None
+        self.message_size = 0
+        return message
+
+    def handle_text(self, payload, fin):
+        """
+        Decode a fragment of a text message, once, as it arrives. A
+        character may be split between fragments, only the end of the
+        message must be a whole one. Returns the message after the last.
+        """
+        if fin and self.text_decoder is None:
+            self.message_opcode = self.inflater = None
+            return self._decode_bytes(payload)
+
+        if self.text_decoder is None:
+            self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+            self.message_buffer = []
+
+        self.message_buffer.append(self.text_decoder.decode(payload, fin))
+        self.message_size += len(payload)
+        if not fin:
+            return None
+
+        message = "".join(self.message_buffer)
+        self.message_opcode = self.message_buffer = self.inflater = None
+        self.text_decoder = None
+        self.message_size = 0
+        return message
+
+    def check_size(self, length):
+        """refuse a message growing by `length` bytes past the limit"""
+        if length + self.message_size > self.max_message_size:
+            raise MessageTooLargeException("Message larger than %d bytes" %
+                                           self.max_message_size)
+
+    def inflate(self, payload, fin):
+        """decompress a frame of the message in `message_buffer`"""
+        inflater = self.inflater
+        self.deflate.compressed_in += len(payload)
+        if self.max_message_size is None:
+            data = inflater.decompress(payload)
+            if fin:
+                data += inflater.decompress(b"\0\0\xff\xff")
+
+        else:
+            # stop at the limit, a small payload may inflate to gigabytes
+            room = self.max_message_size - self.message_size
+            data = inflater.decompress(payload, room + 1)
+            if fin and len(data) <= room:
+                data += inflater.decompress(b"\0\0\xff\xff",
+                                            room + 1 - len(data))
+
+            if len(data) > room:
+                self.check_size(len(data))
+
+        self.deflate.raw_in += len(data)
+        return data
+
+    def next_chunk(self):
+        """
+        The next `(opcode, fin, data)` chunk of the message being
+        received, from buffered data only. `None` if more is needed.
+        Frames are cut at what was read and decompressed output at
+        `read_buffer_size`, so chunks are never larger.
+        """
+        opcode = self.message_opcode
+        if self.inflate_input is not None:
+            payload, fin = self.inflate_input
+            self.inflate_input = None
+
+        else:
+            while True:
+                frame = self.parser.next_piece()
+                if frame is None:
+                    return None
+
+                data = self.decode_frame(frame)
+                if data is not None:
+                    break
+
+                if self.closed:
+                    raise WebSocketError(MSG_CLOSED)
+
+            opcode, fin, payload = data
+
+        inflater = self.inflater
+        if inflater is not None:
+            size = self.read_buffer_size
+            compressed = len(payload)
+            payload = inflater.decompress(payload, size)
+            rest = inflater.unconsumed_tail
+            if rest or len(payload) == size:
+                # more output may be waiting, even without input left
+                self.inflate_input = rest, fin
+                fin = False
+
+            elif fin:
+                payload += inflater.decompress(b"\0\0\xff\xff")
+
+            self.deflate.compressed_in += compressed - len(rest)
+            self.deflate.raw_in += len(payload)
+
+        if fin:
+            self.message_opcode = self.inflater = None
+
+        return opcode, fin, payload
+
+    def read_chunk(self):
+        """`next_chunk()`, reading more when needed"""
+        chunk = self.next_chunk()
+        while chunk is None:
+            needed = min(self.parser.needed, self.read_buffer_size)
+            if self.read1 is not None:
+                data = self.read1(self.read_buffer_size)
+
+            else:
+                data = self.read(needed)
+
+            if not data:
+                raise WebSocketError("Unexpected EOF while decoding frame")
+
+            self.parser.feed(data)
+            chunk = self.next_chunk()
+
+        return chunk
+
+    def receive(self, block=True):
+        """
+        Read and return a message from the stream. If `None` is returned, then
+        the socket is considered closed/errored. If `block` is false, only
+        data already buffered is used and `None` is also returned while no
+        whole message is buffered.
+        """
+        if self.closed:
+            self.handler.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            return self.read_message(block)
+
+        except (UnicodeError, socket.error) as e:
+            self.close_on_error(e)
+
+        return None
+
+    def receive_stream(self):
+        """
+        Wait for the next message and return it as a `MessageStream`, that
+        gives the message in chunks as they arrive instead of holding it
+        all. It must be read to the end or closed before the next
+        message is received. `None` is returned if the socket is closed.
+        """
+        if self.closed:
+            self.handler.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            chunk = self.read_chunk()
+
+        except (UnicodeError, socket.error) as e:
+            self.close_on_error(e)
+            return None
+
+        return MessageStream(self, chunk)
+
+    def close_on_error(self, error):
+        """close the websocket for an error raised while reading"""
+        if self.closed:
+            return
+
+        if isinstance(error, UnicodeError):
+            self.close(1007, str(error))
+
+        elif isinstance(error, MessageTooLargeException):
+            self.close(1009, str(error))
+
+        elif isinstance(error, ProtocolError):
+            self.close(1002, str(error))
+
+        else:
+            self.close(message=str(error))
+            self.handler.on_close(MSG_CLOSED)
+
+    @staticmethod
+    def encode_header(fin, opcode, mask, length, flags):
+        first_byte = opcode
+        second_byte = 0
         extra = b""
         result = bytearray()
 
@@ -548,49 +1849,327 @@ class WebSocket(object):
         if not message:
             return
 
+        with self.send_lock:
+            header, message = self.encode_frame(message, opcode, do_compress)
+            try:
+                self.write_frame(header, message)
+
+            except socket.error as e:
+                raise WebSocketError(MSG_SOCKET_DEAD + " : " + str(e))
+
+            self.frames_out += 1
+            self.bytes_out += len(header) + len(message)
+
+    def encode_frame(self, message, opcode, do_compress=False):
+        """
+        `(header, payload)` of a final frame of `message`, compressed if
+        `do_compress` and the connection does. Called under the send lock.
+        """
         if opcode in (OPCODE_TEXT, OPCODE_PING):
             message = self._encode_bytes(message)
 
         elif opcode == OPCODE_BINARY:
-            message = bytes(message)
+            if isinstance(message, memoryview):
+                # len() must count bytes
+                message = message.cast("B")
 
-        if do_compress and self.do_compress:
-            message = self.compressor.compress(message)
-            message += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            elif not isinstance(message, (bytes, bytearray)):
+                message = bytes(message)
 
-            if message.endswith(b"\x00\x00\xff\xff"):
-                message = message[:-4]
+        compressed = None
+        if do_compress and self.do_compress:
+            compressed = self.compress(message)
 
+        if compressed is not None:
+            message = compressed
             flags = RSV0_MASK
 
         else:
             flags = 0
 
-        header = self.encode_header(True, opcode, b"", len(message), flags)
-
-        try:
-            self.write(bytes(header + message))
-
-        except socket.error as e:
-            raise WebSocketError(MSG_SOCKET_DEAD + " : " + str(e))
+        return self.encode_header(True, opcode, b"", len(message),
+                                  flags), message
 
-    def send(self, message, binary=None, do_compress=True):
+    def compress(self, message):
         """
-        Send a frame over the websocket with message as its payload
+        The deflated payload of `message`, or `None` if the compression
+        policy(`self.deflate`) sends it as it is.
         """
-
-        if binary is None:
+        deflate = self.deflate
+        level = deflate.level_for(len(message))
+        if level is None:
+            deflate.plain_out += len(message)
+            return None
+
+        compressor = self.get_compressor(level)
+        data = compressor.compress(message)
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(b"\x00\x00\xff\xff"):
+            data = data[:-4]
+
+        if deflate.server_no_context_takeover and len(data) >= len(message):
+            # nothing refers to this message later, send it as it is
+            deflate.plain_out += len(message)
+            return None
+
+        deflate.count_out(len(message), len(data))
+        if not deflate.enabled:
+            self.compressor = None
+
+        return data
+
+    def get_compressor(self, level):
+        """the compressor of the next message, with this level"""
+        compressor = self.compressor
+        if compressor is None or level != self.compressor_level:
+            # a new compressor can take over mid stream, the client's
+            # window just holds more history than it refers to
+            compressor = self.deflate.compressobj(level)
+            if not self.deflate.server_no_context_takeover:
+                self.compressor = compressor
+                self.compressor_level = level
+
+        return compressor
+
+    def write_frame(self, header, payload):
+        """
+        Write an encoded frame. Large payloads go out next to the header
+        in one `sendmsg()` call when the socket is known, smaller ones are
+        cheaper to join into a single buffer.
+        """
+        if self.batched is not None:
+            self.batched += header
+            self.batched += payload
+            return
+
+        if self.sendmsg is None or len(payload) < self.gather_size:
+            data = b"".join((header, payload))
+            if self.sendall is not None:
+                self.sendall(data)
+
+            else:
+                self.write(data)
+
+            return
+
+        buffers = [memoryview(buf) for buf in (header, payload) if len(buf)]
+        while buffers:
+            sent = self.sendmsg(buffers)
+            # drop what was written, a partial write leaves a tail to resend
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+    def send(self, message, binary=None, do_compress=True, key=None):
+        """
+        Send a frame over the websocket with message as its payload. With
+        a `send_queue` the message is queued, `False` is returned if it
+        was dropped and `key` names messages that may be coalesced.
+        """
+        if self.send_queue is not None:
+            return self.send_queue.put(message, binary, do_compress, key)
+
+        self.write_message(message, binary, do_compress)
+
+    def write_message(self, message, binary=None, do_compress=True):
+        """write a message on the caller's thread"""
+        if binary is None:
             binary = not isinstance(message, string_types)
 
         opcode = OPCODE_BINARY if binary else OPCODE_TEXT
 
         try:
-            self.send_frame(message, opcode, do_compress)
+            with self.message_lock:
+                self.send_frame(message, opcode, do_compress)
 
         except WebSocketError:
             self.handler.on_close(MSG_SOCKET_DEAD)
             raise WebSocketError(MSG_SOCKET_DEAD)
 
+    def send_many(self, messages, binary=None, do_compress=True):
+        """
+        Send `messages` with one write, their frames are encoded into a
+        single buffer. `binary` as `send()` for each message. With a
+        `send_queue` they are queued one by one.
+        """
+        if self.send_queue is not None:
+            for message in messages:
+                self.send_queue.put(message, binary, do_compress)
+
+            return
+
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        with self.message_lock:
+            with self.send_lock:
+                data = encode_messages(self, messages, binary, do_compress)
+                try:
+                    self.write_encoded(data)
+
+                except socket.error as e:
+                    self.handler.on_close(MSG_SOCKET_DEAD)
+                    raise WebSocketError(MSG_SOCKET_DEAD + " : " + str(e))
+
+    def write_encoded(self, data):
+        """write frames that are encoded(and masked) as they are"""
+        WebSocket.write_frame(self, b"", data)
+
+    def batch(self):
+        """
+        `with websocket.batch():` - frames sent in the block, by any
+        thread, are joined in one buffer and written with one call at its
+        end. A burst of small messages then costs one syscall.
+        """
+        return WriteBatch(self)
+
+    def end_batch(self):
+        """write the frames of the `batch()` and stop batching"""
+        with self.send_lock:
+            data, self.batched = self.batched, None
+            if not data or self.closed:
+                return
+
+            try:
+                self.write_encoded(data)
+
+            except socket.error as e:
+                self.handler.on_close(MSG_SOCKET_DEAD)
+                raise WebSocketError(MSG_SOCKET_DEAD + " : " + str(e))
+
+    def send_stream(self, data, binary=True, fragment_size=65536,
+                    do_compress=True):
+        """
+        Send a message in fragments as it is produced by `data`, a file
+        object or an iterable of chunks, without holding all of it. Other
+        messages wait until it is sent, control frames can go between its
+        fragments.
+        """
+        with self.message_lock:
+            fragments = Fragmenter(self, binary, fragment_size, do_compress)
+            try:
+                for chunk in iter_chunks(data, fragment_size):
+                    for header, payload in fragments.encode(chunk):
+                        self.write_fragment(header, payload)
+
+                for header, payload in fragments.finish():
+                    self.write_fragment(header, payload)
+
+            except WebSocketError:
+                self.handler.on_close(MSG_SOCKET_DEAD)
+                raise WebSocketError(MSG_SOCKET_DEAD)
+
+            except Exception:
+                # the message can not be finished, nor another one sent
+                self.close(1011, "Internal Error")
+                raise
+
+    def write_fragment(self, header, payload):
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            with self.send_lock:
+                self.write_frame(header, payload)
+                self.frames_out += 1
+                self.bytes_out += len(header) + len(payload)
+
+        except socket.error as e:
+            raise WebSocketError(MSG_SOCKET_DEAD + " : " + str(e))
+
+    def write_nowait(self, opcode, payload, finish=None):
+        """
+        Write a control frame without blocking. Returns `False` if the
+        socket is dead or has no room for the frame, `None` if it can
+        not be tried now, as while a `batch()` holds frames that must go
+        first. A frame written in part is torn, it is `False`
+        too unless `finish` is given: `finish(rest)` is called with the
+        send lock held and must write the rest and release the lock.
+        """
+        sock = self.socket
+        if not sends_nowait(self):
+            return None
+
+        if not self.send_lock.acquire(False):
+            return None
+
+        locked = True
+        try:
+            if self.batched is not None:
+                return None
+
+            header, payload = self.encode_frame(payload, opcode)
+            if self.masked:
+                header, payload = mask_frame(header, payload)
+
+            frame = bytes(header) + payload
+            try:
+                sent = sock.send(frame, DONTWAIT)
+
+            except socket.error:
+                return False
+
+            if sent != len(frame):
+                # the rest can not be written without blocking
+                if finish is None:
+                    return False
+
+                locked = False
+                finish(frame[sent:])
+
+            self.frames_out += 1
+            self.bytes_out += len(frame)
+            return True
+
+        finally:
+            if locked:
+                self.send_lock.release()
+
+    def abort(self, code=1011, message=""):
+        """
+        Close without blocking, for a client that may be gone. A close
+        frame is written if the socket has room, then the socket is shut
+        down, the reader wakes up and closes the websocket.
+        """
+        sock = self.socket
+        if sock is None:
+            self.close(code, message)
+            return
+
+        # the frames of an open batch are not sent, the close frame must
+        # be the last one. A sender holding the lock may be adding to it,
+        # then no close frame is written either
+        if self.send_lock.acquire(False):
+            self.batched = None
+            self.send_lock.release()
+
+        self.write_nowait(OPCODE_CLOSE,
+                          struct.pack("!H", code) + message.encode("utf-8"))
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+
+        except socket.error:
+            pass
+
+    def lock_writes(self, blocking=True):
+        """take the message and frame locks, to write whole messages"""
+        if not self.message_lock.acquire(blocking):
+            return False
+
+        if self.send_lock.acquire(blocking):
+            return True
+
+        self.message_lock.release()
+        return False
+
+    def unlock_writes(self):
+        self.send_lock.release()
+        self.message_lock.release()
+
     def close(self, code=1000, message=b""):
         """
         Close the websocket and connection, sending the specified code and
@@ -603,6 +2182,9 @@ class WebSocket(object):
             self.handler.on_close(MSG_ALREADY_CLOSED)
 
         try:
+            if self.batched is not None and not self.closed:
+                self.end_batch()  # the close frame goes last
+
             message = self._encode_bytes(message)
             self.send_frame(struct.pack("!H%ds" % len(message), code, message),
                             opcode=OPCODE_CLOSE)
@@ -613,12 +2195,226 @@ class WebSocket(object):
 
         finally:
             self.logger.debug("Closed WebSocket")
+            if self.send_queue is not None:
+                self.send_queue.close()
+
+            if not self.closed:
+                metrics.inc("wsocket_closes_total", 1,
+                            (("code", str(code)), ))
+                metrics.retire(self)
+
             self.closed = True
             self.write = None
             self.read = None
+            self.read1 = None
+            self.readinto = None
+            self.socket = None
+            self.sendall = None
+            self.sendmsg = None
             self.environ = None
 
 
+def iter_chunks(data, size):
+    """chunks of a file object, read `size` at a time, or of an iterable"""
+    read = getattr(data, "read", None)
+    if read is None:
+        for chunk in data:
+            yield chunk
+
+        return
+
+    while True:
+        chunk = read(size)
+        if not chunk:
+            return
+
+        yield chunk
+
+
+class Fragmenter(object):
+    """
+    Encodes a message given in chunks as frames of at most
+    `fragment_size` bytes, compressed on the fly if `do_compress`. See
+    `WebSocket.send_stream()`.
+    """
+
+    def __init__(self, websocket, binary, fragment_size, do_compress):
+        self.websocket = websocket
+        self.opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        self.fragment_size = fragment_size
+        self.flags = 0
+        self.compressor = None
+        self.raw = 0
+        self.compressed = 0
+        deflate = websocket.deflate
+        if do_compress and deflate is not None:
+            # the message size is not known, judge it by its fragments
+            level = deflate.level_for(fragment_size)
+            if level is not None:
+                self.compressor = websocket.get_compressor(level)
+                self.flags = RSV0_MASK
+
+    def frame(self, fin, payload):
+        header = self.websocket.encode_header(fin, self.opcode, b"",
+                                              len(payload), self.flags)
+        # only the first frame has the opcode and RSV1
+        self.opcode = OPCODE_CONTINUATION
+        self.flags = 0
+        return header, payload
+
+    def encode(self, chunk):
+        """the frames of the next chunk, they are not final"""
+        if not isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = self.websocket._encode_bytes(chunk)
+
+        if self.compressor is not None:
+            self.raw += len(chunk)
+            chunk = self.compressor.compress(chunk)
+            self.compressed += len(chunk)
+
+        size = self.fragment_size
+        view = memoryview(chunk).cast("B")
+        return [
+            self.frame(False, view[start:start + size])
+            for start in range_type(0, len(view), size)
+        ]
+
+    def finish(self):
+        """the final frame, with what the compressor still holds"""
+        if self.compressor is None:
+            return [self.frame(True, b"")]
+
+        data = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(b"\x00\x00\xff\xff"):
+            data = data[:-4]
+
+        self.compressed += len(data)
+        deflate = self.websocket.deflate
+        deflate.count_out(self.raw, self.compressed)
+        if not deflate.enabled:
+            self.websocket.compressor = None
+
+        size = self.fragment_size
+        frames = [
+            self.frame(False, data[start:start + size])
+            for start in range_type(0, len(data) - size, size)
+        ]
+        frames.append(self.frame(True, data[len(frames) * size:]))
+        return frames
+
+
+class WriteBatch(object):
+    """`WebSocket.batch()`, a nested batch is written by the outer one"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.outer = False
+
+    def __enter__(self):
+        websocket = self.websocket
+        with websocket.send_lock:
+            if websocket.batched is None:
+                websocket.batched = bytearray()
+                self.outer = True
+
+        return websocket
+
+    def __exit__(self, *exc_info):
+        if self.outer:
+            self.outer = False
+            self.websocket.end_batch()
+
+
+class MessageStream(object):
+    """
+    A message being received, from `WebSocket.receive_stream()`. Iterate
+    over it for chunks as they arrive or `read()` it like a file. Text
+    messages give `str` chunks and binary ones `bytearray` chunks.
+    """
+
+    def __init__(self, websocket, chunk):
+        opcode, fin, data = chunk
+        self.websocket = websocket
+        self.binary = opcode == OPCODE_BINARY
+        self.decoder = (None if self.binary else
+                        codecs.getincrementaldecoder("utf-8")())
+        self.size = 0  # bytes received, after decompression
+        self.done = False
+        self.buffer = self.decode(fin, data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        if self.buffer:
+            chunk, self.buffer = self.buffer, self.buffer[:0]
+            yield chunk
+
+        while not self.done:
+            chunk = self.next_chunk()
+            if chunk:
+                yield chunk
+
+    def decode(self, fin, data):
+        self.size += len(data)
+        self.done = fin
+        if self.decoder is None:
+            return data if isinstance(data, bytearray) else bytearray(data)
+
+        try:
+            return self.decoder.decode(data, fin)
+
+        except UnicodeError as e:
+            self.websocket.close_on_error(e)
+            raise WebSocketError(MSG_CLOSED)
+
+    def next_chunk(self):
+        """read the next chunk of the message, it may be empty"""
+        if self.done:
+            return self.buffer[:0]
+
+        if self.websocket.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            opcode, fin, data = self.websocket.read_chunk()
+
+        except (UnicodeError, socket.error) as e:
+            self.websocket.close_on_error(e)
+            raise WebSocketError(MSG_CLOSED)
+
+        return self.decode(fin, data)
+
+    def read(self, size=-1):
+        """
+        Up to `size` bytes(characters of text messages) of the message,
+        all the rest if `size` is negative. Empty at the end.
+        """
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            self.buffer += self.next_chunk()
+
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = self.buffer, self.buffer[:0]
+
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def close(self):
+        """skip the rest of the message"""
+        self.buffer = self.buffer[:0]
+        try:
+            while not self.done:
+                self.next_chunk()
+
+        except WebSocketError:
+            self.done = True
+
+
 class Response(object):
     # Header blacklist for specific response codes
     # (rfc2616 section 10.2.3 and 10.3.5)
@@ -638,11 +2434,16 @@ class Response(object):
         )),
     }
     headers_sent = False
+    # small items of streamed bodies are written together, up to this size
+    buffer_size = 16384
 
     def __init__(self, environ, start_response, app):
         self.environ = environ
         self._start_response = start_response
         self.app = app
+        # notified when the response is started, maybe by another thread
+        self.started = Condition()
+        self.event_stream = False
 
     def process_response(self, allow_write=True):
         try:
@@ -651,7 +2452,11 @@ class Response(object):
         except Exception as e:
             self.start_response()
             log = log_traceback(e)
-            err = "<h1>Internal Server Error(500)</h1><p><b>%s :%s</b></p><p><samp><pre>%s</pre></samp></p><a href=\"https://github.com/Ksengine/wsocket/issues/new?%s\" target=\"blank\"><button><h3>report</h3></button></a>" % (
+            err = ("<h1>Internal Server Error(500)</h1>"
+                   "<p><b>%s :%s</b></p><p><samp><pre>%s</pre></samp></p>"
+                   "<a href=\"https://github.com/Ksengine/wsocket/issues/new"
+                   "?%s\" target=\"blank\"><button><h3>report</h3></button>"
+                   "</a>") % (
                 type(e).__name__, str(e), log,
                 urlencode({
                     'title': type(e).__name__,
@@ -660,343 +2465,3766 @@ class Response(object):
             logger.debug(log)
             return [err.encode("utf-8")]
 
-        if not allow_write:
-            return []
+        if not allow_write:
+            return []
+
+        file_wrapper = self.environ.get("wsgi.file_wrapper")
+        if isinstance(results, FileWrapper) or type(results) is file_wrapper:
+            # the server sends files itself, see `FixedServerHandler.sendfile`
+            return results
+
+        if hasattr(results, "__iter__") and not isinstance(
+                results, (string_types, bytes)):
+            self.stream(results)
+            return []
+
+        if not self.headers_sent:
+            self.start_response()
+
+        if isinstance(results, string_types):
+            return [results.encode("utf-8")]
+
+        elif isinstance(results, bytes):
+            return [results]
+
+        else:
+            return [str(results).encode("utf-8")]
+
+    def stream(self, results):
+        """
+        Write the items of an iterable body, small ones together up to
+        `buffer_size` bytes. An empty item writes what was buffered, as
+        does every item of a `text/event-stream` response. Without a
+        Content-Length the built-in server sends it chunked. A generator
+        may start the response later, from any thread, its items wait
+        for it. Other bodies start the default response if it was not.
+        """
+        buffer = []
+        size = 0
+        if not self.headers_sent and not isinstance(results, GeneratorType):
+            # only a generator can start the response later
+            self.start_response()
+
+        try:
+            for result in results:
+                if not self.headers_sent:
+                    # another thread may start the response
+                    with self.started:
+                        self.started.wait_for(lambda: self.headers_sent)
+
+                if isinstance(result, string_types):
+                    result = result.encode("utf-8")
+
+                elif not isinstance(result, bytes):
+                    result = str(result).encode("utf-8")
+
+                if result:
+                    buffer.append(result)
+                    size += len(result)
+
+                if size >= self.buffer_size or size and (
+                        self.event_stream or not result):
+                    self.write(b"".join(buffer))
+                    buffer = []
+                    size = 0
+
+            if buffer:
+                self.write(b"".join(buffer))
+
+        finally:
+            if hasattr(results, "close"):
+                results.close()
+
+    def start_response(self, status="200 OK", headers=[]):
+        if self.headers_sent:
+            return
+
+        status = self.process_status(status)
+
+        # a copy, the server adds its own headers to the list
+        headers = list(
+            headers.items() if isinstance(headers, dict) else headers)
+
+        if self.code in self.bad_headers:
+            bad_headers = self.bad_headers[self.code]
+            headers = [h for h in headers if h[0] not in bad_headers]
+
+        self.event_stream = any(
+            value.startswith("text/event-stream") for name, value in headers
+            if name.lower() == "content-type")
+        self.write = self._start_response(status, headers)
+        with self.started:
+            self.headers_sent = True
+            self.started.notify_all()
+
+        return self.write
+
+    def process_status(self, status):
+        if isinstance(status, int):
+            code, status = status, _HTTP_STATUS_LINES.get(status)
+
+        elif " " in status:
+            if "\n" in status or "\r" in status or "\0" in status:
+                raise ValueError("Status line must not include control chars.")
+
+            status = status.strip()
+            code = int(status.split()[0])
+
+        else:
+            raise ValueError("String status line without a reason phrase.")
+
+        if not 100 <= code <= 999:
+            raise ValueError("Status code out of range.")
+
+        self.code = code
+        return str(status or ("%d Unknown" % code))
+
+
+class Dispatcher(object):
+    """
+    Bounded thread pool for `Event` handlers. Calls for the same websocket
+    run one at a time, in the order they were made, while calls for
+    different websockets run in parallel on up to `workers` threads.
+
+    At most `max_queue` calls wait for a thread. `when_full` decides what
+    happens to new calls then: "block" waits for room, "drop" discards
+    the call and "close" also closes its websocket with code 1013
+    (Try Again Later).
+
+    Threads are started as calls come and exit after `idle_timeout`
+    seconds without work.
+    """
+
+    idle_timeout = 60.0
+
+    def __init__(self, workers=16, max_queue=1024, when_full="block"):
+        if when_full not in ("block", "drop", "close"):
+            raise ValueError("when_full must be block, drop or close")
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self.when_full = when_full
+        self.lock = Lock()
+        self.has_work = Condition(self.lock)
+        self.has_room = Condition(self.lock)
+        self.calls = {}  # key: calls waiting, while any is queued or running
+        self.ready = deque()  # keys with calls and no thread on them
+        self.threads = 0
+        self.idle = 0
+        # statistics
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.handled = 0
+        self.dropped = 0
+        self.wait_time = 0.0
+        self.handler_time = 0.0
+        self.max_handler_time = 0.0
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queue `func(*args, **kwargs)` behind the other calls for `key`
+        (usually a websocket), `None` if it does not need ordering.
+        """
+        with self.lock:
+            while self.queued >= self.max_queue:
+                if self.when_full == "block":
+                    self.has_room.wait()
+                    continue
+
+                self.dropped += 1
+                break
+
+            else:
+                if key is None:
+                    key = object()
+
+                self.queued += 1
+                self.max_queued = max(self.max_queued, self.queued)
+                if key in self.calls:
+                    # runs after the key's call in progress, on its thread
+                    self.calls[key].append((func, args, kwargs, monotonic()))
+                    return True
+
+                self.calls[key] = deque(((func, args, kwargs, monotonic()), ))
+                self.ready.append(key)
+                if self.idle:
+                    self.has_work.notify()
+
+                elif self.threads < self.workers:
+                    self.threads += 1
+                    t = Thread(target=self.work)
+                    t.daemon = True
+                    t.start()
+
+                return True
+
+        logger.warning("Event queue is full, call dropped")
+        if self.when_full == "close" and isinstance(key, WebSocket):
+            # without blocking, the reader sees it and closes the websocket
+            key.abort(1013, "Try Again Later")
+
+        return False
+
+    def work(self):
+        self.lock.acquire()
+        try:
+            while True:
+                while not self.ready:
+                    self.idle += 1
+                    woken = self.has_work.wait(self.idle_timeout)
+                    self.idle -= 1
+                    if not woken and not self.ready:
+                        return  # idle since the last burst
+
+                key = self.ready.popleft()
+                calls = self.calls[key]
+                func, args, kwargs, queued_at = calls.popleft()
+                self.queued -= 1
+                self.running += 1
+                self.has_room.notify()
+                self.lock.release()
+
+                start = monotonic()
+                try:
+                    func(*args, **kwargs)
+
+                except Exception as e:
+                    logger.exception(e)
+
+                finally:
+                    end = monotonic()
+                    self.lock.acquire()
+
+                self.running -= 1
+                self.handled += 1
+                self.wait_time += start - queued_at
+                self.handler_time += end - start
+                self.max_handler_time = max(self.max_handler_time,
+                                            end - start)
+                if calls:
+                    # the key's next call, after other waiting keys
+                    self.ready.append(key)
+
+                else:
+                    del self.calls[key]
+
+        finally:
+            self.threads -= 1
+            self.lock.release()
+
+    def stats(self):
+        """queue depth and handler latency(seconds), to size the pool"""
+        with self.lock:
+            handled = self.handled or 1
+            return {
+                "threads": self.threads,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "running": self.running,
+                "handled": self.handled,
+                "dropped": self.dropped,
+                "avg_wait": self.wait_time / handled,
+                "avg_latency": self.handler_time / handled,
+                "max_latency": self.max_handler_time,
+            }
+
+
+class Hub(object):
+    """
+    Broadcast messages to channels of websockets. `publish()` encodes and
+    frames a message once and writes the same bytes to every subscriber.
+
+    Blocking websockets are written by a thread pool, so the publisher
+    does not wait for sockets. Pool threads write without blocking, a
+    socket with no room is left to a `WriteSelector` and written again
+    when it has, so stalled subscribers do not hold the pool. A
+    subscriber that still has `max_pending` frames to write is a slow
+    consumer, it misses the message instead.
+    asyncio websockets are written in the publishing task and skipped
+    when their transport buffers more than `max_buffer` bytes.
+    """
+
+    workers = 8
+    max_pending = 64  # frames waiting for a blocking subscriber
+    max_buffer = 1 << 20  # bytes waiting for an asyncio subscriber
+
+    def __init__(self, workers=None, max_pending=None):
+        self.channels = {}  # name: set of subscribed websockets
+        self.pending = {}  # websocket: frames to write, while it is flushed
+        self.rest = {}  # websocket: unwritten bytes, with its locks held
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(workers or self.workers)
+        self.selector = WriteSelector()
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+        self.published = 0
+        self.skipped = 0
+
+    def subscribe(self, wsock, channel=""):
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(wsock)
+
+    def unsubscribe(self, wsock, channel=None):
+        """leave `channel`, or every channel if it is `None`"""
+        with self.lock:
+            names = list(self.channels) if channel is None else [channel]
+            for name in names:
+                subscribers = self.channels.get(name)
+                if subscribers is None:
+                    continue
+
+                subscribers.discard(wsock)
+                if not subscribers:
+                    del self.channels[name]
+
+    def subscribers(self, channel=""):
+        with self.lock:
+            return list(self.channels.get(channel, ()))
+
+    def encode(self, message, binary=None):
+        """a complete, unmasked and uncompressed frame for `message`"""
+        if binary is None:
+            binary = not isinstance(message, string_types)
+
+        if binary:
+            opcode = OPCODE_BINARY
+            payload = bytes(message)
+
+        else:
+            opcode = OPCODE_TEXT
+            if not isinstance(message, text_type):
+                message = text_type(message or "")
+
+            payload = message.encode("utf-8")
+
+        header = WebSocket.encode_header(True, opcode, b"", len(payload), 0)
+        return bytes(header) + payload
+
+    def publish(self, message, channel="", binary=None):
+        """
+        Send `message` to the subscribers of `channel`. Returns how many
+        subscribers it was written or queued for.
+        """
+        frame = self.encode(message, binary)
+        flush = []
+        closed = []
+        sent = 0
+        with self.lock:
+            self.published += 1
+            subscribers = self.channels.get(channel, ())
+            for wsock in subscribers:
+                if wsock.closed:
+                    closed.append(wsock)
+                    continue
+
+                if isinstance(wsock, AsyncWebSocket):
+                    transport = wsock.writer.transport
+                    if transport.get_write_buffer_size() > self.max_buffer:
+                        self.skipped += 1
+                        continue
+
+                    if wsock.deferred is not None:
+                        # after the message being streamed
+                        wsock.deferred.append(frame)
+
+                    else:
+                        wsock.writer.write(frame)
+
+                    wsock.frames_out += 1
+                    wsock.bytes_out += len(frame)
+
+                else:
+                    frames = self.pending.get(wsock)
+                    if frames is None:
+                        # write right away if the socket has room, the
+                        # pool only finishes what did not fit
+                        sent_now = self.try_send(wsock, frame)
+                        if sent_now is None:
+                            self.pending[wsock] = [frame]
+                            flush.append((wsock, False))
+
+                        elif sent_now < 0:
+                            closed.append(wsock)
+                            continue
+
+                        elif sent_now < len(frame):
+                            # the send lock stays held, or another sender
+                            # could write between the two halves
+                            self.pending[wsock] = [frame[sent_now:]]
+                            flush.append((wsock, True))
+
+                        else:
+                            wsock.unlock_writes()
+
+                    elif len(frames) < self.max_pending:
+                        frames.append(frame)
+
+                    else:
+                        self.skipped += 1
+                        continue
+
+                sent += 1
+
+            # clients that went away without unsubscribing
+            for wsock in closed:
+                subscribers.discard(wsock)
+
+        for wsock, locked in flush:
+            self.pool.submit(self.flush, wsock, locked)
+
+        return sent
+
+    def try_send(self, wsock, frame):
+        """
+        Write as much of `frame` as fits in the socket buffer, without
+        blocking. Returns the bytes written with `wsock.lock_writes()` held,
+        -1 if the socket is dead or `None` if it can not be tried now.
+        """
+        sock = wsock.socket
+        if not sends_nowait(wsock):
+            return None
+
+        if not wsock.lock_writes(False):
+            return None
+
+        try:
+            sent = sock.send(frame, DONTWAIT)
+
+        except BlockingIOError:
+            return 0
+
+        except socket.error:
+            wsock.unlock_writes()
+            return -1
+
+        # the rest of a partial frame is counted by `flush()`
+        wsock.frames_out += sent == len(frame)
+        wsock.bytes_out += sent
+        return sent
+
+    def resume(self, wsock, locked):
+        self.pool.submit(self.flush, wsock, locked)
+
+    def flush(self, wsock, locked=False):
+        """
+        write the queued frames of a blocking websocket, `locked` if its
+        send lock was already taken for it
+        """
+        sock = wsock.socket
+        if not sends_nowait(wsock):
+            return self.flush_blocking(wsock, locked)
+
+        while True:
+            rest = self.rest.pop(wsock, None)
+            if rest is None:
+                # another sender has the websocket, try again soon
+                if not locked and not wsock.lock_writes(False):
+                    self.selector.later(0.01,
+                                        lambda: self.resume(wsock, False))
+                    return
+
+                locked = True
+                with self.lock:
+                    frames = self.pending[wsock]
+                    if not frames or wsock.closed:
+                        del self.pending[wsock]
+                        wsock.unlock_writes()
+                        return
+
+                    self.pending[wsock] = []
+
+                rest = memoryview(b"".join(frames))
+                wsock.frames_out += len(frames)
+
+            try:
+                sent = sock.send(rest, DONTWAIT)
+
+            except BlockingIOError:
+                sent = 0
+
+            except socket.error as e:
+                logger.debug("broadcast failed: %s" % e)
+                with self.lock:
+                    del self.pending[wsock]
+
+                wsock.unlock_writes()
+                self.unsubscribe(wsock)
+                return
+
+            wsock.bytes_out += sent
+            rest = rest[sent:]
+            if len(rest):
+                # the frames stay locked until the client takes the rest
+                self.rest[wsock] = rest
+                self.selector.wait(sock, lambda: self.resume(wsock, True))
+                return
+
+            wsock.unlock_writes()
+            locked = False
+
+    def flush_blocking(self, wsock, locked):
+        """`flush()` of ssl and timeout sockets, they block a pool thread"""
+        while True:
+            with self.lock:
+                frames = self.pending[wsock]
+                if not frames or wsock.closed:
+                    del self.pending[wsock]
+                    if locked:
+                        wsock.unlock_writes()
+
+                    return
+
+                self.pending[wsock] = []
+
+            if not locked:
+                wsock.lock_writes()
+
+            locked = False
+            try:
+                data = b"".join(frames)
+                wsock.write_frame(b"", data)
+                wsock.frames_out += len(frames)
+                wsock.bytes_out += len(data)
+
+            except Exception as e:
+                logger.debug("broadcast failed: %s" % e)
+                with self.lock:
+                    del self.pending[wsock]
+
+                self.unsubscribe(wsock)
+                return
+
+            finally:
+                wsock.unlock_writes()
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+class Broadcast(object):
+    """
+    Carries `publish()` to the other processes of a deployment, set it as
+    `WSocketApp.broadcast`. `start(deliver)` is called in every process
+    that uses it, `publish()` sends a message to the other processes and
+    they pass lists of `(message, channel, binary)` to their `deliver`.
+    Subclass it for other transports(eg:- a message broker).
+    """
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, message, channel="", binary=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalBroadcast(Broadcast):
+    """
+    `Broadcast` between the processes of one machine over Unix domain
+    sockets in the directory `path`. Every process listens on a socket
+    there and connects to the sockets of the others, so there is no broker
+    to run. Messages published within `tick` seconds are sent to each
+    process in one write and delivered there in one call.
+
+    Create it before the workers are forked, so that they share `path`,
+    a new private directory by default. A given `path` is created if
+    needed and must be only accessible to this user.
+
+    Nothing waits for a process that does not read: once `max_backlog`
+    bytes wait for it, it misses messages. Messages published beyond
+    `max_pending` in one tick are dropped too, as are received records
+    that are not valid UTF-8, `dropped` counts them all.
+    """
+
+    tick = 0.001
+    timeout = 1.0  # to connect to another process
+    max_pending = 10000  # messages of one tick
+    max_backlog = 4 << 20  # bytes waiting for one process
+    record = struct.Struct("!BHI")  # binary, channel and payload length
+
+    def __init__(self, path=None, tick=None):
+        if path is None:
+            self.path = tempfile.mkdtemp(prefix="wsocket-")
+
+        else:
+            self.path = path
+            self.make_path()
+
+        if tick is not None:
+            self.tick = tick
+
+        self.starting = Lock()
+        self.creator = os.getpid()
+        self.pid = None
+        self.closed = False
+        # `publish()` may be called before `start()`
+        self.lock = Condition()
+        self.pending = []  # records of this tick
+        self.sent = 0  # messages published by this process
+        self.received = 0  # messages delivered from the others
+        self.dropped = 0  # messages some process missed
+
+    def make_path(self):
+        """create `path`, or check that no other user can use it"""
+        os.makedirs(self.path, 0o700, exist_ok=True)
+        st = os.lstat(self.path)
+        private = (os.path.isdir(self.path), not os.path.islink(self.path),
+                   st.st_uid == os.getuid(), st.st_mode & 0o777 == 0o700)
+        if not all(private):
+            raise PermissionError(
+                "%s must be a directory of this user with mode 0700" %
+                self.path)
+
+    def start(self, deliver):
+        """listen for the other processes, once in each process"""
+        if self.pid == os.getpid():
+            return
+
+        with self.starting:
+            if self.pid == os.getpid():
+                return
+
+            # sockets copied from the parent when forked are not ours,
+            # nor is its lock, that a thread of the parent may hold
+            self.deliver = deliver
+            if os.getpid() != self.creator:
+                self.lock = Condition()
+                self.pending = []
+
+            self.peers = {}  # socket path: connection, `None` until used
+            self.backlog = {}  # socket path: bytes waiting for room
+            self.ready = set()  # socket paths that have room again
+            self.writer = WriteSelector()
+            self.scanned = None  # mtime of `path` when `peers` were listed
+            self.closed = False
+            self.make_path()
+            self.address = os.path.join(self.path, "%d.sock" % os.getpid())
+            if os.path.exists(self.address):
+                os.unlink(self.address)  # left by a process of that pid
+
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.address)
+            self.server.listen(128)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.server, selectors.EVENT_READ)
+            for target in (self.receive_forever, self.send_forever):
+                thread = Thread(target=target)
+                thread.daemon = True
+                thread.start()
+
+            self.pid = os.getpid()
+
+    def encode(self, message, channel="", binary=None):
+        if binary is None:
+            binary = not isinstance(message, string_types)
+
+        if binary:
+            payload = bytes(message)
+
+        else:
+            if not isinstance(message, text_type):
+                message = text_type(message or "")
+
+            payload = message.encode("utf-8")
+
+        channel = channel.encode("utf-8")
+        header = self.record.pack(binary, len(channel), len(payload))
+        return header + channel + payload
+
+    def decode(self, buf):
+        """the messages of the complete records in `buf`, removed from it"""
+        messages = []
+        start = 0
+        while len(buf) - start >= self.record.size:
+            binary, size, length = self.record.unpack_from(buf, start)
+            begin = start + self.record.size
+            end = begin + size + length
+            if len(buf) < end:
+                break
+
+            payload = bytes(buf[begin + size:end])
+            try:
+                channel = bytes(buf[begin:begin + size]).decode("utf-8")
+                if not binary:
+                    payload = payload.decode("utf-8")
+
+            except UnicodeDecodeError as e:
+                # the length framing holds, skip just this record
+                logger.warning("broadcast record dropped: %s" % e)
+                with self.lock:
+                    self.dropped += 1
+
+            else:
+                messages.append((payload, channel, bool(binary)))
+
+            start = end
+
+        del buf[:start]
+        return messages
+
+    def publish(self, message, channel="", binary=None):
+        """send `message` to the other processes with this tick's batch"""
+        record = self.encode(message, channel, binary)
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+
+            self.pending.append(record)
+            self.sent += 1
+            if len(self.pending) == 1:
+                self.lock.notify()
+
+    def send_forever(self):
+        while True:
+            with self.lock:
+                while not (self.pending or self.ready or self.closed):
+                    self.lock.wait()
+
+                ready, self.ready = self.ready, set()
+                batch = bool(self.pending)
+
+            if self.closed:
+                return
+
+            self.flush(ready)
+            if not batch:
+                continue
+
+            sleep(self.tick)  # let the rest of this tick's messages come
+            with self.lock:
+                pending, self.pending = self.pending, []
+
+            self.send(b"".join(pending), len(pending))
+
+    def scan(self):
+        """look for processes that came or went, when `path` changed"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+
+        except OSError:
+            return
+
+        if mtime == self.scanned:
+            return
+
+        self.scanned = mtime
+        addresses = set(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.endswith(".sock"))
+        addresses.discard(self.address)
+        for address in list(self.peers):
+            if address not in addresses:
+                self.drop(address)
+
+        for address in addresses:
+            self.peers.setdefault(address, None)
+
+    def drop(self, address):
+        self.backlog.pop(address, None)
+        sock = self.peers.pop(address, None)
+        if sock is not None:
+            sock.close()
+
+    def send(self, data, count):
+        """write `count` messages to every other process, without waiting"""
+        self.scan()
+        for address, sock in list(self.peers.items()):
+            backlog = self.backlog.get(address)
+            if backlog is not None:
+                # still waiting for room, written after the rest
+                if len(backlog) + len(data) > self.max_backlog:
+                    with self.lock:
+                        self.dropped += count
+
+                else:
+                    backlog += data
+
+                continue
+
+            try:
+                if sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.timeout)
+                    self.peers[address] = sock
+                    sock.connect(address)
+                    sock.setblocking(False)
+
+                self.write(address, sock, data)
+
+            except socket.error as e:
+                self.failed(address, e)
+
+    def flush(self, addresses):
+        """write the backlog of processes that have room again"""
+        for address in addresses:
+            sock = self.peers.get(address)
+            if sock is None or address not in self.backlog:
+                continue
+
+            try:
+                self.write(address, sock, self.backlog[address])
+
+            except socket.error as e:
+                self.failed(address, e)
+
+    def write(self, address, sock, data):
+        """write what `sock` takes now, the rest once it has room"""
+        try:
+            sent = sock.send(data)
+
+        except BlockingIOError:
+            sent = 0
+
+        if sent < len(data):
+            self.backlog[address] = bytearray(data[sent:])
+            self.writer.wait(sock, lambda: self.writable(address))
+
+        else:
+            self.backlog.pop(address, None)
+
+    def writable(self, address):
+        with self.lock:
+            self.ready.add(address)
+            self.lock.notify()
+
+    def failed(self, address, error):
+        if isinstance(error, (ConnectionRefusedError, FileNotFoundError)):
+            # a process that is gone, or left its socket behind
+            self.drop(address)
+            try:
+                os.unlink(address)
+
+            except OSError:
+                pass
+
+            return
+
+        # a part of a record may be written, start over on a new
+        # connection with the next batch
+        logger.debug("broadcast to %s failed: %s" % (address, error))
+        self.backlog.pop(address, None)
+        sock = self.peers.get(address)
+        if sock is not None:
+            sock.close()
+            self.peers[address] = None
+
+    def receive_forever(self):
+        buffers = {}  # connection: bytes of a record being received
+        while not self.closed:
+            try:
+                events = self.selector.select(1.0)
+
+            except (OSError, ValueError):
+                return  # closed
+
+            for key, _ in events:
+                sock = key.fileobj
+                if sock is self.server:
+                    try:
+                        conn = self.server.accept()[0]
+
+                    except socket.error:
+                        continue
+
+                    self.selector.register(conn, selectors.EVENT_READ)
+                    buffers[conn] = bytearray()
+                    continue
+
+                try:
+                    data = sock.recv(1 << 16)
+
+                except socket.error:
+                    data = b""
+
+                if not data:
+                    self.selector.unregister(sock)
+                    sock.close()
+                    del buffers[sock]
+                    continue
+
+                buf = buffers[sock]
+                buf += data
+                messages = self.decode(buf)
+                if messages:
+                    self.received += len(messages)
+                    try:
+                        self.deliver(messages)
+
+                    except Exception as e:
+                        logger.error("broadcast delivery failed: %s" % e)
+
+    def close(self):
+        """
+        stop in this process. In the process that created it, after the
+        workers exited, the sockets they left in `path` are removed too.
+        """
+        if self.pid != os.getpid():
+            if self.creator == os.getpid() and os.path.isdir(self.path):
+                for name in os.listdir(self.path):
+                    if name.endswith(".sock"):
+                        os.unlink(os.path.join(self.path, name))
+
+                try:
+                    os.rmdir(self.path)
+
+                except OSError:
+                    pass  # not empty
+
+            return
+
+        if self.closed:
+            return
+
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+
+        try:
+            os.unlink(self.address)
+
+        except OSError:
+            pass
+
+        self.server.close()
+        for address in list(self.peers):
+            self.drop(address)
+
+
+class WriteSelector(object):
+    """
+    One thread that calls back writers when their sockets have room
+    again, or after a delay, so that no thread waits for a slow client.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.selector = None
+        self.timers = []  # heap of (due, sequence, callback)
+        self.sequence = 0
+
+    def start(self):
+        """under the lock"""
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, sock, callback):
+        """`callback()` once `sock` can be written, or is dead"""
+        with self.lock:
+            if self.selector is None:
+                self.start()
+
+            try:
+                self.selector.register(sock, selectors.EVENT_WRITE, callback)
+
+            except KeyError:
+                # left by a closed socket of the same file descriptor
+                self.selector.unregister(sock)
+                self.selector.register(sock, selectors.EVENT_WRITE, callback)
+
+        self.waker.send(b"\0")
+
+    def later(self, delay, callback):
+        """`callback()` in `delay` seconds"""
+        with self.lock:
+            if self.selector is None:
+                self.start()
+
+            self.sequence += 1
+            heapq.heappush(self.timers,
+                           (monotonic() + delay, self.sequence, callback))
+
+        self.waker.send(b"\0")
+
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = (max(0, self.timers[0][0] - monotonic())
+                           if self.timers else None)
+
+            ready = []
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.wakeup:
+                    try:
+                        self.wakeup.recv(4096)
+
+                    except BlockingIOError:
+                        pass
+
+                    continue
+
+                with self.lock:
+                    self.selector.unregister(key.fileobj)
+
+                ready.append(key.data)
+
+            with self.lock:
+                now = monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    ready.append(heapq.heappop(self.timers)[2])
+
+            for callback in ready:
+                try:
+                    callback()
+
+                except Exception as e:
+                    logger.exception(e)
+
+
+class SendQueue(object):
+    """
+    Bounded queue of the messages sent to one websocket, written by a
+    pool thread(or an event loop task) so a slow client does not block
+    its senders. `WSocketApp.send_queue` is the policy, `attach()` makes
+    the queue of one websocket.
+
+    Pool threads write without blocking. A socket that has no room is
+    left to one `WriteSelector` thread and written again when it has, so
+    slow clients do not hold the threads the other queues need. ssl and
+    timeout sockets, which can not be written that way, block a thread.
+
+    The queue is full with `max_bytes` or `max_messages` queued. Then
+    `policy` is one of
+    - "block" - the sender waits for room
+    - "drop_oldest" - queued messages are dropped to make room
+    - "drop_newest" - the new message is dropped
+    - "coalesce" - a message with a `key` replaces the queued message of
+      that key even when there is room, otherwise the oldest are dropped
+    - "close" - the websocket is closed with `close_code`(1008 or 1013)
+
+    `len(queue)` and `size` are the queued messages and bytes, `dropped`,
+    `coalesced` and `blocked` count messages dropped, replaced and senders
+    that waited. `Hub` broadcasts do not go through the queue.
+    """
+
+    policies = ("block", "drop_oldest", "drop_newest", "coalesce", "close")
+
+    def __init__(self, max_bytes=1 << 20, max_messages=1024, policy="block",
+                 close_code=1013, workers=8):
+        if policy not in self.policies:
+            raise ValueError("policy must be one of %s" %
+                             ", ".join(self.policies))
+
+        if close_code not in (1008, 1013):
+            raise ValueError("close_code must be 1008 or 1013")
+
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+        self.close_code = close_code
+        # shared by the queues of the websockets, threads start when used
+        self.pool = ThreadPoolExecutor(workers)
+        self.selector = WriteSelector()
+        self.websocket = None
+        self.reset()
+
+    def reset(self):
+        self.items = deque()  # [message, binary, do_compress, key, size]
+        self.keys = {}  # key: its queued item
+        self.size = 0
+        self.writing = False  # a writer is draining the queue
+        self.rest = None  # of a frame written in part, with its locks held
+        self.closed = False
+        self.lock = Condition()
+        self.room = None  # `asyncio.Event` set when asyncio senders may go on
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+
+    def attach(self, websocket):
+        """a queue with these settings for `websocket`"""
+        queue = copy(self)
+        queue.websocket = websocket
+        queue.reset()
+        return queue
+
+    def __len__(self):
+        return len(self.items)
+
+    def admit(self, message, binary, do_compress, key):
+        """
+        Queue a message, under the lock. Returns `True` if it was queued,
+        `False` if it was dropped and `None` if the sender has to wait.
+        """
+        size = message_size(message)
+        if key is not None and self.policy == "coalesce":
+            item = self.keys.get(key)
+            if item is not None:
+                self.size += size - item[4]
+                item[:] = [message, binary, do_compress, key, size]
+                self.coalesced += 1
+                return True
+
+        # a message larger than the limit still goes when nothing waits
+        while self.items and any((self.size + size > self.max_bytes,
+                                  len(self.items) >= self.max_messages)):
+            if self.policy == "block":
+                return None
+
+            if self.policy in ("drop_oldest", "coalesce"):
+                self.pop()
+                self.dropped += 1
+
+            elif self.policy == "drop_newest":
+                self.dropped += 1
+                return False
+
+            else:
+                self.dropped += 1
+                self.close()
+                self.websocket.abort(self.close_code, "Send queue full")
+                return False
+
+        item = [message, binary, do_compress, key, size]
+        self.items.append(item)
+        if key is not None:
+            self.keys[key] = item
+
+        self.size += size
+        return True
+
+    def pop(self):
+        """the oldest item, under the lock"""
+        item = self.items.popleft()
+        if item[3] is not None and self.keys.get(item[3]) is item:
+            del self.keys[item[3]]
+
+        self.size -= item[4]
+        self.lock.notify_all()
+        if self.room is not None:
+            self.room.set()
+
+        return item
+
+    def put(self, message, binary=None, do_compress=True, key=None):
+        waited = False
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise WebSocketError(MSG_ALREADY_CLOSED)
+
+                queued = self.admit(message, binary, do_compress, key)
+                if queued is not None:
+                    break
+
+                if not waited:
+                    waited = True
+                    self.blocked += 1
+
+                self.lock.wait()
+
+            start = queued and not self.writing
+            if start:
+                self.writing = True
+
+        if start:
+            self.pool.submit(self.flush)
+
+        return queued
+
+    def resume(self):
+        self.pool.submit(self.flush)
+
+    def stop_writing(self):
+        """`True` if there is nothing to write, under the lock"""
+        if self.items and not self.closed:
+            return False
+
+        self.writing = False
+        self.lock.notify_all()
+        return True
+
+    def flush(self):
+        """write the queued messages, in a pool thread"""
+        websocket = self.websocket
+        sock = websocket.socket
+        if not sends_nowait(websocket):
+            return self.flush_blocking()
+
+        while True:
+            if self.rest is None:
+                if self.closed:
+                    with self.lock:
+                        self.stop_writing()
+
+                    return
+
+                # another sender has the websocket, try again soon
+                if not websocket.lock_writes(False):
+                    self.selector.later(0.01, self.resume)
+                    return
+
+                with self.lock:
+                    if self.stop_writing():
+                        websocket.unlock_writes()
+                        return
+
+                    message, binary, do_compress, key, size = self.pop()
+
+                try:
+                    self.rest = memoryview(
+                        encode_messages(websocket, (message, ), binary,
+                                        do_compress))
+
+                except Exception as e:
+                    websocket.unlock_writes()
+                    logger.exception(e)
+                    continue
+
+            try:
+                sent = sock.send(self.rest, DONTWAIT)
+
+            except BlockingIOError:
+                sent = 0
+
+            except socket.error:
+                self.rest = None
+                websocket.unlock_writes()
+                self.close()
+                with self.lock:
+                    self.stop_writing()
+
+                return
+
+            self.rest = self.rest[sent:]
+            if len(self.rest):
+                # the frame stays locked until the client takes the rest
+                self.selector.wait(sock, self.resume)
+                return
+
+            self.rest = None
+            websocket.unlock_writes()
+
+    def flush_blocking(self):
+        while True:
+            with self.lock:
+                if self.stop_writing():
+                    return
+
+                message, binary, do_compress, key, size = self.pop()
+
+            try:
+                self.websocket.write_message(message, binary, do_compress)
+
+            except WebSocketError:
+                self.close()
+
+            except Exception as e:
+                logger.exception(e)
+
+    async def put_async(self, message, binary=None, do_compress=True,
+                        key=None):
+        """`put()` of an `AsyncWebSocket`, in its event loop"""
+        if self.room is None:
+            self.room = asyncio.Event()
+
+        waited = False
+        while True:
+            if self.closed:
+                raise WebSocketError(MSG_ALREADY_CLOSED)
+
+            with self.lock:
+                queued = self.admit(message, binary, do_compress, key)
+
+            if queued is not None:
+                break
+
+            if not waited:
+                waited = True
+                self.blocked += 1
+
+            self.room.clear()
+            await self.room.wait()
+
+        if queued and not self.writing:
+            self.writing = True
+            asyncio.ensure_future(self.flush_async())
+
+        return queued
+
+    async def flush_async(self):
+        try:
+            while self.items and not self.closed:
+                with self.lock:
+                    message, binary, do_compress, key, size = self.pop()
+
+                try:
+                    await self.websocket.write_message(message, binary,
+                                                       do_compress)
+
+                except WebSocketError:
+                    self.close()
+
+        finally:
+            self.writing = False
+
+    def join(self, timeout=None):
+        """
+        Wait until the queue is empty, `timeout` seconds at most. Returns
+        `False` on timeout. Messages queued when the websocket closes are
+        dropped, this lets them go out before `close()`.
+        """
+        with self.lock:
+            return self.lock.wait_for(
+                lambda: self.closed or not (self.items or self.writing),
+                timeout)
+
+    def close(self):
+        """drop the queued messages, senders get `WebSocketError`"""
+        with self.lock:
+            self.closed = True
+            self.items.clear()
+            self.keys.clear()
+            self.size = 0
+            self.lock.notify_all()
+
+        if self.room is not None:
+            self.room.set()
+
+
+class Heartbeat(object):
+    """
+    Pings websockets from one thread for the whole server. Each websocket
+    is pinged every `interval` seconds and closed with code 1011 when
+    `max_missed` pings in a row got no pong, or when no frame but pongs
+    came for `idle_timeout` seconds(`None` for no limit). `rtt` of a
+    websocket is the round trip time of its last answered ping.
+
+    Pongs are seen by the thread or task reading the websocket. Pings and
+    close frames are written without blocking, a ping that finds no room
+    in the socket is a missed one. Closing shuts the socket down, which
+    wakes up a reader blocked on a vanished client.
+    """
+
+    interval = 20.0
+    max_missed = 2
+    idle_timeout = None
+    workers = 2  # threads writing pings that can not be written at once
+
+    def __init__(self, interval=None, max_missed=None, idle_timeout=None):
+        if interval is not None:
+            self.interval = interval
+
+        if max_missed is not None:
+            self.max_missed = max_missed
+
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
+        self.queue = []  # heap of (due, sequence, websocket)
+        self.sequence = 0
+        # websocket: [frames seen, when they last changed, missed pings,
+        # event loop of asyncio websockets]
+        self.websockets = {}
+        self.lock = Condition()
+        self.thread = None
+        self.pool = None
+        self.stopped = False
+
+    def add(self, wsock):
+        """
+        Ping `wsock` from now on. An asyncio websocket must be added from
+        its event loop.
+        """
+        loop = None
+        if isinstance(wsock, AsyncWebSocket):
+            loop = asyncio.get_running_loop()
+
+        with self.lock:
+            self.websockets[wsock] = [wsock.parser.frames, monotonic(), 0,
+                                      loop]
+            self.schedule(wsock, monotonic() + self.interval)
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def discard(self, wsock):
+        """stop pinging `wsock`"""
+        with self.lock:
+            self.websockets.pop(wsock, None)
+
+    def schedule(self, wsock, due):
+        self.sequence += 1
+        heapq.heappush(self.queue, (due, self.sequence, wsock))
+        self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.stopped:
+                    if not self.queue:
+                        self.lock.wait()
+                        continue
+
+                    wait = self.queue[0][0] - monotonic()
+                    if wait <= 0:
+                        break
+
+                    self.lock.wait(wait)
+
+                if self.stopped:
+                    return
+
+                now = monotonic()
+                due = []
+                while self.queue and self.queue[0][0] <= now:
+                    due.append(heapq.heappop(self.queue)[2])
+
+            for wsock in due:
+                try:
+                    if self.beat(wsock, now):
+                        with self.lock:
+                            self.schedule(wsock, now + self.interval)
+
+                except Exception as e:
+                    logger.exception(e)
+                    self.discard(wsock)
+
+    def beat(self, wsock, now):
+        """check and ping a due websocket, `False` if it is done"""
+        with self.lock:
+            state = self.websockets.get(wsock)
+            if state is None or wsock.closed:
+                self.websockets.pop(wsock, None)
+                return False
+
+            frames = wsock.parser.frames - wsock.pongs
+            if frames != state[0]:
+                state[0] = frames
+                state[1] = now
+
+            if wsock.ping_payload is None:
+                state[2] = 0
+
+            else:
+                state[2] += 1
+
+            missed = state[2]
+            idle = now - state[1]
+            loop = state[3]
+            self.sequence += 1
+            payload = struct.pack("!Q", self.sequence)
+
+        if missed >= self.max_missed:
+            self.expire(wsock, loop, "ping_timeout", "Ping timeout")
+            return False
+
+        if self.idle_timeout is not None and idle >= self.idle_timeout:
+            self.expire(wsock, loop, "idle_timeout", "Idle timeout")
+            return False
+
+        if loop is not None:
+            loop.call_soon_threadsafe(self.ping_async, wsock, payload)
+            return True
+
+        wsock.ping_payload = payload
+        wsock.ping_sent = monotonic()
+        sock = wsock.socket
+
+        def finish(rest):
+            self.submit(self.write_rest, wsock, sock, rest)
+
+        if wsock.write_nowait(OPCODE_PING, payload, finish) is None:
+            # written when the socket or the other sender lets it
+            self.submit(self.write, wsock, OPCODE_PING, payload)
+
+        # else a ping that did not fit is not answered, it is missed at
+        # the next beat like one without a pong
+        return True
+
+    def submit(self, func, *args):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+
+        self.pool.submit(func, *args)
+
+    def ping_async(self, wsock, payload):
+        if wsock.closed:
+            return
+
+        transport = wsock.writer.transport
+        if transport.get_write_buffer_size() > Hub.max_buffer:
+            # a client that reads nothing, it misses the ping
+            return
+
+        wsock.ping_payload = payload
+        wsock.ping_sent = monotonic()
+        try:
+            wsock.send_frame(payload, OPCODE_PING)
+
+        except WebSocketError:
+            pass
+
+    def write(self, wsock, opcode, payload):
+        try:
+            wsock.send_frame(payload, opcode)
+
+        except WebSocketError:
+            pass
+
+    def write_rest(self, wsock, sock, rest):
+        """finish a ping written in part, the send lock is held for it"""
+        try:
+            sock.sendall(rest)
+
+        except socket.error:
+            pass
+
+        finally:
+            wsock.send_lock.release()
+
+    def expire(self, wsock, loop, reason, message):
+        """close a websocket that stopped answering"""
+        self.discard(wsock)
+        metrics.inc("wsocket_heartbeat_closes_total", 1,
+                    (("reason", reason), ))
+        if loop is not None:
+            loop.call_soon_threadsafe(wsock.abort, 1011, message)
+
+        else:
+            wsock.abort(1011, message)
+
+    def close(self):
+        """stop the heartbeat thread"""
+        with self.lock:
+            self.stopped = True
+            self.websockets.clear()
+            self.queue = []
+            self.lock.notify()
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
+def handler_name(func):
+    """`module.name` of an event handler, for metrics"""
+    name = getattr(func, "__qualname__", None) or getattr(
+        func, "__name__", None) or type(func).__name__
+    return "%s.%s" % (getattr(func, "__module__", None), name)
+
+
+class Event:
+    def __init__(self, default=None, dispatcher=None):
+        self._items = []
+        self.default = default
+        self.dispatcher = dispatcher
+
+    def __call__(self, *args, **kwargs):
+        handlers = self._items or ([self.default] if self.default else [])
+        if not handlers:
+            return
+
+        def execute():
+            hooks = tracer
+            for func in handlers:
+                span = hooks and handler_span(hooks, func, args)
+                start = monotonic()
+                try:
+                    func(*args, **kwargs)
+
+                except Exception as e:
+                    logger.exception(e)
+
+                end = monotonic()
+                metrics.observe("wsocket_handler_seconds", end - start,
+                                (("handler", handler_name(func)), ))
+                if span:
+                    span.end = end
+                    hooks.end(span)
+
+        if self.dispatcher is None:
+            t = Thread(target=execute)
+            t.start()
+            return
+
+        # keep the calls for a websocket in order
+        for arg in args:
+            if isinstance(arg, WebSocket):
+                self.dispatcher.submit(arg, execute)
+                return
+
+        self.dispatcher.submit(None, execute)
+
+    async def call_async(self, *args, **kwargs):
+        """
+        Run the handlers in the calling task (asyncio server), awaiting the
+        ones that are coroutine functions.
+        """
+        handlers = self._items or ([self.default] if self.default else [])
+        hooks = tracer
+        for func in handlers:
+            span = hooks and handler_span(hooks, func, args)
+            start = monotonic()
+            try:
+                result = func(*args, **kwargs)
+                if asyncio.iscoroutine(result):
+                    await result
+
+            except Exception as e:
+                logger.exception(e)
+
+            end = monotonic()
+            metrics.observe("wsocket_handler_seconds", end - start,
+                            (("handler", handler_name(func)), ))
+            if span:
+                span.end = end
+                hooks.end(span)
+
+    def clear(self):
+        self._items = []
+
+    def __add__(self, item):
+        self._items.append(item)
+        return self
+
+    def __sub__(self, item):
+        self._items.remove(item)
+        return self
+
+    def __iadd__(self, item):
+        self._items.append(item)
+        return self
+
+    def __isub__(self, item):
+        self._items.remove(item)
+        return self
+
+
+class StaticFiles(object):
+    """
+    WSGI app serving the files under `root`, see `WSocketApp.static`.
+
+    Files are sent with `wsgi.file_wrapper`, zero-copy on the built-in
+    server. The ETag and Last-Modified of every file are cached until it
+    changes and conditional requests are answered with 304. A single
+    `Range` is honoured. If the client accepts gzip, a newer `.gz` file
+    next to the requested one is sent, or else the file is compressed
+    once and kept in memory, up to `gzip_cache_size` bytes in total.
+    """
+    block_size = 65536
+    # types worth compressing, by prefix
+    gzip_types = ("text/", "application/javascript", "application/json",
+                  "application/xml", "application/wasm", "image/svg+xml")
+    gzip_max_size = 1 << 20  # larger files are only sent from `.gz` files
+    gzip_cache_size = 16 << 20
+
+    def __init__(self, root, max_age=None, gzip=True):
+        self.root = os.path.realpath(root)
+        self.max_age = max_age  # Cache-Control max-age, seconds
+        self.gzip = gzip
+        self.files = {}  # path: file info, see `lookup`
+        self.gzipped = {}  # path: (stat key, compressed body), oldest first
+        self.gzipped_size = 0
+        self.lock = Lock()  # guards the caches, shared by request threads
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD", "GET")
+        if method not in ("GET", "HEAD"):
+            start_response(405, [("Allow", "GET, HEAD")])
+            return []
+
+        args, params = environ.get("wsgiorg.routing_args", ((), {}))
+        info = self.lookup(params.get("path", environ.get("PATH_INFO", "")))
+        if info is None:
+            start_response(404, [("Content-Type", "text/plain")])
+            return [b"Not Found"]
+
+        headers = list(info["headers"])
+        if self.not_modified(environ, info):
+            start_response(304, headers)
+            return []
+
+        path, size, start = info["path"], info["size"], 0
+        ranges = environ.get("HTTP_RANGE")
+        etag = info["etag"]
+        if ranges and environ.get("HTTP_IF_RANGE", etag) != etag:
+            ranges = None  # changed since the client got its part
+
+        body = None
+        if ranges:
+            found = self.parse_range(ranges, size)
+            if found is False:
+                start_response(416, headers + [("Content-Range",
+                                                "bytes */%d" % size)])
+                return []
+
+            if found is not None:
+                start, end = found
+                headers.append(("Content-Range",
+                                "bytes %d-%d/%d" % (start, end - 1, size)))
+                size = end - start
+                ranges = True
+
+        if ranges is not True and info["gzip"] and self.accepts_gzip(environ):
+            variant = self.gzip_variant(info)
+            if variant is not None:
+                path, body, size = variant
+                headers = [(name, value) for name, value in headers
+                           if name != "ETag"]
+                headers.append(("ETag", info["etag"][:-1] + '-gzip"'))
+                headers.append(("Content-Encoding", "gzip"))
+
+        headers.append(("Content-Length", str(size)))
+        start_response(206 if ranges is True else 200, headers)
+        if method == "HEAD":
+            return []
+
+        if body is not None:
+            return [body]
+
+        f = open(path, "rb")
+        wrapper = environ.get("wsgi.file_wrapper")
+        if wrapper is None or ranges is True:
+            return FileWrapper(f, self.block_size, start,
+                               size if ranges is True else None)
+
+        return wrapper(f, self.block_size)
+
+    def lookup(self, name):
+        """cached info of file `name` under `root`, `None` if not found"""
+        path = os.path.realpath(os.path.join(self.root, name.lstrip("/")))
+        if not path.startswith(self.root + os.sep):
+            return None  # outside `root`
+
+        try:
+            st = os.stat(path)
+
+        except OSError:
+            return None
+
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        info = self.files.get(path)
+        if info is not None and info["key"] == key:
+            return info
+
+        if not os.path.isfile(path):
+            return None
+
+        content_type, encoding = mimetypes.guess_type(path)
+        content_type = content_type or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        modified = int(st.st_mtime)
+        headers = [("Content-Type", content_type), ("ETag", etag),
+                   ("Last-Modified", formatdate(modified, usegmt=True)),
+                   ("Accept-Ranges", "bytes")]
+        compress = self.gzip and encoding is None and content_type.startswith(
+            self.gzip_types)
+        if compress:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        if self.max_age is not None:
+            headers.append(("Cache-Control", "max-age=%d" % self.max_age))
+
+        info = {
+            "path": path,
+            "key": key,
+            "size": st.st_size,
+            "etag": etag,
+            "modified": modified,
+            "headers": headers,
+            "gzip": compress,
+        }
+        with self.lock:
+            self.files[path] = info
+
+        return info
+
+    def not_modified(self, environ, info):
+        """whether the client's copy of the file is current"""
+        etags = environ.get("HTTP_IF_NONE_MATCH")
+        if etags is not None:
+            etags = [etag.strip() for etag in etags.split(",")]
+            etags = [etag.replace("W/", "", 1).replace('-gzip"', '"')
+                     for etag in etags]
+            return "*" in etags or info["etag"] in etags
+
+        since = parsedate_tz(environ.get("HTTP_IF_MODIFIED_SINCE", ""))
+        return since is not None and info["modified"] <= mktime_tz(since)
+
+    def parse_range(self, header, size):
+        """
+        (start, end) of a `bytes=` range, `None` to send the whole file
+        (also for invalid ranges like `bytes=5-2`) and `False` if the
+        range is not satisfiable.
+        """
+        unit, _, spec = header.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            return None  # multiple ranges are not supported, send it all
+
+        first, _, last = spec.strip().partition("-")
+        try:
+            if not first:
+                start, end = max(size - int(last), 0), size
+
+            else:
+                start = int(first)
+                if last and int(last) < start:
+                    return None  # invalid, the header is ignored
+
+                end = min(int(last) + 1, size) if last else size
+
+        except ValueError:
+            return None
+
+        if start >= end or start < 0:
+            return False
+
+        return start, end
+
+    def accepts_gzip(self, environ):
+        for coding in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+            name, _, q = coding.partition(";")
+            if name.strip() == "gzip":
+                q = q.replace(" ", "")
+                return q not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+
+        return False
+
+    def gzip_variant(self, info):
+        """
+        (`.gz` path, compressed body, size) of a file, with one of path
+        and body `None`. `None` if it is sent uncompressed.
+        """
+        path = info["path"]
+        try:
+            st = os.stat(path + ".gz")
+            if st.st_mtime_ns >= info["key"][0]:
+                return path + ".gz", None, st.st_size
+
+        except OSError:
+            pass
+
+        cached = self.gzipped.get(path)
+        if cached is None or cached[0] != info["key"]:
+            if info["size"] > self.gzip_max_size:
+                return None
+
+            cached = self.compress(path, info["key"])
+
+        if cached[1] is None:
+            return None
+
+        return None, cached[1], len(cached[1])
+
+    def compress(self, path, key):
+        """gzip a file into the cache, dropping the oldest files"""
+        with open(path, "rb") as f:
+            data = f.read()
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)  # gzip header
+        body = compressor.compress(data) + compressor.flush()
+        if len(body) >= len(data):
+            body = None  # cached too, so it is not compressed again
+
+        cached = (key, body)
+        with self.lock:
+            if path in self.gzipped:
+                self.gzipped_size -= len(self.gzipped.pop(path)[1] or b"")
+
+            self.gzipped[path] = cached
+            self.gzipped_size += len(body or b"")
+            while self.gzipped_size > self.gzip_cache_size:
+                oldest = next(iter(self.gzipped))
+                self.gzipped_size -= len(self.gzipped.pop(oldest)[1] or b"")
+
+        return cached
+
+
+class Router(object):
+    """
+    Finds the handler of a request. Plain paths are looked up in a dict.
+    Rules ending with `*` match paths starting with the rest of the rule
+    and `<name>` matches a path segment, `<name:int>` a number and
+    `<name:path>` the rest of the path. These rules are tried in the
+    order they were added and the last `cache_size` matches are cached.
+
+    Rules are grouped by the first segment of their path, when it has no
+    parameter, and every group is one combined regular expression. So a
+    lookup only tries the rules of its group and those without one.
+    """
+
+    cache_size = 1024
+    params = {"": "[^/]+", "int": "-?\\d+", "path": ".+"}
+    param = re.compile(r"<(\w+)(?::(\w*))?>")
+
+    def __init__(self):
+        self.static = {}  # path: {method: callback}
+        self.dynamic = []  # [(rule, regex, int params, {method: callback})]
+        self.rules = {}  # rule: {method: callback} of dynamic rules
+        self.groups = {}  # first segment, `None` if unknown: [rule index]
+        self.combined = {}  # first segment: (regex, [rule index])
+        # first segment: [rule index] of its group and those without one
+        self.merged = {}
+        # (method, path): (callback, params), least recently used first
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.static) + len(self.dynamic)
+
+    def add(self, rule, callback, method=None):
+        """
+        Route `rule` to `callback` for `method`, a method name or a list
+        of them. `None` matches any method.
+        """
+        methods = method if isinstance(method, (list, tuple, set)) else [
+            method
+        ]
+        if "<" not in rule and not rule.endswith("*"):
+            targets = self.static.setdefault(rule, {})
+
+        elif rule in self.rules:
+            targets = self.rules[rule]
+
+        else:
+            regex, ints = self.compile(rule)
+            targets = self.rules[rule] = {}
+            self.dynamic.append((rule, regex, ints, targets))
+            prefix = self.param.split(rule)[0].rstrip("*")
+            end = prefix.find("/", 1)
+            group = prefix[1:end] if prefix[:1] == "/" and end > 0 else None
+            self.groups.setdefault(group, []).append(len(self.dynamic) - 1)
+            self.combined.pop(group, None)
+            self.merged.clear()
+
+        for name in methods:
+            targets[name.upper() if name else None] = callback
+
+        self.cache.clear()
+
+    def compile(self, rule):
+        """
+        regex of a rule with a named group per parameter, and the names
+        of `int` parameters
+        """
+        pattern = []
+        ints = []
+        end = 0
+        for match in self.param.finditer(rule):
+            name, kind = match.group(1), match.group(2) or ""
+            if kind not in self.params:
+                raise ValueError("Unknown parameter type %r in %r" %
+                                 (kind, rule))
+
+            if kind == "int":
+                ints.append(name)
+
+            pattern.append(re.escape(rule[end:match.start()]))
+            pattern.append("(?P<%s>%s)" % (name, self.params[kind]))
+            end = match.end()
+
+        rest = rule[end:]
+        if rest.endswith("*"):
+            pattern.append(re.escape(rest[:-1]) + ".*")
+
+        else:
+            pattern.append(re.escape(rest))
+
+        return re.compile("".join(pattern) + "$"), ints
+
+    def search(self, group, path):
+        """index of the first rule of `group` matching `path`, or `None`"""
+        combined = self.combined.get(group)
+        if combined is None:
+            indexes = self.groups.get(group)
+            if indexes is None:
+                return None
+
+            # one regex group per rule, `lastindex` tells which one matched
+            patterns = [
+                "(%s)" % re.sub(r"\(\?P<\w+>", "(?:",
+                                self.dynamic[index][1].pattern[:-1])
+                for index in indexes
+            ]
+            combined = self.combined[group] = (re.compile(
+                "(?:%s)$" % "|".join(patterns)), indexes)
+
+        found = combined[0].match(path)
+        if found is None:
+            return None
+
+        return combined[1][found.lastindex - 1]
+
+    def candidates(self, group):
+        """indexes of the rules that may match a path in `group`, in order"""
+        if group not in self.groups:
+            return self.groups.get(None, [])
+
+        merged = self.merged.get(group)
+        if merged is None:
+            merged = self.merged[group] = sorted(
+                self.groups.get(None, []) + self.groups[group])
+
+        return merged
+
+    def match(self, method, path):
+        """
+        `(callback, params, allowed)` of a request. `callback` is `None`
+        if no rule matches, `allowed` then has the methods of the rules
+        that match the path.
+        """
+        key = (method, path)
+        hit = self.cache.get(key)
+        if hit is not None:
+            try:
+                self.cache.move_to_end(key)
+
+            except KeyError:
+                pass  # dropped by another thread
+
+            return hit[0], dict(hit[1]), None
+
+        allowed = set()
+        targets = self.static.get(path)
+        if targets is not None:
+            callback = self.pick(targets, method)
+            if callback is not None:
+                return callback, {}, None
+
+            allowed.update(targets)
+
+        if self.dynamic:
+            first = self.search(None, path)
+            end = path.find("/", 1)
+            group = path[1:end] if end > 0 else None
+            if group is not None:
+                index = self.search(group, path)
+                if index is not None and (first is None or index < first):
+                    first = index
+
+            if first is not None:
+                # rules of other groups can not match the path
+                candidates = self.candidates(group)
+                for index in candidates[bisect_left(candidates, first):]:
+                    rule, regex, ints, targets = self.dynamic[index]
+                    found = regex.match(path)
+                    if found is None:
+                        continue
+
+                    callback = self.pick(targets, method)
+                    if callback is None:
+                        allowed.update(targets)
+                        continue
+
+                    params = found.groupdict()
+                    for name in ints:
+                        params[name] = int(params[name])
+
+                    self.remember(key, callback, params)
+                    return callback, dict(params), None
+
+        return None, {}, allowed
+
+    def remember(self, key, callback, params):
+        """cache a match, dropping the least recently used ones"""
+        cache = self.cache
+        if not self.cache_size:
+            return
+
+        try:
+            while len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+
+        except KeyError:
+            pass  # emptied by another thread
+
+        cache[key] = callback, params
+
+    def pick(self, targets, method):
+        callback = targets.get(method) or targets.get(None)
+        if callback is None and method == "HEAD":
+            callback = targets.get("GET")
+
+        return callback
+
+
+class WSocketApp:
+    SUPPORTED_VERSIONS = ("13", "8", "7")
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    websocket_class = WebSocket
+    send = None
+    # permessage-deflate policy, `None` turns compression off
+    deflate = PerMessageDeflate()
+    # larger messages close the websocket with code 1009, see
+    # `WebSocket.max_message_size`
+    max_message_size = None
+    # text messages as undecoded bytes, see `WebSocket.raw_text`
+    raw_text = False
+    # a `Heartbeat` that pings the websockets of the app, `None` for none
+    heartbeat = None
+    # a `SendQueue` whose copies queue what is sent to each websocket,
+    # `None` to write on the sender's thread
+    send_queue = None
+    # a `Broadcast` that carries `publish()` to the other worker
+    # processes, `None` to publish in this process only
+    broadcast = None
+
+    def __init__(self, app=None, protocols=[], dispatcher=None):
+        self.protocols = protocols if isinstance(protocols,
+                                                 (list, tuple,
+                                                  set)) else [protocols]
+        self.app = app or self.wsgi
+        self.routes = {}  # rule: callback, as added by `route()`
+        self.router = Router()
+        # runs event handlers, see `Dispatcher`
+        self.dispatcher = dispatcher or Dispatcher()
+        # channels for `publish()`
+        self.hub = Hub()
+        self.onclose = Event(self.on_close, self.dispatcher)
+        self.onmessage = Event(self.on_message, self.dispatcher)
+        self.onconnect = Event(self.on_connect, self.dispatcher)
+
+    def on_close(self, message):
+        print(message)
+
+    def on_connect(self, client):
+        print(client)
+        client.send('you connected')
+
+    def fake(*args, **kwargs):
+        pass
+
+    def on_message(self, message, client):
+        print(repr(message))
+        try:
+            client.send("you said: " + message)
+            sleep(2)
+            client.send("you said: " + message)
+
+        except WebSocketError:
+            pass
+
+    def subscribe(self, client, channel=""):
+        """`client` receives the messages published to `channel`"""
+        if self.broadcast is not None:
+            self.broadcast.start(self.deliver)
+
+        self.hub.subscribe(client, channel)
+
+    def unsubscribe(self, client, channel=None):
+        """leave `channel`, or every channel if it is `None`"""
+        self.hub.unsubscribe(client, channel)
+
+    def publish(self, message, channel="", binary=None):
+        """
+        Send a message to every client subscribed to `channel`. It is
+        encoded once and slow clients miss it, see `Hub`. With a
+        `broadcast` it is sent to the other processes too, the number
+        returned are the clients of this process.
+        """
+        if self.broadcast is not None:
+            self.broadcast.start(self.deliver)
+            self.broadcast.publish(message, channel, binary)
+
+        return self.hub.publish(message, channel, binary)
+
+    def deliver(self, messages):
+        """publish `(message, channel, binary)`s from other processes"""
+        for message, channel, binary in messages:
+            self.hub.publish(message, channel, binary)
+
+    def route(self, r, method=None):
+        """
+        Route requests for path `r` to the decorated WSGI app, for
+        `method` or a list of methods, all of them if `None`. See `Router`
+        for the rules, their parameters are passed in
+        `environ["wsgiorg.routing_args"]`.
+        """
+        def decorator(callback):
+            self.routes[r] = callback
+            self.router.add(r, callback, method)
+            return callback
+
+        return decorator
+
+    def static(self, prefix, root, **kwargs):
+        """
+        Serve the files under directory `root` at paths starting with
+        `prefix`, see `StaticFiles` for the keyword arguments.
+        """
+        files = StaticFiles(root, **kwargs)
+        self.route(prefix.rstrip("/") + "/<path:path>", ("GET", "HEAD"))(files)
+        return files
+
+    def not_found(self, environ, start_response):
+        start_response(404)
+        return "<h1>Page Not Found(404)</h1><p><b>%s</b></p>" % (
+            environ.get("PATH_INFO") + "?" + environ.get("QUERY_STRING", "\b"))
+
+    def method_not_allowed(self, environ, start_response):
+        allowed = environ["wsocket.allowed_methods"]
+        start_response(405, [("Allow", ", ".join(sorted(allowed)))])
+        return "<h1>Method Not Allowed(405)</h1>"
+
+    def wsgi(self, environ, start_response):
+        if self.router:
+            callback, params, allowed = self.router.match(
+                environ.get("REQUEST_METHOD", "GET"),
+                environ.get("PATH_INFO", "/"))
+            if callback is not None:
+                environ["wsgiorg.routing_args"] = ((), params)
+
+            elif allowed:
+                environ["wsocket.allowed_methods"] = allowed
+                callback = self.method_not_allowed
+
+            else:
+                callback = self.not_found
+
+            r = Response(environ, start_response, callback)
+            return r.process_response()
+
+        wsock = environ.get("wsgi.websocket")
+        if not wsock:
+            start_response()
+            return "<h1>Hello World!</h1>"
+
+        self.onconnect(wsock)
+        park = environ.get("wsocket.park")
+        if park is not None:
+            # the server calls `serve_parked` when messages arrive
+            park(wsock, self.serve_parked)
+            return []
+
+        while True:
+            try:
+                message = wsock.receive()
+                if message is not None:
+                    self.onmessage(message, wsock)
+
+            except WebSocketError as e:
+                break
+
+        self.hub.unsubscribe(wsock)
+        return []
+
+    def serve_parked(self, wsock):
+        """
+        Handle the messages buffered by a websocket parked in a
+        `SelectorWSGIServer`. Runs in a worker thread, returns `False`
+        once the websocket is closed.
+        """
+        while True:
+            try:
+                message = wsock.receive(block=False)
+
+            except WebSocketError:
+                self.hub.unsubscribe(wsock)
+                return False
+
+            if message is None:
+                if wsock.closed:
+                    self.hub.unsubscribe(wsock)
+
+                return not wsock.closed
+
+            self.onmessage(message, wsock)
+
+    def is_upgrade(self, environ):
+        """is this a websocket upgrade request?"""
+        if environ.get("REQUEST_METHOD", "") != "GET":
+            return False
+        # Upgrade
+        upgrade = environ.get("HTTP_UPGRADE", "").lower().split(",")
+        if "websocket" not in map(str.strip, upgrade):
+            return False
+
+        # Connection
+        connection = environ.get("HTTP_CONNECTION", "").lower().split(",")
+        return "upgrade" in map(str.strip, connection)
+
+    def handshake(self, environ):
+        """
+        Check the websocket handshake headers of an upgrade request.
+        Returns `(status, headers, body, do_compress)`, the status is
+        "101 Switching Protocols" if the connection can be upgraded.
+        """
+        # Sec-WebSocket-Version PLUS determine mode: Hybi or Hixie
+        if "HTTP_SEC_WEBSOCKET_VERSION" not in environ:
+            logger.warning(
+                "WebSocket connection denied - Hixie76 protocol not supported."
+            )
+            self.refuse("no_version")
+            return ("426 Upgrade Required",
+                    [("Sec-WebSocket-Version",
+                      ", ".join(self.SUPPORTED_VERSIONS))],
+                    b"No Websocket protocol version defined", False)
+
+        version = environ.get("HTTP_SEC_WEBSOCKET_VERSION")
+
+        # respond with list of supported versions (descending order)
+        if version not in self.SUPPORTED_VERSIONS:
+            msg = "Unsupported WebSocket Version: %s" % version
+            logger.warning(msg)
+            self.refuse("unsupported_version")
+            return ("400 Bad Request",
+                    [("Sec-WebSocket-Version",
+                      ", ".join(self.SUPPORTED_VERSIONS))], msg.encode(),
+                    False)
+
+        key = environ.get("HTTP_SEC_WEBSOCKET_KEY", "").strip()
+        if not len(key):
+            msg = "Sec-WebSocket-Key header is missing/empty"
+            logger.warning(msg)
+            self.refuse("missing_key")
+            return "400 Bad Request", [], msg.encode(), False
+
+        try:
+            key_len = len(b64decode(key))
+
+        except TypeError:
+            msg = "Invalid key: %s" % key
+            logger.warning(msg)
+            self.refuse("invalid_key")
+            return "400 Bad Request", [], msg.encode(), False
+
+        if key_len != 16:
+            msg = "Invalid key: %s" % key
+            logger.warning(msg)
+            self.refuse("invalid_key")
+            return "400 Bad Request", [], msg.encode(), False
+
+        # Sec-WebSocket-Protocol
+        requested_protocols = list(
+            map(str.strip,
+                environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL", "").split(",")))
+        protocols = None
+        protocols = set(requested_protocols) and set(self.protocols)
+        logger.debug("Protocols allowed: {0}".format(", ".join(protocols)))
+
+        # the first permessage-deflate offer we can accept
+        do_compress = None
+        if self.deflate is not None:
+            for name, params in parse_extensions(
+                    environ.get("HTTP_SEC_WEBSOCKET_EXTENSIONS", "")):
+                if name == "permessage-deflate":
+                    do_compress = self.deflate.accept(params)
+                    if do_compress is not None:
+                        break
+
+        if PY3:
+            accept = b64encode(
+                sha1((key + self.GUID).encode("latin-1")).digest())
+            accept = accept.decode("latin-1")
+
+        else:
+            accept = b64encode(sha1(key + self.GUID).digest())
+
+        headers = [
+            ("Upgrade", "websocket"),
+            ("Connection", "Upgrade"),
+            ("Sec-WebSocket-Accept", accept),
+        ]
+
+        if do_compress:
+            headers.append(
+                ("Sec-WebSocket-Extensions", do_compress.response()))
+
+        if protocols:
+            headers.append(("Sec-WebSocket-Protocol", ", ".join(protocols)))
+
+        logger.debug("WebSocket request accepted, switching protocols")
+        metrics.inc("wsocket_handshakes_total")
+        return "101 Switching Protocols", headers, b"", do_compress
+
+    def refuse(self, reason):
+        """count a refused handshake"""
+        metrics.inc("wsocket_handshake_failures_total", 1,
+                    (("reason", reason), ))
+
+    def __call__(self, environ, start_response):
+        if "wsgi.websocket" in environ or not self.is_upgrade(environ):
+            r = Response(environ, start_response, self.app)
+            return r.process_response()
+
+        status, headers, body, do_compress = self.handshake(environ)
+        if not status.startswith("101"):
+            start_response(status, headers)
+            return [body]
+
+        write = start_response(status, headers)
+        read = environ["wsgi.input"].read
+        write(b"")
+        websocket = self.websocket_class(environ, read, write, self,
+                                         do_compress)
+        if self.max_message_size is not None:
+            websocket.max_message_size = self.max_message_size
+
+        if self.raw_text:
+            websocket.raw_text = True
+
+        if self.heartbeat is not None:
+            self.heartbeat.add(websocket)
+
+        if self.send_queue is not None:
+            websocket.send_queue = self.send_queue.attach(websocket)
+
+        environ.update({
+            "wsgi.websocket_version": environ["HTTP_SEC_WEBSOCKET_VERSION"],
+            "wsgi.websocket": websocket
+        })
+        r = Response(environ, start_response, self.app)
+        r.start_response = self.fake
+        return r.process_response(False)
+
+
+# for version compat
+class WebSocketHandler(FixedHandler):
+    def get_app(self):
+        return WSocketApp(self.server.get_app())
+
+
+WSocketHandler = WebSocketHandler
+
+
+class WSocketServer(ThreadingWSGIServer):
+    def set_app(self, app, *args, **kwargs):
+        ThreadingWSGIServer.set_app(self, WSocketApp(app), *args, **kwargs)
+
+
+class AsyncWebSocket(WebSocket):
+    """
+    asyncio flavour of `WebSocket`. `receive()` and `send()` are
+    coroutines, frames are read from an `asyncio.StreamReader` and written
+    to an `asyncio.StreamWriter`.
+    """
+
+    def __init__(self, environ, reader, writer, handler, do_compress):
+        WebSocket.__init__(self, environ, reader.read, None, handler,
+                           do_compress)
+        self.reader = reader
+        self.writer = writer
+        self.stream_lock = asyncio.Lock()  # held while a message is sent
+        self.deferred = None
+
+    async def read_frame(self):
+        parser = self.parser
+        frame = None
+
+        while frame is None:
+            if self.max_message_size is not None and parser.header is not None:
+                self.check_size(parser.header[4])
+
+            data = await self.reader.read(
+                max(parser.needed, self.read_buffer_size))
+            if not data:
+                raise WebSocketError("Unexpected EOF while decoding frame")
+
+            parser.feed(data)
+            frame = parser.next_frame()
+
+        return frame
+
+    async def read_chunk(self):
+        chunk = self.next_chunk()
+        while chunk is None:
+            data = await self.reader.read(self.read_buffer_size)
+            if not data:
+                raise WebSocketError("Unexpected EOF while decoding frame")
+
+            self.parser.feed(data)
+            chunk = self.next_chunk()
+
+        return chunk
+
+    async def read_message(self):
+        while True:
+            frame = self.parser.next_frame()
+            if frame is None:
+                frame = await self.read_frame()
+
+            message = self.handle_frame(frame)
+            if message is not None or self.closed:
+                return message
+
+    async def receive(self):
+        """
+        Read and return a message from the stream. If `None` is returned, then
+        the socket is considered closed/errored.
+        """
+        if self.closed:
+            self.handler.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            return await self.read_message()
+
+        except (UnicodeError, socket.error) as e:
+            self.close_on_error(e)
+
+        return None
+
+    async def receive_stream(self):
+        """
+        Wait for the next message and return it as an
+        `AsyncMessageStream`, see `WebSocket.receive_stream()`.
+        """
+        if self.closed:
+            self.handler.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            chunk = await self.read_chunk()
+
+        except (UnicodeError, socket.error) as e:
+            self.close_on_error(e)
+            return None
+
+        return AsyncMessageStream(self, chunk)
+
+    def write_frame(self, header, payload):
+        # buffered by the transport, `send()` waits for it to drain
+        if self.batched is not None:
+            self.batched += header
+            self.batched += payload
+
+        else:
+            self.writer.writelines((header, payload))
+
+    def write_encoded(self, data):
+        AsyncWebSocket.write_frame(self, b"", data)
+
+    def abort(self, code=1011, message=""):
+        """close and drop what the transport holds, the client is gone"""
+        if not self.closed:
+            self.close(code, message)
+
+        self.writer.transport.abort()
+
+    async def send(self, message, binary=None, do_compress=True, key=None):
+        """
+        Send a frame over the websocket with message as its payload, see
+        `WebSocket.send()`.
+        """
+        if self.send_queue is not None:
+            return await self.send_queue.put_async(message, binary,
+                                                   do_compress, key)
+
+        await self.write_message(message, binary, do_compress)
+
+    async def write_message(self, message, binary=None, do_compress=True):
+        async with self.stream_lock:
+            WebSocket.write_message(self, message, binary, do_compress)
+
+        try:
+            await self.writer.drain()
+
+        except socket.error:
+            self.handler.on_close(MSG_SOCKET_DEAD)
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
+    async def send_many(self, messages, binary=None, do_compress=True):
+        """`WebSocket.send_many()`, waits for the transport to drain"""
+        if self.send_queue is not None:
+            for message in messages:
+                await self.send_queue.put_async(message, binary, do_compress)
+
+            return
+
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        async with self.stream_lock:
+            with self.send_lock:
+                self.write_encoded(
+                    encode_messages(self, messages, binary, do_compress))
+
+        try:
+            await self.writer.drain()
+
+        except socket.error:
+            self.handler.on_close(MSG_SOCKET_DEAD)
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
+    async def send_stream(self, data, binary=True, fragment_size=65536,
+                          do_compress=True):
+        """
+        `WebSocket.send_stream()`, `data` may also be an async iterable.
+        Each fragment waits for the transport to drain.
+        """
+        async with self.stream_lock:
+            # broadcasts wait in `deferred` until the message is sent
+            self.deferred = []
+            fragments = Fragmenter(self, binary, fragment_size, do_compress)
+            try:
+                if hasattr(data, "__aiter__"):
+                    async for chunk in data:
+                        await self.write_fragments(fragments.encode(chunk))
+
+                else:
+                    for chunk in iter_chunks(data, fragment_size):
+                        await self.write_fragments(fragments.encode(chunk))
+
+                await self.write_fragments(fragments.finish())
+
+            except WebSocketError:
+                self.handler.on_close(MSG_SOCKET_DEAD)
+                raise WebSocketError(MSG_SOCKET_DEAD)
+
+            except Exception:
+                self.close(1011, "Internal Error")
+                raise
+
+            finally:
+                deferred, self.deferred = self.deferred, None
+                if deferred and not self.closed:
+                    self.writer.writelines(deferred)
+
+    async def write_fragments(self, frames):
+        for header, payload in frames:
+            self.write_fragment(header, payload)
+            try:
+                await self.writer.drain()
+
+            except socket.error as e:
+                raise WebSocketError(MSG_SOCKET_DEAD + " : " + str(e))
+
+
+class AsyncMessageStream(MessageStream):
+    """
+    `MessageStream` of an `AsyncWebSocket`, `read()`, `close()` and
+    `next_chunk()` are coroutines and it is iterated with `async for`.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def __aiter__(self):
+        if self.buffer:
+            chunk, self.buffer = self.buffer, self.buffer[:0]
+            yield chunk
+
+        while not self.done:
+            chunk = await self.next_chunk()
+            if chunk:
+                yield chunk
+
+    async def next_chunk(self):
+        if self.done:
+            return self.buffer[:0]
+
+        if self.websocket.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        try:
+            opcode, fin, data = await self.websocket.read_chunk()
+
+        except (UnicodeError, socket.error) as e:
+            self.websocket.close_on_error(e)
+            raise WebSocketError(MSG_CLOSED)
+
+        return self.decode(fin, data)
+
+    async def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            self.buffer += await self.next_chunk()
+
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = self.buffer, self.buffer[:0]
+
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    async def close(self):
+        self.buffer = self.buffer[:0]
+        try:
+            while not self.done:
+                await self.next_chunk()
+
+        except WebSocketError:
+            self.done = True
+
+
+class AsyncWSocketApp(WSocketApp):
+    """
+    Event based app for the asyncio server. `onconnect` and `onmessage`
+    handlers may be coroutine functions. They run in the connection's task,
+    so messages of a client are handled one by one, in order.
+    """
+
+    websocket_class = AsyncWebSocket
+    loop = None  # of the subscribers, for messages from `broadcast`
+
+    async def on_connect(self, client):
+        print(client)
+        await client.send('you connected')
+
+    async def on_message(self, message, client):
+        print(repr(message))
+        try:
+            await client.send("you said: " + message)
+            await asyncio.sleep(2)
+            await client.send("you said: " + message)
+
+        except WebSocketError:
+            pass
+
+    async def serve_websocket(self, wsock):
+        await self.onconnect.call_async(wsock)
+        while True:
+            try:
+                message = await wsock.receive()
+                if message is not None:
+                    await self.onmessage.call_async(message, wsock)
+
+            except WebSocketError:
+                break
+
+        self.hub.unsubscribe(wsock)
+
+    def subscribe(self, client, channel=""):
+        self.loop = asyncio.get_running_loop()
+        WSocketApp.subscribe(self, client, channel)
+
+    def deliver(self, messages):
+        # subscribers are written from their loop, not the broadcast thread
+        if self.loop is None:
+            WSocketApp.deliver(self, messages)
+
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(WSocketApp.deliver, self,
+                                           messages)
+
+
+class AsyncWSocketServer(object):
+    """
+    asyncio HTTP server for `AsyncWSocketApp`. Each connection is a task
+    instead of a thread, so idle websockets only cost some memory. Plain
+    HTTP requests are passed to the WSGI app in a worker thread and their
+    connections closed after the response.
+    """
+
+    max_header_size = 65536
+
+    def __init__(self, app, host="127.0.0.1", port=8080, **options):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.options = options  # passed on to `asyncio.start_server`
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection,
+                                                 self.host,
+                                                 self.port,
+                                                 limit=self.max_header_size,
+                                                 **self.options)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    def get_environ(self, head, writer):
+        request_line, _, header_lines = head.decode("latin-1").partition(
+            "\r\n")
+        method, target, version = request_line.split(" ", 2)
+        path, _, query = target.partition("?")
+        server_name, server_port = writer.get_extra_info("sockname")[:2]
+        remote_addr, remote_port = writer.get_extra_info("peername")[:2]
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": version.strip(),
+            "REMOTE_ADDR": remote_addr,
+            "REMOTE_PORT": str(remote_port),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+
+        for line in header_lines.split("\r\n"):
+            name, _, value = line.partition(":")
+            if not value:
+                continue
+
+            key = name.strip().upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+
+            value = value.strip()
+            if key in environ:
+                value = environ[key] + "," + value
+
+            environ[key] = value
+
+        return environ
+
+    def call_app(self, environ):
+        """run the WSGI app and collect the whole response"""
+        response = []
+        body = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return body.append
+
+        results = self.app(environ, start_response)
+        try:
+            for data in results:
+                body.append(data)
+
+        finally:
+            if hasattr(results, "close"):
+                results.close()
+
+        status, headers = response or ["200 OK", []]
+        return status, headers, b"".join(body)
+
+    def write_response(self, writer, status, headers, body):
+        headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+        headers.append(("Content-Length", str(len(body))))
+        headers.append(("Connection", "close"))
+        self.write_head(writer, status, headers)
+        writer.write(body)
+
+    def write_head(self, writer, status, headers):
+        lines = ["HTTP/1.1 %s" % status]
+        lines.extend("%s: %s" % header for header in headers)
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def read_body(self, reader, environ):
+        """
+        the request body, `None` if its transfer coding is not supported.
+        Raises `ValueError` if it is malformed.
+        """
+        coding = environ.get("HTTP_TRANSFER_ENCODING")
+        if coding is None:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            if length < 0:
+                raise ValueError("negative Content-Length")
+
+            return await reader.readexactly(length)
+
+        if coding.strip().lower() != "chunked":
+            return None
+
+        body = bytearray()
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            size = int(line.split(b";", 1)[0].strip(), 16)  # no extensions
+            if size < 0:
+                raise ValueError("negative chunk size")
+
+            if not size:
+                break
+
+            body += await reader.readexactly(size + 2)
+            if body[-2:] != b"\r\n":
+                raise ValueError("chunk without CRLF")
+
+            del body[-2:]
+
+        # trailers, up to an empty line
+        while await reader.readuntil(b"\r\n") != b"\r\n":
+            pass
+
+        environ["CONTENT_LENGTH"] = str(len(body))
+        return bytes(body)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+                environ = self.get_environ(head, writer)
+
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    ValueError):
+                return
+
+            if not self.app.is_upgrade(environ):
+                try:
+                    body = await self.read_body(reader, environ)
+
+                except asyncio.IncompleteReadError:
+                    return  # the client went away
+
+                except (ValueError, asyncio.LimitOverrunError):
+                    self.write_response(writer, "400 Bad Request",
+                                        [("Content-Type", "text/plain")],
+                                        b"Bad Request")
+                    await writer.drain()
+                    return
+
+                if body is None:
+                    self.write_response(writer, "501 Not Implemented",
+                                        [("Content-Type", "text/plain")],
+                                        b"Transfer-Encoding not supported")
+                    await writer.drain()
+                    return
+
+                environ["wsgi.input"] = BytesIO(body)
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(None, self.call_app,
+                                                      environ)
+                self.write_response(writer, *response)
+                await writer.drain()
+                return
+
+            status, headers, body, do_compress = self.app.handshake(environ)
+            if not status.startswith("101"):
+                self.write_response(writer, status, headers, body)
+                await writer.drain()
+                return
+
+            self.write_head(writer, status, headers)
+            wsock = self.app.websocket_class(environ, reader, writer,
+                                             self.app, do_compress)
+            if self.app.max_message_size is not None:
+                wsock.max_message_size = self.app.max_message_size
+
+            if self.app.raw_text:
+                wsock.raw_text = True
+
+            if self.app.heartbeat is not None:
+                self.app.heartbeat.add(wsock)
+
+            if self.app.send_queue is not None:
+                wsock.send_queue = self.app.send_queue.attach(wsock)
+
+            environ.update({
+                "wsgi.websocket_version":
+                environ["HTTP_SEC_WEBSOCKET_VERSION"],
+                "wsgi.websocket": wsock
+            })
+            await self.app.serve_websocket(wsock)
+
+        except socket.error:
+            pass
+
+        finally:
+            writer.close()
+
+
+class Span(object):
+    """
+    A traced operation: `name`, the websocket, app or handler function
+    it ran for(`target`), the request path, the size of the data it
+    handled and its `time.monotonic()` `start` and `end`.
+    """
+    __slots__ = ("name", "target", "path", "size", "start", "end")
+
+    def __init__(self, name, target, path, size):
+        self.name = name
+        self.target = target
+        self.path = path
+        self.size = size
+        self.start = self.end = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer(object):
+    """
+    Tracing hooks, installed with `set_tracer()`. `begin(span)` and
+    `end(span)` are called around websocket handshakes("handshake"),
+    frame decoding("decode"), decompression("inflate"), compression
+    ("compress"), socket writes("write") and event handler calls
+    ("handler"). They run on the hot path, they should be quick and must
+    not raise.
+    """
+
+    def begin(self, span):
+        pass
+
+    def end(self, span):
+        pass
+
+
+class SlowestCalls(Tracer):
+    """
+    Profiler keeping the `count` slowest spans named in `spans`, event
+    handler calls by default, with their path and data size. It samples
+    one span in `sample`.
+    """
+
+    def __init__(self, count=10, spans=("handler", ), sample=1):
+        self.count = count
+        self.spans = frozenset(spans)
+        self.sample = sample
+        self.seen = 0
+        # heap of (seconds, number, span, target, path, size)
+        self.slowest = []
+        self.lock = Lock()
+
+    def end(self, span):
+        if span.name not in self.spans:
+            return
+
+        self.seen += 1
+        if self.seen % self.sample:
+            return
+
+        target = span.target
+        if span.name == "handler":
+            target = handler_name(target)
+
+        else:
+            target = type(target).__name__
+
+        entry = (span.duration, self.seen, span.name, target, span.path,
+                 span.size)
+        with self.lock:
+            if len(self.slowest) < self.count:
+                heapq.heappush(self.slowest, entry)
+
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def report(self):
+        """the recorded spans as dicts, slowest first"""
+        with self.lock:
+            entries = sorted(self.slowest, reverse=True)
+
+        return [
+            dict(seconds=seconds, span=name, target=target, path=path,
+                 size=size)
+            for seconds, number, name, target, path, size in entries
+        ]
+
+
+def message_size(message):
+    """bytes of `message` as it is sent, 0 if it is not text or bytes"""
+    if isinstance(message, text_type):
+        if message.isascii():
+            return len(message)
+
+        return len(message.encode("utf-8", "surrogatepass"))
+
+    if isinstance(message, (bytes, bytearray)):
+        return len(message)
+
+    if isinstance(message, memoryview):
+        return message.nbytes
+
+    return 0
+
+
+def handler_span(hooks, func, args):
+    """begin the span of an event handler call"""
+    path = size = None
+    for arg in args:
+        if isinstance(arg, WebSocket):
+            path = arg.path
+
+        elif size is None:
+            size = message_size(arg)
+
+    span = Span("handler", func, path, size or 0)
+    span.start = monotonic()
+    hooks.begin(span)
+    return span
+
+
+def trace(method, name, describe, hooks):
+    """`method` calling the hooks of a `Tracer` around it"""
+
+    def traced(self, *args):
+        span = Span(name, self, *describe(self, *args))
+        span.start = monotonic()
+        hooks.begin(span)
+        try:
+            return method(self, *args)
+
+        finally:
+            span.end = monotonic()
+            hooks.end(span)
+
+    traced.untraced = method
+    return traced
+
+
+# `(class, method, span, describe)`, `describe` gives `(path, size)` of a
+# call from its arguments
+TRACED = (
+    (WSocketApp, "handshake", "handshake",
+     lambda app, environ: (environ.get("PATH_INFO"), 0)),
+    (WebSocket, "decode_frame", "decode",
+     lambda wsock, frame: (wsock.path, len(frame[4]))),
+    (WebSocket, "inflate", "inflate",
+     lambda wsock, payload, fin: (wsock.path, len(payload))),
+    (WebSocket, "compress", "compress",
+     lambda wsock, message: (wsock.path, len(message))),
+    (WebSocket, "write_frame", "write",
+     lambda wsock, header, payload: (wsock.path, len(header) + len(payload))),
+    (AsyncWebSocket, "write_frame", "write",
+     lambda wsock, header, payload: (wsock.path, len(header) + len(payload))),
+)
+tracer = None
+
+
+def set_tracer(hooks):
+    """
+    Install a `Tracer`, `None` removes it. Traced methods are wrapped
+    only while a tracer is installed, so tracing costs nothing without.
+    """
+    global tracer
+    tracer = hooks
+    for cls, attr, name, describe in TRACED:
+        method = cls.__dict__[attr]
+        method = getattr(method, "untraced", method)
+        setattr(
+            cls, attr,
+            method if hooks is None else trace(method, name, describe, hooks))
+
+
+class Supervisor(object):
+    """
+    Runs `target(worker)` in `workers` forked processes, numbered from 0,
+    and starts a new one when a worker exits. SIGINT and SIGTERM stop the
+    workers with SIGTERM, those that are still running after
+    `stop_timeout` seconds are killed. `forwarded` signals are passed on
+    to the workers. Workers ignore SIGINT, a Ctrl-C reaches them through
+    the supervisor.
+    """
+
+    forwarded = ("SIGHUP", "SIGUSR1", "SIGUSR2")
+    restart_delay = 1.0  # before restarting a worker that died this young
+    stop_timeout = 10.0
+
+    def __init__(self, target, workers):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("workers need os.fork()")
+
+        self.target = target
+        self.workers = workers
+        self.pids = {}  # pid: (worker, start time)
+        self.stopping = False
+
+    def start_worker(self, worker):
+        # or the worker writes out what the supervisor buffered too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = (worker, monotonic())
+            return
+
+        # the worker
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for name in self.forwarded:
+                if hasattr(signal, name):
+                    signal.signal(getattr(signal, name), signal.SIG_DFL)
+
+            self.target(worker)
+
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def signal_workers(self, signum):
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+
+            except OSError:
+                pass
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+        killer = Timer(self.stop_timeout, self.signal_workers,
+                       (signal.SIGKILL, ))
+        killer.daemon = True
+        killer.start()
+
+    def forward(self, signum, frame):
+        self.signal_workers(signum)
+
+    def run(self):
+        """start the workers and supervise them until they are stopped"""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for name in self.forwarded:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self.forward)
+
+        for worker in range_type(self.workers):
+            self.start_worker(worker)
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+
+            except ChildProcessError:
+                break
+
+            if pid not in self.pids:
+                continue
+
+            worker, started = self.pids.pop(pid)
+            if self.stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = "was killed by signal %d" % os.WTERMSIG(status)
+
+            else:
+                reason = "exited with status %d" % os.WEXITSTATUS(status)
+
+            logger.warning("worker %d (pid %d) %s, restarting" %
+                           (worker, pid, reason))
+            if monotonic() - started < self.restart_delay:
+                sleep(self.restart_delay)
 
-        if isinstance(results, string_types):
-            return [results.encode("utf-8")]
+            if not self.stopping:
+                self.start_worker(worker)
 
-        elif isinstance(results, bytes):
-            return [results]
 
-        elif hasattr(results, "__iter__"):
-            while not self.headers_sent:
-                pass
+def reserve_port(host, port, family=socket.AF_INET):
+    """
+    A socket bound with SO_REUSEPORT to `port` of `host`, a free port if
+    it is 0, for workers to bind too. It does not listen, connections go
+    to the workers.
+    """
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
 
-            for result in results:
-                if isinstance(result, string_types):
-                    self.write(result.encode("utf-8"))
 
-                elif isinstance(result, bytes):
-                    self.write(result)
+def run(app=WSocketApp(), host="127.0.0.1", port=8080, **options):
+    handler_cls = options.get("handler_class", FixedHandler)
+    server_cls = options.get("server_class", ThreadingWSGIServer)
+    workers = options.get("workers", 1)
+    # socket options of the connections, see `FixedHandler` and
+    # `ThreadingWSGIServer`
+    tuning = dict((name, options[name]) for name in ("tcp_nodelay", "tcp_cork")
+                  if name in options)
+    if tuning:
+        handler_cls = type(handler_cls.__name__, (handler_cls, ), tuning)
+
+    buffers = dict((name, options[name]) for name in ("sndbuf", "rcvbuf")
+                   if name in options)
+    if buffers:
+        server_cls = type(server_cls.__name__, (server_cls, ), buffers)
 
-                else:
-                    self.write(str(result).encode("utf-8"))
+    if ":" in host:  # Fix wsgiref for IPv6 addresses.
+        if getattr(server_cls, "address_family") == socket.AF_INET:
 
-            return []
+            class server_cls(server_cls):
+                address_family = socket.AF_INET6
 
-        else:
-            return [str(result).encode("utf-8")]
+    if workers > 1:
+        # a server per process, the kernel spreads connections over them
+        class server_cls(server_cls):
+            reuse_port = True
 
-    def start_response(self, status="200 OK", headers=[]):
-        if self.headers_sent:
-            return
+        reserved = reserve_port(host, port, server_cls.address_family)
+        port = reserved.getsockname()[1]
 
-        status = self.process_status(status)
+        def serve(worker):
+            make_server(host, port, app, server_cls,
+                        handler_cls).serve_forever()
 
-        if isinstance(headers, dict):
-            headers = list(headers.items())
+        print("Server started at http://%s:%i with %d workers." %
+              (host, port, workers))
+        Supervisor(serve, workers).run()
+        reserved.close()
+        if getattr(app, "broadcast", None) is not None:
+            app.broadcast.close()
 
-        if self.code in self.bad_headers:
-            bad_headers = self.bad_headers[self.code]
-            headers = [h for h in headers if h[0] not in bad_headers]
+        print("\nServer stopped.")
+        return
 
-        self.write = self._start_response(status, headers)
-        self.headers_sent = True
-        return self.write
+    srv = make_server(host, port, app, server_cls, handler_cls)
+    port = srv.server_port  # update port actual port (0 means random)
+    print("Server started at http://%s:%i." % (host, port))
+    try:
+        srv.serve_forever()
 
-    def process_status(self, status):
-        if isinstance(status, int):
-            code, status = status, _HTTP_STATUS_LINES.get(status)
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+        srv.server_close()  # Prevent ResourceWarning: unclosed socket
 
-        elif " " in status:
-            if "\n" in status or "\r" in status or "\0" in status:
-                raise ValueError("Status line must not include control chars.")
 
-            status = status.strip()
-            code = int(status.split()[0])
+def run_async(app=None, host="127.0.0.1", port=8080, **options):
+    """asyncio counterpart of `run()`, serves an `AsyncWSocketApp`"""
+    server_cls = options.pop("server_class", AsyncWSocketServer)
+    workers = options.pop("workers", 1)
+    app = app or AsyncWSocketApp()
 
-        else:
-            raise ValueError("String status line without a reason phrase.")
+    if workers > 1:
+        reserved = reserve_port(host, port,
+                                socket.AF_INET6 if ":" in host else
+                                socket.AF_INET)
+        port = reserved.getsockname()[1]
+        options["reuse_port"] = True
 
-        if not 100 <= code <= 999:
-            raise ValueError("Status code out of range.")
+        def serve(worker):
+            asyncio.run(server_cls(app, host, port, **options).serve_forever())
 
-        self.code = code
-        return str(status or ("%d Unknown" % code))
+        print("Server started at http://%s:%i with %d workers." %
+              (host, port, workers))
+        Supervisor(serve, workers).run()
+        reserved.close()
+        if getattr(app, "broadcast", None) is not None:
+            app.broadcast.close()
 
+        print("\nServer stopped.")
+        return
 
-class Event:
-    def __init__(self, default=None):
-        self._items = []
-        self.default = default
+    srv = server_cls(app, host, port, **options)
 
-    def __call__(self, *args, **kwargs):
-        def execute():
-            for func in self._items:
-                try:
-                    func(*args, **kwargs)
+    async def serve():
+        await srv.start()
+        print("Server started at http://%s:%i." % (host, srv.port))
+        await srv.serve_forever()
 
-                except Exception as e:
-                    logger.exception(e)
+    try:
+        asyncio.run(serve())
 
-        if not len(self._items):
-            if self.default:
-                t = Thread(target=self.default, args=args, kwargs=kwargs)
-                t.start()
-                return
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
 
-            else:
-                return
 
-        t = Thread(target=execute)
-        t.start()
+def client_request(url, protocols=(), headers=(), deflate=None):
+    """
+    `(host, port, secure, key, request)` of the upgrade request to a
+    ws:// or wss:// `url`
+    """
+    parts = urlparse(url)
+    if parts.scheme not in ("ws", "wss"):
+        raise ValueError("Not a websocket url: %r" % url)
+
+    secure = parts.scheme == "wss"
+    port = parts.port or (443 if secure else 80)
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+
+    key = b64encode(urandom(16)).decode("latin-1")
+    lines = [
+        "GET %s HTTP/1.1" % target,
+        "Host: %s" % parts.netloc,
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Key: %s" % key,
+        "Sec-WebSocket-Version: 13",
+    ]
+    if protocols:
+        lines.append("Sec-WebSocket-Protocol: %s" % ", ".join(protocols))
+
+    if deflate is not None:
+        lines.append("Sec-WebSocket-Extensions: %s" % deflate.offer())
+
+    lines.extend("%s: %s" % header for header in headers)
+    request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return parts.hostname, port, secure, key, request
+
+
+def client_response(head, key, deflate=None):
+    """
+    Check the response to an upgrade request. Returns `(environ,
+    do_compress)`, `environ` holds the response headers as HTTP_*
+    variables like a WSGI environ.
+    """
+    status, _, lines = head.decode("latin-1").partition("\r\n")
+    if status.split(" ", 2)[1:2] != ["101"]:
+        raise WebSocketError("Handshake refused: %s" % status)
+
+    environ = {"HTTP_SEC_WEBSOCKET_VERSION": "13"}
+    for line in lines.split("\r\n"):
+        name, _, value = line.partition(":")
+        if name:
+            environ["HTTP_" + name.strip().upper().replace("-", "_")] = (
+                value.strip())
+
+    accept = b64encode(
+        sha1((key + WSocketApp.GUID).encode("latin-1")).digest())
+    if environ.get("HTTP_SEC_WEBSOCKET_ACCEPT") != accept.decode("latin-1"):
+        raise WebSocketError("Invalid Sec-WebSocket-Accept")
+
+    do_compress = None
+    for name, params in parse_extensions(
+            environ.get("HTTP_SEC_WEBSOCKET_EXTENSIONS", "")):
+        unexpected = name != "permessage-deflate" or deflate is None
+        if unexpected or do_compress is not None:
+            raise WebSocketError("Unexpected extension: %s" % name)
+
+        do_compress = deflate.confirm(params)
+        if do_compress is None:
+            raise WebSocketError("Invalid permessage-deflate response")
+
+    return environ, do_compress
+
+
+def mask_frame(header, payload):
+    """a frame masked with a new random key, as clients send them"""
+    mask = urandom(4)
+    header = bytearray(header)
+    header[1] |= MASK_MASK
+    header += mask
+    return header, mask_bytes(mask, payload)
+
+
+def encode_messages(websocket, messages, binary=None, do_compress=True):
+    """
+    One buffer with the frames of `messages`, masked if `websocket` is a
+    client, to send with a single write. Called under the send lock.
+    """
+    data = bytearray()
+    for message in messages:
+        if not message:
+            continue
 
-    def clear(self):
-        self._items = []
+        if binary is None:
+            opcode = (OPCODE_TEXT if isinstance(message, string_types) else
+                      OPCODE_BINARY)
 
-    def __add__(self, item):
-        self._items.append(item)
-        return self
+        else:
+            opcode = OPCODE_BINARY if binary else OPCODE_TEXT
 
-    def __sub__(self, item):
-        self._items.remove(item)
-        return self
+        header, payload = websocket.encode_frame(message, opcode, do_compress)
+        if websocket.masked:
+            header, payload = mask_frame(header, payload)
 
-    def __iadd__(self, item):
-        self._items.append(item)
-        return self
+        data += header
+        data += payload
+        websocket.frames_out += 1
 
-    def __isub__(self, item):
-        self._items.remove(item)
-        return self
+    websocket.bytes_out += len(data)
+    return data
 
 
-class WSocketApp:
-    SUPPORTED_VERSIONS = ("13", "8", "7")
-    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-    websocket_class = WebSocket
-    send = None
-    routes = {}
+class WebSocketClient(WebSocket):
+    """
+    Blocking websocket client, the frame code of `WebSocket` with frames
+    masked as clients must send them. permessage-deflate is offered with
+    the compression policy of `deflate`, `None` to not offer it. `send()`
+    does not wait for replies, so messages can be pipelined while another
+    thread is in `receive()`, and `send_many()` writes a burst of
+    messages at once.
+    """
 
-    def __init__(self, app=None, protocols=[]):
-        self.protocols = protocols if isinstance(protocols,
-                                                 (list, tuple,
-                                                  set)) else [protocols]
-        self.app = app or self.wsgi
-        self.onclose = Event(self.on_close)
-        self.onmessage = Event(self.on_message)
-        self.onconnect = Event(self.on_connect)
+    max_header_size = 65536
+    masked = True
+
+    def __init__(self, url, protocols=(), headers=(), deflate=True,
+                 timeout=None, ssl_context=None, handler=None):
+        if deflate is True:
+            deflate = PerMessageDeflate()
+
+        host, port, secure, key, request = client_request(
+            url, protocols, headers, deflate or None)
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if secure:
+                context = ssl_context or ssl.create_default_context()
+                sock = context.wrap_socket(sock, server_hostname=host)
+
+            sock.sendall(request)
+            stream = sock.makefile("rb")
+            head = bytearray()
+            while not head.endswith(b"\r\n\r\n"):
+                line = stream.readline(self.max_header_size)
+                if not line or len(head) > self.max_header_size:
+                    raise WebSocketError("Invalid handshake response")
+
+                head += line
+
+            environ, do_compress = client_response(bytes(head), key,
+                                                   deflate or None)
+
+        except Exception:
+            sock.close()
+            raise
+
+        environ["PATH_INFO"] = urlparse(url).path or "/"
+        environ["wsocket.socket"] = sock
+        self.url = url
+        self.stream = stream
+        # frames are read from the buffered stream that holds what came
+        # after the response
+        WebSocket.__init__(self, environ, stream.read, sock.sendall,
+                           handler or self, do_compress)
+        self.protocol = environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL")
 
     def on_close(self, message):
-        print(message)
+        """called when the connection is found closed, unless `handler`"""
 
-    def on_connect(self, client):
-        print(client)
-        client.send('you connected')
+    def write_frame(self, header, payload):
+        # looked up on the class, so it is the traced one under a tracer
+        WebSocket.write_frame(self, *mask_frame(header, payload))
 
-    def fake(*args, **kwargs):
-        pass
+    def close(self, code=1000, message=b""):
+        """`WebSocket.close()` and close the connection"""
+        if self.closed:
+            return
 
-    def on_message(self, message, client):
-        print(repr(message))
+        sock = self.socket
+        WebSocket.close(self, code, message)
+        stream = getattr(self, "stream", None)
+        if stream is not None:
+            stream.close()
+
+        if sock is not None:
+            sock.close()
+
+
+class AsyncWebSocketClient(AsyncWebSocket):
+    """
+    asyncio flavour of `WebSocketClient`, connected with `await
+    AsyncWebSocketClient.connect(url)`.
+    """
+
+    masked = True
+
+    def __init__(self, environ, reader, writer, handler=None,
+                 do_compress=None):
+        AsyncWebSocket.__init__(self, environ, reader, writer,
+                                handler or self, do_compress)
+        self.protocol = environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL")
+
+    @classmethod
+    async def connect(cls, url, protocols=(), headers=(), deflate=True,
+                      ssl_context=None, handler=None):
+        if deflate is True:
+            deflate = PerMessageDeflate()
+
+        host, port, secure, key, request = client_request(
+            url, protocols, headers, deflate or None)
+        # asyncio streams set TCP_NODELAY
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=(ssl_context or True) if secure else None)
         try:
-            client.send("you said: " + message)
-            sleep(2)
-            client.send("you said: " + message)
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            environ, do_compress = client_response(head, key,
+                                                   deflate or None)
 
-        except WebSocketError:
-            pass
+        except Exception:
+            writer.close()
+            raise
 
-    def route(self, r):
-        def decorator(callback):
-            self.routes[r] = callback
-            return callback
+        environ["PATH_INFO"] = urlparse(url).path or "/"
+        client = cls(environ, reader, writer, handler, do_compress)
+        client.url = url
+        return client
 
-        return decorator
+    def on_close(self, message):
+        """called when the connection is found closed, unless `handler`"""
 
-    def not_found(self, environ, start_response):
-        start_response(404)
-        return "<h1>Page Not Found(404)</h1><p><b>%s</b></p>" % (
-            environ.get("PATH_INFO") + "?" + environ.get("QUERY_STRING", "\b"))
+    def write_frame(self, header, payload):
+        # looked up on the class, so it is the traced one under a tracer
+        AsyncWebSocket.write_frame(self, *mask_frame(header, payload))
 
-    def wsgi(self, environ, start_response):
-        if len(self.routes):
-            for route in self.routes:
-                if route == environ.get("PATH_INFO"):
-                    r = Response(environ, start_response, self.routes[route])
-                    return r.process_response()
-
-                if route.endswith("*") and environ.get(
-                        "PATH_INFO", "").startswith(route[:-1]):
-                    r = Response(environ, start_response, self.routes[route])
-                    return r.process_response()
-
-            r = Response(environ, start_response, self.not_found)
-            return r.process_response()
+    def close(self, code=1000, message=b""):
+        """`WebSocket.close()` and close the connection"""
+        if self.closed:
+            return
 
-        wsock = environ.get("wsgi.websocket")
-        if not wsock:
-            start_response()
-            return "<h1>Hello World!</h1>"
+        WebSocket.close(self, code, message)
+        writer = getattr(self, "writer", None)
+        if writer is not None:
+            writer.close()
 
-        self.onconnect(wsock)
-        while True:
-            try:
-                message = wsock.receive()
-                if message != None:
-                    self.onmessage(message, wsock)
 
-            except WebSocketError as e:
-                break
+class ClientPool(object):
+    """
+    Client connections to many servers, for fan-out. Up to `size`
+    connections per url are opened when first needed, used in turn and
+    opened again after they close. `options` are passed to the client.
+    """
 
-        return []
+    client_class = WebSocketClient
 
-    def __call__(self, environ, start_response):
-        if "wsgi.websocket" in environ or environ.get("REQUEST_METHOD",
-                                                      "") != "GET":
-            r = Response(environ, start_response, self.app)
-            return r.process_response()
-        # Upgrade
-        # Connection
-        if "websocket" not in map(
-                str.strip,
-                environ.get("HTTP_UPGRADE",
-                            "").lower().split(",")) or "upgrade" not in map(
-                                str.strip,
-                                environ.get("HTTP_CONNECTION",
-                                            "").lower().split(",")):
-            r = Response(environ, start_response, self.app)
-            return r.process_response()
-        # Sec-WebSocket-Version PLUS determine mode: Hybi or Hixie
-        if "HTTP_SEC_WEBSOCKET_VERSION" not in environ:
-            logger.warning(
-                "WebSocket connection denied - Hixie76 protocol not supported."
-            )
-            start_response(
-                "426 Upgrade Required",
-                [("Sec-WebSocket-Version", ", ".join(self.SUPPORTED_VERSIONS))
-                 ],
-            )
-            return [b"No Websocket protocol version defined"]
+    def __init__(self, size=1, **options):
+        self.size = size
+        self.options = options
+        self.clients = {}  # url: [client, ...]
+        self.turns = {}  # url: connections taken
+        self.connecting = {}  # url: connections being opened
+        self.lock = Condition()
 
-        version = environ.get("HTTP_SEC_WEBSOCKET_VERSION")
+    def take(self, url):
+        """
+        an open client of `url`, or `None` if the caller has to open one,
+        see `opened`. `False` while the others open the last ones.
+        """
+        clients = [
+            client for client in self.clients.get(url, ())
+            if not client.closed
+        ]
+        self.clients[url] = clients
+        connecting = self.connecting.get(url, 0)
+        if len(clients) + connecting < self.size:
+            self.connecting[url] = connecting + 1
+            return None
 
-        # respond with list of supported versions (descending order)
-        if version not in self.SUPPORTED_VERSIONS:
-            msg = "Unsupported WebSocket Version: %s" % version
-            logger.warning(msg)
-            start_response(
-                "400 Bad Request",
-                [("Sec-WebSocket-Version", ", ".join(self.SUPPORTED_VERSIONS))
-                 ],
-            )
-            return [msg.encode()]
+        if not clients:
+            return False
 
-        key = environ.get("HTTP_SEC_WEBSOCKET_KEY", "").strip()
-        if not len(key):
-            msg = "Sec-WebSocket-Key header is missing/empty"
-            logger.warning(msg)
-            start_response("400 Bad Request", [])
-            return [msg.encode()]
+        turn = self.turns[url] = self.turns.get(url, 0) + 1
+        return clients[turn % len(clients)]
 
-        try:
-            key_len = len(b64decode(key))
+    def opened(self, url, client):
+        """add a client opened after `take`, `None` if it failed"""
+        self.connecting[url] -= 1
+        if client is not None:
+            self.clients.setdefault(url, []).append(client)
 
-        except TypeError:
-            msg = "Invalid key: %s" % key
-            logger.warning(msg)
-            start_response("400 Bad Request", [])
-            return [msg.encode()]
+    def get(self, url):
+        """a connection to `url`"""
+        with self.lock:
+            client = self.take(url)
+            while client is False:
+                self.lock.wait()
+                client = self.take(url)
 
-        if key_len != 16:
-            msg = "Invalid key: %s" % key
-            logger.warning(msg)
-            start_response("400 Bad Request", [])
-            return [msg.encode]
+            if client is not None:
+                return client
 
-        # Sec-WebSocket-Protocol
-        requested_protocols = list(
-            map(str.strip,
-                environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL", "").split(",")))
-        protocols = None
-        protocols = set(requested_protocols) and set(self.protocols)
-        logger.debug("Protocols allowed: {0}".format(", ".join(protocols)))
+        # opened without the lock, the other urls do not wait for it
+        try:
+            client = self.client_class(url, **self.options)
 
-        extensions = list(
-            map(lambda ext: ext.split(";")[0].strip(),
-                environ.get("HTTP_SEC_WEBSOCKET_EXTENSIONS", "").split(",")))
+        finally:
+            with self.lock:
+                self.opened(url, client)
+                self.lock.notify_all()
 
-        do_compress = "permessage-deflate" in extensions
+        return client
 
-        if PY3:
-            accept = b64encode(
-                sha1((key +
-                      self.GUID).encode("latin-1")).digest()).decode("latin-1")
+    def send(self, url, message, binary=None, do_compress=True):
+        self.get(url).send(message, binary, do_compress)
 
-        else:
-            accept = b64encode(sha1(key + self.GUID).digest())
+    def send_all(self, message, urls=None, binary=None, do_compress=True):
+        """
+        Send `message` to every url(of the open connections by default)
+        and return the urls it could not be sent to.
+        """
+        failed = []
+        for url in list(self.clients) if urls is None else urls:
+            try:
+                self.send(url, message, binary, do_compress)
 
-        headers = [
-            ("Upgrade", "websocket"),
-            ("Connection", "Upgrade"),
-            ("Sec-WebSocket-Accept", accept),
-        ]
+            except (WebSocketError, socket.error):
+                failed.append(url)
 
-        if do_compress:
-            headers.append(("Sec-WebSocket-Extensions", "permessage-deflate"))
+        return failed
 
-        if protocols:
-            headers.append(("Sec-WebSocket-Protocol", ", ".join(protocols)))
+    def close(self):
+        with self.lock:
+            clients, self.clients = self.clients, {}
 
-        logger.debug("WebSocket request accepted, switching protocols")
-        write = start_response("101 Switching Protocols", headers)
-        read = environ["wsgi.input"].read
-        write(b"")
-        websocket = self.websocket_class(environ, read, write, self,
-                                         do_compress)
-        environ.update({
-            "wsgi.websocket_version": version,
-            "wsgi.websocket": websocket
-        })
-        r = Response(environ, start_response, self.app)
-        r.start_response = self.fake
-        return r.process_response(False)
+        for url_clients in clients.values():
+            for client in url_clients:
+                client.close()
 
+    def __enter__(self):
+        return self
 
-# for version compat
-class WebSocketHandler(FixedHandler):
-    def get_app(self):
-        return WSocketApp(self.server.get_app())
+    def __exit__(self, *exc_info):
+        self.close()
 
 
-WSocketHandler = WebSocketHandler
+class AsyncClientPool(ClientPool):
+    """asyncio flavour of `ClientPool`, sends to all urls concurrently"""
 
+    client_class = AsyncWebSocketClient
 
-class WSocketServer(ThreadingWSGIServer):
-    def set_app(self, app, *args, **kwargs):
-        ThreadingWSGIServer.set_app(self, WSocketApp(app), *args, **kwargs)
+    def __init__(self, size=1, **options):
+        ClientPool.__init__(self, size, **options)
+        self.lock = None  # an `asyncio.Condition`, made in the event loop
 
+    async def get(self, url):
+        if self.lock is None:
+            self.lock = asyncio.Condition()
 
-def run(app=WSocketApp(), host="127.0.0.1", port=8080, **options):
-    handler_cls = options.get("handler_class", FixedHandler)
-    server_cls = options.get("server_class", ThreadingWSGIServer)
+        async with self.lock:
+            client = self.take(url)
+            while client is False:
+                await self.lock.wait()
+                client = self.take(url)
 
-    if ":" in host:  # Fix wsgiref for IPv6 addresses.
-        if getattr(server_cls, "address_family") == socket.AF_INET:
+            if client is not None:
+                return client
 
-            class server_cls(server_cls):
-                address_family = socket.AF_INET6
+        try:
+            client = await self.client_class.connect(url, **self.options)
 
-    srv = make_server(host, port, app, server_cls, handler_cls)
-    port = srv.server_port  # update port actual port (0 means random)
-    print("Server started at http://%s:%i." % (host, port))
-    try:
-        srv.serve_forever()
+        finally:
+            async with self.lock:
+                self.opened(url, client)
+                self.lock.notify_all()
+
+        return client
+
+    async def send(self, url, message, binary=None, do_compress=True):
+        client = await self.get(url)
+        await client.send(message, binary, do_compress)
+
+    async def send_all(self, message, urls=None, binary=None,
+                       do_compress=True):
+        urls = list(self.clients) if urls is None else list(urls)
+        results = await asyncio.gather(*[
+            self.send(url, message, binary, do_compress) for url in urls
+        ], return_exceptions=True)
+        failed = []
+        for url, result in zip(urls, results):
+            if isinstance(result, (WebSocketError, socket.error)):
+                failed.append(url)
+
+            elif isinstance(result, BaseException):
+                raise result
+
+        return failed
+
+    def close(self):
+        clients, self.clients = self.clients, {}
+        for url_clients in clients.values():
+            for client in url_clients:
+                client.close()
+
+    async def __aenter__(self):
+        return self
 
-    except KeyboardInterrupt:
-        print("\nServer stopped.")
-        srv.server_close()  # Prevent ResourceWarning: unclosed socket
+    async def __aexit__(self, *exc_info):
+        self.close()
 
 
 if __name__ == "__main__":